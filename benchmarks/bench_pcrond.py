@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+"""
+Benchmarks for pcrond: parsing, matching, dispatch and loading.
+
+    python benchmarks/bench_pcrond.py -o results.json
+    python benchmarks/bench_pcrond.py -o new.json -c results.json
+
+Results are stored as JSON; with --compare, benchmarks slower than the baseline by more than
+--threshold are reported, and the exit code is 1.
+"""
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pcrond import Job, Parser, Scheduler     # noqa: E402
+from pcrond import compiled                   # noqa: E402
+from pcrond.sched import std_launch_func      # noqa: E402
+
+REALISTIC_PATTERNS = ["*/5 * * * *", "0 * * * *", "30 4 * * mon", "0 0 1 * *", "15 14 1 * *", "0 22 * * 1-5",
+                      "23 0-23/2 * * *", "5 4 * * sun", "0 0,12 1 */2 *", "0 9-17 * jan-mar,oct-dec mon-fri",
+                      "0 0 L * *", "0 12 15w * *", "0 8 * * 5l", "0 8 * * fri#2", "0 0 1 1 * 2030"]
+ADVERSARIAL_PATTERNS = [",".join(str(i) for i in range(60)) + " * * * *",
+                        "0-59/1 0-23/1 1-31/1 1-12/1 0-6/1",
+                        ",".join("%d-%d/2" % (i, i + 10) for i in range(0, 49)) + " * * * *",
+                        "* * " + ",".join("%dw" % i for i in range(1, 32)) + " * *",
+                        "* * * * " + ",".join("%d#%d" % (d, n) for d in range(7) for n in range(1, 6))]
+
+
+def random_pattern(rnd):
+    return "%d %s %s * %s" % (rnd.randrange(60),
+                              rnd.choice(["*", str(rnd.randrange(24)), "*/%d" % rnd.randrange(1, 12)]),
+                              rnd.choice(["*", "*", str(rnd.randrange(1, 29)), "L", "15w"]),
+                              rnd.choice(["*", "*", "mon-fri", str(rnd.randrange(7)), "5l"]))
+
+
+def do_nothing():
+    pass
+
+
+def timeit(func, repeat):
+    """
+    :return: list of durations of func(), in seconds
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter() if hasattr(time, 'perf_counter') else time.time()
+        func()
+        end = time.perf_counter() if hasattr(time, 'perf_counter') else time.time()
+        times.append(end - start)
+    return times
+
+
+def bench_parser(scale):
+    parser = Parser()
+
+    def parse(patterns):
+        def f():
+            compiled.clear_cache()
+            for pattern in patterns:
+                fields = pattern.lower().split()
+                parser.parse_minute(fields[0])
+                parser.parse_hour(fields[1])
+                parser.parse_day_in_month(fields[2])
+                parser.parse_month(fields[3])
+                parser.parse_day_in_week(fields[4])
+        return f
+    yield ("parser.realistic", parse(REALISTIC_PATTERNS * 20 * scale))
+    yield ("parser.adversarial", parse(ADVERSARIAL_PATTERNS * 4 * scale))
+
+    def create_jobs():
+        compiled.clear_cache()
+        for pattern in REALISTIC_PATTERNS * 20 * scale:
+            Job(pattern)
+    yield ("job.create", create_jobs)
+
+
+def bench_should_run_at(scale):
+    jobs = [Job(pattern) for pattern in REALISTIC_PATTERNS]
+    start = datetime(2019, 1, 1)
+    minutes = [start + timedelta(minutes=i) for i in range(0, 365 * 24 * 60, 60 // scale if scale < 60 else 1)]
+
+    def f():
+        for job in jobs:
+            for minute in minutes:
+                job._should_run_at(minute)
+    yield ("job.should_run_at.year", f)
+
+    def g():
+        for job in jobs:
+            job.next_run_at(start)
+    yield ("job.next_run_at", g)
+
+
+def bench_run_pending(scale):
+    rnd = random.Random(42)
+    for n in [10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6][:scale + 1]:
+        sched = Scheduler()
+        sched.bulk_load(["%s echo %d" % (random_pattern(rnd), i) for i in range(n)], processes=1)
+        for job in sched.jobs:
+            job.job_func = do_nothing
+        # consecutive minutes from now on, so that no job is seen as missed
+        tick = [datetime.now().replace(second=0, microsecond=0) + timedelta(minutes=1)]
+
+        def f(sched=sched, tick=tick):
+            for _ in range(10):
+                sched._run_pending_at(tick[0])
+                tick[0] += timedelta(minutes=1)
+        yield ("scheduler.run_pending.%d" % n, f)
+
+
+def bench_load_crontab(scale):
+    rnd = random.Random(42)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for n in [10 ** 3, 10 ** 4, 10 ** 5][:scale + 1]:
+            path = os.path.join(tmpdir, "crontab%d" % n)
+            with open(path, "w") as fp:
+                for i in range(n):
+                    fp.write("%s echo %d\n" % (random_pattern(rnd), i))
+            sched = Scheduler()
+
+            def f(sched=sched, path=path):
+                compiled.clear_cache()
+                sched.load_crontab_file(path)
+            yield ("scheduler.load_crontab_file.%d" % n, f)
+    finally:
+        # reached only after all benchmarks above have been run
+        shutil.rmtree(tmpdir)
+
+
+def bench_launch(scale):
+    true_cmd = [sys.executable, "-c", "pass"] if sys.platform.startswith("win") else ["true"]
+    launch = std_launch_func(true_cmd)
+
+    def f():
+        for _ in range(5 * scale):
+            launch()
+    yield ("std_launch_func.dispatch", f)
+
+
+BENCHMARKS = [bench_parser, bench_should_run_at, bench_run_pending, bench_load_crontab, bench_launch]
+
+
+def run(scale, repeat, selected):
+    results = {}
+    for bench in BENCHMARKS:
+        for (name, func) in bench(scale):
+            if selected and not [s for s in selected if s in name]:
+                continue
+            times = timeit(func, repeat)
+            times.sort()
+            results[name] = {'min': times[0], 'median': times[len(times) // 2], 'repeat': repeat}
+            print("%-40s min %10.6fs   median %10.6fs" % (name, times[0], times[len(times) // 2]))
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    :return: the list of benchmark names slower than the baseline
+    """
+    regressions = []
+    for (name, result) in sorted(results.items()):
+        if name not in baseline:
+            continue
+        ratio = result['min'] / baseline[name]['min'] if baseline[name]['min'] else 1.0
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print("%-40s %6.2fx%s" % (name, ratio, flag))
+    return regressions
+
+
+def parse_args():
+    import argparse
+    parser = argparse.ArgumentParser(description='Run pcrond benchmarks.')
+    parser.add_argument('-o', '--output', help='write results to this JSON file')
+    parser.add_argument('-c', '--compare', help='compare results with this JSON file')
+    parser.add_argument('-t', '--threshold', type=float, default=0.10,
+                        help='relative slowdown reported as regression (default 0.10)')
+    parser.add_argument('-s', '--scale', type=int, default=1,
+                        help='size of the benchmarks, 3 goes up to 10^6 jobs (default 1)')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='repetitions of each benchmark (default 3)')
+    parser.add_argument('benchmarks', nargs='*', help='run only benchmarks whose name contains one of these')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    logging.disable(logging.WARNING)
+    results = run(args.scale, args.repeat, args.benchmarks)
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump({'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'date': datetime.now().isoformat(),
+                       'scale': args.scale,
+                       'results': results}, fp, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)['results']
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
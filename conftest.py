@@ -0,0 +1,4 @@
+import sys
+
+# test modules using async syntax cannot even be compiled on older Pythons
+collect_ignore = ["test_aiosched.py"] if sys.version_info < (3, 5) else []
@@ -5,6 +5,11 @@
 from .job import Job
 from .sched import Scheduler
 from .cronparser import Parser
+try:
+    from .aiosched import AsyncScheduler
+except SyntaxError:
+    # asyncio is not available in Python 2
+    pass
 
 # default instance
 scheduler = Scheduler()
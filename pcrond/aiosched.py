@@ -0,0 +1,177 @@
+# asyncio counterpart of sched.py, requires Python 3.5+
+
+import asyncio
+import inspect
+import logging
+import time
+from .job import when_done
+from .sched import Scheduler, LaunchCommand
+from . import metrics as _metrics
+
+logger = logging.getLogger('pcrond')
+
+
+class AsyncLaunchCommand(LaunchCommand):
+    """
+    A coroutine function executing a command, without blocking the event loop.
+    The coroutine returns once the command is started, with a task that waits for it, so that the child
+    is always reaped.
+    """
+    async def __call__(self):
+        """
+        Start the command.
+        :return: a Task, whose result is the exit code of the command
+        """
+        logger.info("Now running: " + str(self.cmd_splitted))
+        start = time.time()
+        stdin = self.stdin
+        if stdin is None:
+            proc = await asyncio.create_subprocess_exec(*self.cmd_splitted)
+        else:
+            if not isinstance(stdin, bytes):
+                stdin = stdin.encode()
+            proc = await asyncio.create_subprocess_exec(*self.cmd_splitted, stdin=asyncio.subprocess.PIPE)
+        _metrics.get_default().observe('pcrond_spawn_seconds', time.time() - start)
+        return asyncio.ensure_future(self._wait(proc, stdin))
+
+    @staticmethod
+    async def _wait(proc, stdin):
+        try:
+            if stdin is None:
+                return await proc.wait()
+            await proc.communicate(input=stdin)
+            return proc.returncode
+        except asyncio.CancelledError:
+            # the task was cancelled, es. by overlap policy OVERLAP_KILL
+            proc.kill()
+            await proc.wait()
+            raise
+
+    def __repr__(self):
+        return "AsyncLaunchCommand(%r)" % (self.cmd_splitted,)
+
+
+def async_launch_func(cmd_splitted, stdin=None):
+    """
+    Default way of executing commands in :class:`AsyncScheduler`,
+    using asyncio.create_subprocess_exec()
+    """
+    return AsyncLaunchCommand(cmd_splitted, stdin)
+
+
+def _is_async(job_func):
+    return inspect.iscoroutinefunction(job_func) or \
+        inspect.iscoroutinefunction(getattr(job_func, '__call__', None))
+
+
+class AsyncScheduler(Scheduler):
+    """
+    A :class:`Scheduler` running inside an asyncio event loop.
+    Job functions may be either coroutine functions, which run as tasks of the loop,
+    or plain callables, which are offloaded to the executor.
+    run_pending() and main_loop() must be called from within the running loop.
+    """
+    def __init__(self, executor=None, max_workers=None, metrics=None):
+        """
+        Constructor
+        :param executor:
+            where plain callables are executed: None (default) for the loop's default executor,
+            'thread' or 'process' for a pool owned by this Scheduler, or any
+            ``concurrent.futures.Executor``
+        :param max_workers:
+            max number of plain callables running in parallel, for 'thread' and 'process' executors
+        :param metrics:
+            see :class:`Scheduler`
+        """
+        super(AsyncScheduler, self).__init__(executor, max_workers, metrics)
+        self._tasks = set()
+        # set while main_loop() is running
+        self._loop = None
+        self._async_wakeup = None
+
+    def _notify(self):
+        """
+        Wake up main_loop(); may be called from any thread.
+        """
+        super(AsyncScheduler, self)._notify()
+        loop = self._loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self._async_wakeup.set)
+
+    def _start(self, job):
+        """
+        Start given job as a task of the running loop.
+        """
+        logger.info('Running job %s', job)
+        task = asyncio.ensure_future(self._run_job(job))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        # with OVERLAP_KILL, the task is cancelled
+        job._track(task)
+        task.add_done_callback(job._untrack)
+
+    async def _run_job(self, job):
+        start = time.time()
+        error = False
+        result = None
+        try:
+            if _is_async(job.job_func):
+                result = await job.job_func()
+            else:
+                loop = asyncio.get_event_loop()
+                result = await loop.run_in_executor(self.executor, job.job_func)
+            return result
+        except Exception as e:
+            error = True
+            logger.exception("Job %s raised an exception: %s", job, e)
+        finally:
+            if isinstance(result, asyncio.Future):
+                # a command, waited for by its own task; join() waits for it too
+                self._tasks.add(result)
+                result.add_done_callback(self._tasks.discard)
+            job._finish_when_done(result, lambda result: self._release(job))
+            when_done(result, lambda _: self._record_runtime(job, start, error))
+
+    def _record_runtime(self, job, start, error):
+        self.metrics.observe('pcrond_job_runtime_seconds', time.time() - start)
+        if self.profiler is not None:
+            # CPU time cannot be told apart among tasks, only wall time is measured
+            self.profiler.record_run(job, time.time() - start, error=error)
+
+    async def join(self):
+        """
+        Wait for all running jobs to terminate.
+        """
+        while self._tasks:
+            await asyncio.wait(list(self._tasks))
+
+    def load_crontab_file(self, crontab_file, clear=True, job_func_func=async_launch_func, incremental=False):
+        """
+        Read crontab file, create corresponding jobs in this scheduler.
+        Same as :meth:`Scheduler.load_crontab_file`, but commands are launched with asyncio.
+        """
+        return super(AsyncScheduler, self).load_crontab_file(crontab_file, clear, job_func_func, incremental)
+
+    def watch_crontab_file(self, crontab_file, job_func_func=async_launch_func, interval=5):
+        """
+        Same as :meth:`Scheduler.watch_crontab_file`, but commands are launched with asyncio.
+        """
+        return super(AsyncScheduler, self).watch_crontab_file(crontab_file, job_func_func, interval)
+
+    async def main_loop(self):
+        """
+        Perform main run-and-wait loop, as a coroutine.
+        Sleep until the next scheduled run, or until jobs are added or removed, or stop() is called.
+        """
+        self._async_wakeup = asyncio.Event()
+        self._loop = asyncio.get_event_loop()
+        try:
+            while not self.ask_for_stop:
+                self._async_wakeup.clear()
+                self.run_pending()
+                try:
+                    await asyncio.wait_for(self._async_wakeup.wait(), self._sleep_time())
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._loop = None
@@ -0,0 +1,119 @@
+"""
+Batch evaluation of many jobs over a range of minutes.
+
+Each job is evaluated into a *row*, that is a Python integer whose bit i is set iff the job
+fires at the i-th minute of the range. Rows are built one day at a time by shifting a
+precomputed 1440-bit mask of the minutes of a day, so that the cost is proportional to
+the number of days, not minutes, and Python big-integer operations act as vectorized
+operations over the whole range.
+"""
+from datetime import timedelta
+
+MINUTES_PER_DAY = 24 * 60
+
+
+def _minute_range(start, end):
+    """
+    :return: start truncated to the minute, and the number of minutes in [start, end)
+    """
+    start = start.replace(second=0, microsecond=0)
+    size = int((end - start).total_seconds() // 60)
+    if (end - start).total_seconds() % 60:
+        size += 1
+    return (start, max(size, 0))
+
+
+def day_row(compiled):
+    """
+    :return: a 1440-bit integer, whose bit h*60+m is set iff given CompiledSchedule
+             allows hour h and minute m
+    """
+    row = 0
+    for h in range(24):
+        if (compiled.hour_mask >> h) & 1:
+            row |= compiled.minute_mask << (h * 60)
+    return row
+
+
+def compiled_row(compiled, start, end):
+    """
+    :return: the row of given CompiledSchedule over the range [start, end)
+    """
+    (start, size) = _minute_range(start, end)
+    daily = day_row(compiled)
+    if not daily:
+        return 0
+    row = 0
+    midnight = start.replace(hour=0, minute=0)
+    offset = -(start.hour * 60 + start.minute)      # bit offset of current day in the row
+    while offset < size:
+        if (compiled.month_mask >> midnight.month) & 1 and compiled.year_matches(midnight.year) \
+                and (compiled.day_mask(midnight.year, midnight.month) >> midnight.day) & 1:
+            row |= (daily << offset) if offset >= 0 else (daily >> -offset)
+        midnight += timedelta(days=1)
+        offset += MINUTES_PER_DAY
+    return row & ((1 << size) - 1)
+
+
+def job_rows(jobs, start, end):
+    """
+    :return: the list of rows of given jobs over the range [start, end).
+             Jobs sharing the same CompiledSchedule are evaluated once.
+    """
+    rows = {}
+    result = []
+    for job in jobs:
+        key = id(job.compiled)
+        if key not in rows:
+            rows[key] = compiled_row(job.compiled, start, end)
+        result.append(rows[key])
+    return result
+
+
+def _bit_indexes(row):
+    """
+    :return: the list of indexes of the bits set in given row
+    """
+    s = bin(row)[:1:-1]     # least significant bit first
+    indexes = []
+    i = s.find('1')
+    while i >= 0:
+        indexes.append(i)
+        i = s.find('1', i + 1)
+    return indexes
+
+
+def match_matrix(jobs, start, end):
+    """
+    :return: a list containing, for each job, a list of booleans, one per minute in [start, end).
+             Element [j][i] is True iff the j-th job should run at the i-th minute.
+    """
+    (_, size) = _minute_range(start, end)
+    matrix = []
+    for row in job_rows(jobs, start, end):
+        s = bin(row)[:1:-1]
+        matrix.append([c == '1' for c in s] + [False] * (size - len(s)) if row else [False] * size)
+    return matrix
+
+
+def fire_times(jobs, start, end):
+    """
+    :return: a list containing, for each job, the list of datetimes in [start, end) when it should run
+    """
+    (first, _) = _minute_range(start, end)
+    return [[first + timedelta(minutes=i) for i in _bit_indexes(row)] for row in job_rows(jobs, start, end)]
+
+
+def fires_per_minute(jobs, start, end):
+    """
+    :return: a list containing, for each minute in [start, end), the number of jobs that should run
+    """
+    (_, size) = _minute_range(start, end)
+    counts = [0] * size
+    multiplicity = {}
+    for row in job_rows(jobs, start, end):
+        multiplicity[row] = multiplicity.get(row, 0) + 1
+    for (row, n) in multiplicity.items():
+        for i in _bit_indexes(row):
+            counts[i] += n
+    return counts
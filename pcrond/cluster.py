@@ -0,0 +1,231 @@
+import bisect
+import errno
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger('pcrond')
+
+
+def _ring_hash(text):
+    """
+    :return: a stable 32-bit hash of given string; crc32 would spread similar strings badly on the ring
+    """
+    return int(hashlib.md5(text.encode('utf-8')).hexdigest()[:8], 16)
+
+
+class HashRing(object):
+    """
+    Consistent hashing of job keys over a set of nodes: when a node joins or leaves,
+    only the jobs it owns, or will own, change owner.
+    """
+    def __init__(self, nodes, replicas=100):
+        """
+        Constructor
+        :param nodes: names of the nodes
+        :param replicas: points of each node on the ring, more points give a more even spread
+        """
+        self.nodes = sorted(set(nodes))
+        if not self.nodes:
+            raise ValueError("at least one node is required")
+        points = sorted((_ring_hash("%s#%d" % (node, i)), node) for node in self.nodes for i in range(replicas))
+        self._hashes = [h for (h, _) in points]
+        self._nodes = [node for (_, node) in points]
+
+    def preference(self, key):
+        """
+        :return: all nodes, in the order they should run given job key: the owner first
+        """
+        pos = bisect.bisect(self._hashes, _ring_hash(key))
+        found = []
+        for i in range(len(self._nodes)):
+            node = self._nodes[(pos + i) % len(self._nodes)]
+            if node not in found:
+                found.append(node)
+                if len(found) == len(self.nodes):
+                    break
+        return found
+
+    def owner(self, key):
+        """
+        :return: the node owning given job key
+        """
+        return self._nodes[bisect.bisect(self._hashes, _ring_hash(key)) % len(self._nodes)]
+
+
+class LeaseBackend(object):
+    """
+    Where nodes record which one took each firing of a job.
+    A lease is identified by a job key and the timestamp of the scheduled run; it can be acquired only once.
+    """
+    def acquire(self, key, fire_ts, node):
+        """
+        Take the lease of given firing, if nobody did yet; this must be atomic among all nodes.
+        :return: ``True`` if given node got the lease
+        """
+        raise NotImplementedError
+
+    def holder(self, key, fire_ts):
+        """
+        :return: the node holding the lease of given firing, or None
+        """
+        raise NotImplementedError
+
+    def purge(self, before):
+        """
+        Forget leases of firings scheduled before given timestamp.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SQLiteLeaseBackend(LeaseBackend):
+    """
+    Leases stored in a SQLite database, which can be shared by processes of the same host,
+    or of hosts sharing a file system with working locks.
+    """
+    def __init__(self, path, timeout=10):
+        """
+        Constructor; the database is created if it does not exist
+        :param timeout: max seconds to wait for a lock held by another node
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS leases ("
+                           "job TEXT NOT NULL, fire INTEGER NOT NULL, node TEXT NOT NULL, "
+                           "PRIMARY KEY (job, fire))")
+
+    def acquire(self, key, fire_ts, node):
+        with self._lock:
+            cursor = self._conn.execute("INSERT OR IGNORE INTO leases VALUES (?, ?, ?)", (key, int(fire_ts), node))
+            return cursor.rowcount == 1
+
+    def holder(self, key, fire_ts):
+        with self._lock:
+            row = self._conn.execute("SELECT node FROM leases WHERE job = ? AND fire = ?",
+                                     (key, int(fire_ts))).fetchone()
+        return row[0] if row is not None else None
+
+    def purge(self, before):
+        with self._lock:
+            self._conn.execute("DELETE FROM leases WHERE fire < ?", (int(before),))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class FileLeaseBackend(LeaseBackend):
+    """
+    Leases stored as files of a directory, created with O_EXCL, which is atomic on local file systems
+    and on NFS v3 and later.
+    """
+    def __init__(self, directory):
+        """
+        Constructor; the directory is created if it does not exist
+        """
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, key, fire_ts):
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, "%d-%s" % (int(fire_ts), digest))
+
+    def acquire(self, key, fire_ts, node):
+        try:
+            fd = os.open(self._path(key, fire_ts), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                return False
+            raise
+        try:
+            os.write(fd, node.encode('utf-8'))
+        finally:
+            os.close(fd)
+        return True
+
+    def holder(self, key, fire_ts):
+        try:
+            with open(self._path(key, fire_ts), 'rb') as fp:
+                return fp.read().decode('utf-8')
+        except (IOError, OSError):
+            return None
+
+    def purge(self, before):
+        for name in os.listdir(self.directory):
+            try:
+                if int(name.split('-', 1)[0]) < before:
+                    os.remove(os.path.join(self.directory, name))
+            except (ValueError, OSError):
+                pass
+
+
+class Coordinator(object):
+    """
+    Let the Schedulers of several nodes, loaded with the same jobs, run each firing only once.
+    Enable it by setting ``Scheduler.coordinator``.
+
+    Jobs are partitioned among nodes by consistent hashing of their key (see :class:`Job`).
+    When a job is due, its owner takes the lease of that firing, and runs it.
+    The other nodes try the same lease after takeover_delay seconds each, in ring order,
+    so that the job still runs, late, if its owner is down.
+    """
+    def __init__(self, node, nodes, backend, takeover_delay=30, retention=86400, replicas=100):
+        """
+        Constructor
+        :param node: the name of this node
+        :param nodes: the names of all nodes, this one included
+        :param backend: a LeaseBackend shared by all nodes
+        :param takeover_delay: seconds before the next node in line runs a job whose owner did not
+        :param retention: seconds leases are kept; must be longer than the takeovers of all nodes
+        """
+        self.node = node
+        self.backend = backend
+        self.takeover_delay = takeover_delay
+        self.retention = retention
+        self.replicas = replicas
+        self.set_nodes(nodes)
+        self._last_purge = 0
+
+    def set_nodes(self, nodes):
+        """
+        Change the members of the cluster, es. when a node is added or removed for good.
+        """
+        if self.node not in nodes:
+            raise ValueError("node %s is not among %s" % (self.node, nodes))
+        self.ring = HashRing(nodes, self.replicas)
+
+    def owns(self, key):
+        """
+        :return: ``True`` if this node owns given job key
+        """
+        return self.ring.owner(key) == self.node
+
+    def delay(self, key):
+        """
+        :return: seconds this node should wait before trying to run given job key; 0 if it owns it
+        """
+        return self.ring.preference(key).index(self.node) * self.takeover_delay
+
+    def claim(self, key, fire_ts):
+        """
+        Try to take the lease of given firing.
+        Errors of the backend are logged, and the run is left to other nodes.
+        :return: ``True`` if this node should run it
+        """
+        now = time.time()
+        try:
+            if now - self._last_purge > self.retention / 24.0:
+                self._last_purge = now
+                self.backend.purge(now - self.retention)
+            return self.backend.acquire(key, fire_ts, self.node)
+        except Exception as e:
+            logger.error("Cannot acquire lease of %s: %s", key, e)
+            return False
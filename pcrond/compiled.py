@@ -0,0 +1,331 @@
+import calendar
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from .cronparser import Parser, uses_hash
+
+# years are stored in a bitmask, bit 0 meaning year YEAR_BASE
+YEAR_BASE = 1970
+
+# when looking for the next match of a pattern without a year token, give up after this many years.
+# The calendar (leap years and weekdays) repeats every 28 years, at least inside a century.
+SEARCH_YEARS = 28
+
+# max number of distinct patterns kept by compile_crontab()
+CACHE_SIZE = 10000
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+# day masks, shared by schedules with the same day rules, as {day rules: {month shape: mask}}
+_day_masks = {}
+# (weekday of the 1st, number of days) of each (year, month) seen
+_month_shapes = {}
+
+
+def to_mask(values, minval, maxval):
+    """
+    :return: an integer whose bit i is set iff i is in given values,
+             or all bits from minval to maxval if values is None
+    """
+    if values is None:
+        return ((1 << (maxval + 1)) - 1) & ~((1 << minval) - 1)
+    mask = 0
+    for x in values:
+        if x >= 0:
+            mask |= 1 << x
+    return mask
+
+
+def next_bit(mask, i):
+    """
+    :return: the index of the first bit set in mask, not before bit i, or None
+    """
+    m = mask >> i
+    if not m:
+        return None
+    return i + (m & -m).bit_length() - 1
+
+
+def last_dom(year, month):
+    """ get last day in given month """
+    return month_shape(year, month)[1]
+
+
+def month_shape(year, month):
+    """
+    :return: the weekday of the first day of given month (Monday is 0), and its number of days
+    """
+    key = year * 16 + month
+    shape = _month_shapes.get(key)
+    if shape is None:
+        shape = _month_shapes[key] = calendar.monthrange(year, month)
+    return shape
+
+
+def _check_w(wdom, day, weekday, lday):
+    """ used for checking 15w """
+    if weekday >= 5:
+        return False
+    if day in wdom:
+        return True
+    if weekday == 0:
+        if (day - 1) in wdom:
+            return True
+        # 1w matches monday, 3rd
+        if day == 3 and 1 in wdom:
+            return True
+    elif weekday == 4:
+        if (day + 1) in wdom:
+            return True
+        # 31w matches friday, 29th
+        if day == lday - 2 and lday in wdom:
+            return True
+    return False
+
+
+class CompiledSchedule(object):
+    """
+    A crontab pattern compiled into bitmasks, so that matching a datetime is a handful of bit tests.
+    Day-of-month and day-of-week rules (including L, W and #) are evaluated into a mask of matching days,
+    that depends only on the shape of the month, i.e. the weekday of the 1st and the number of days;
+    masks are shared by all schedules with the same day rules.
+    """
+    __slots__ = ('minute_mask', 'hour_mask', 'month_mask', 'year_mask', 'every_year',
+                 'dom', 'last_dom', 'wdom', 'dow', 'dowl', 'dow_sharp', 'seconds', '_day_masks', 'pattern', 'fields',
+                 'seed')
+
+    def __init__(self, minutes, hours, doms, last_dom, wdoms, months, dows, dowl, dow_sharp, years, seconds=()):
+        """
+        Each parameter is a set of allowed values, as returned by :class:`Parser`, or None if every
+        value is allowed. Days of week are in Python convention, i.e. Monday is 0.
+        Seconds are () for patterns without a seconds field, that run at second 0.
+        """
+        # Parser does not check bounds, out-of-range values are discarded here
+        self.minute_mask = to_mask(minutes, 0, 59) & to_mask(None, 0, 59)
+        self.hour_mask = to_mask(hours, 0, 23) & to_mask(None, 0, 23)
+        self.month_mask = to_mask(months, 1, 12) & to_mask(None, 1, 12)
+        self.every_year = years is None
+        self.year_mask = 0 if years is None else to_mask([y - YEAR_BASE for y in years], 0, 0)
+        self.dom = None if doms is None else frozenset(doms)
+        self.last_dom = last_dom
+        self.wdom = frozenset(wdoms or ())
+        self.dow = None if dows is None else frozenset(dows)
+        self.dowl = frozenset(dowl or ())
+        self.dow_sharp = dict((n, frozenset(s)) for (n, s) in (dow_sharp or {}).items() if s)
+        # sorted tuple of the seconds of matching minutes when the pattern runs, None for minute-only patterns
+        if seconds is None:
+            seconds = range(60)
+        self.seconds = tuple(sorted(x for x in seconds if 0 <= x <= 59)) if seconds != () else None
+        self._day_masks = None      # shared with schedules having the same day rules, see day_mask()
+        # set by compile_crontab(): the normalized pattern, the Parser results, and the seed of H tokens
+        self.pattern = None
+        self.fields = None
+        self.seed = None
+
+    def day_mask(self, year, month):
+        """
+        :return: an integer whose bit d is set iff the day d of given month matches the pattern
+        """
+        (first_weekday, lday) = month_shape(year, month)
+        masks = self._day_masks
+        if masks is None:
+            masks = self._day_masks = _shared_day_masks(self)
+        key = first_weekday * 32 + lday
+        mask = masks.get(key)
+        if mask is None:
+            mask = masks[key] = self._compute_day_mask(first_weekday, lday)
+        return mask
+
+    def _compute_day_mask(self, first_weekday, lday):
+        mask = 0
+        for day in range(1, lday + 1):
+            w = (first_weekday + day - 1) % 7
+            if self.dow is not None:
+                sharp = self.dow_sharp.get((day - 1) // 7 + 1)
+                if not (w in self.dow
+                        or (w in self.dowl and day > lday - 7)
+                        or (sharp is not None and w in sharp)):
+                    continue
+            if self.dom is not None:
+                if not (day in self.dom
+                        or (self.last_dom and day == lday)
+                        or (self.wdom and _check_w(self.wdom, day, w, lday))):
+                    continue
+            mask |= 1 << day
+        return mask
+
+    def year_matches(self, year):
+        return self.every_year or (year >= YEAR_BASE and (self.year_mask >> (year - YEAR_BASE)) & 1)
+
+    def matches(self, now):
+        """
+        :return: ``True`` if the pattern matches given datetime (seconds are ignored, also the seconds field)
+        """
+        return bool((self.minute_mask >> now.minute) & 1
+                    and (self.hour_mask >> now.hour) & 1
+                    and (self.month_mask >> now.month) & 1
+                    and self.year_matches(now.year)
+                    and (self.day_mask(now.year, now.month) >> now.day) & 1)
+
+    def next_match(self, start):
+        """
+        Compute the first minute, not before given datetime, matching the pattern.
+        :param start:
+            a datetime; seconds and microseconds are ignored, so that the current minute
+            is returned if it matches
+        :return: a datetime, or None if the pattern won't match anymore
+        """
+        if not self.minute_mask or not self.hour_mask or not self.month_mask:
+            return None
+        if self.every_year:
+            last_year = start.year + SEARCH_YEARS
+        elif self.year_mask:
+            last_year = YEAR_BASE + self.year_mask.bit_length() - 1
+        else:
+            return None
+        first_hour = next_bit(self.hour_mask, 0)
+        first_minute = next_bit(self.minute_mask, 0)
+        (year, month, day) = (start.year, start.month, start.day)
+        while year <= last_year:
+            if not self.year_matches(year):
+                (year, month, day) = (year + 1, 1, 1)
+                continue
+            if not (self.month_mask >> month) & 1:
+                month = next_bit(self.month_mask, month + 1)
+                if month is None:
+                    (year, month) = (year + 1, next_bit(self.month_mask, 1))
+                day = 1
+                continue
+            days = self.day_mask(year, month)
+            day = next_bit(days, day)
+            while day is not None:
+                if (year, month, day) == (start.year, start.month, start.day):
+                    (hour, minute) = self._next_time_in_day(start.hour, start.minute)
+                else:
+                    (hour, minute) = (first_hour, first_minute)
+                if hour is not None:
+                    return datetime(year, month, day, hour, minute)
+                day = next_bit(days, day + 1)
+            if month == 12:
+                (year, month, day) = (year + 1, 1, 1)
+            else:
+                (month, day) = (month + 1, 1)
+        return None
+
+    def _next_time_in_day(self, hour, minute):
+        """
+        :return: the first allowed (hour, minute) not before given ones, or (None, None)
+        """
+        if (self.hour_mask >> hour) & 1:
+            m = next_bit(self.minute_mask, minute)
+            if m is not None:
+                return (hour, m)
+        h = next_bit(self.hour_mask, hour + 1)
+        if h is None:
+            return (None, None)
+        return (h, next_bit(self.minute_mask, 0))
+
+
+def _shared_day_masks(schedule):
+    """
+    :return: the dict of day masks of the schedules with the same day rules as given one
+    """
+    rules = (schedule.dom, schedule.last_dom, schedule.wdom, schedule.dow, schedule.dowl,
+             tuple(sorted(schedule.dow_sharp.items())))
+    masks = _day_masks.get(rules)
+    if masks is None:
+        if len(_day_masks) >= CACHE_SIZE:
+            # schedules keep their masks, new ones will share new dicts
+            _day_masks.clear()
+        masks = _day_masks.setdefault(rules, {})
+    return masks
+
+
+def _freeze(field):
+    """
+    :return: a copy of a Parser result, with sets replaced by frozensets
+    """
+    def freeze(x):
+        if isinstance(x, set):
+            return frozenset(x)
+        if isinstance(x, dict):
+            return dict((k, frozenset(v)) for (k, v) in x.items())
+        return x
+    return tuple(freeze(x) for x in field)
+
+
+def _compile_pattern(pattern, seed=None):
+    """
+    Parse and compile given normalized pattern, without caching.
+    """
+    parser = Parser(seed)
+    # the seconds field, if any, comes first
+    tokens = pattern[1:] if len(pattern) == 7 else pattern
+    minute = _freeze(parser.parse_minute(tokens[0]))
+    hour = _freeze(parser.parse_hour(tokens[1]))
+    # Day of month.
+    # L = last day
+    # 15W= nearest working day around the 15th, in the same month
+    dom = _freeze(parser.parse_day_in_month(tokens[2]))
+    month = _freeze(parser.parse_month(tokens[3]))
+    # Day of week.
+    # 5L = last friday of the month
+    # 5#2 = second friday of the month
+    dow = _freeze(parser.parse_day_in_week(tokens[4]))
+    year = _freeze(parser.parse_year(tokens[5]))
+    fields = (minute, hour, dom, month, dow, year)
+    seconds = ()
+    if len(pattern) == 7:
+        second = _freeze(parser.parse_second(pattern[0]))
+        fields += (second,)
+        seconds = None if second[0] else second[1]
+
+    def values(field):
+        return None if field[0] else field[1]
+    schedule = CompiledSchedule(values(minute), values(hour), values(dom), dom[2], dom[3], values(month),
+                                values(dow), dow[2], dow[3], values(year), seconds)
+    schedule.pattern = pattern
+    schedule.fields = fields
+    schedule.seed = seed
+    return schedule
+
+
+def compile_crontab(crontab_lst, seed=None):
+    """
+    Parse and compile a normalized crontab pattern, i.e. a list of 6 lowercase tokens, or 7 with seconds.
+    Results are kept in a LRU cache, so that jobs with the same pattern share the same CompiledSchedule,
+    which must then be treated as immutable.
+    :param seed: the job key, used only if the pattern contains H tokens
+    :raise ValueError: if the pattern is not valid
+    """
+    pattern = tuple(crontab_lst)
+    if seed is not None and not uses_hash(pattern):
+        seed = None
+    key = (pattern, seed)
+    with _cache_lock:
+        schedule = _cache.pop(key, None)
+        if schedule is not None:
+            _cache[key] = schedule              # now it is the most recently used
+            return schedule
+    return cache_schedule(_compile_pattern(pattern, seed))
+
+
+def cache_schedule(schedule):
+    """
+    Put in the cache of compile_crontab() a CompiledSchedule compiled elsewhere, es. in another process.
+    :return: the cached CompiledSchedule for the same pattern, that may be a previous one
+    """
+    with _cache_lock:
+        schedule = _cache.setdefault((schedule.pattern, schedule.seed), schedule)
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return schedule
+
+
+def clear_cache():
+    """
+    Empty the cache of compile_crontab()
+    """
+    with _cache_lock:
+        _cache.clear()
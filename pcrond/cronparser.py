@@ -1,13 +1,67 @@
+from collections import namedtuple
+import re
+import zlib
+
 MONTH_OFFSET = {'jan': '1', 'feb': '2', 'mar': '3', 'apr': '4', 'may': '5', 'jun': '6',
                 'jul': '7', 'aug': '8', 'sep': '9', 'oct': '10', 'nov': '11', 'dec': '12'}
 WEEK_OFFSET = {'sun': '0', 'mon': '1', 'tue': '2', 'wed': '3', 'thu': '4', 'fri': '5', 'sat': '6'}
 
 
+class FieldItem(namedtuple('FieldItem', ['start', 'end', 'step', 'modifier', 'nth', 'pos'])):
+    """
+    One of the comma-separated items of a crontab field, as returned by :meth:`Parser.tokenize`.
+    start, end: undecoded strings (es. '10', 'jul'); start is None for '*', end is None for singletons
+    step: integer, 1 if not given
+    modifier: None, 'l' (es. 5L), 'w' (es. 15W), '#' (es. 5#2, then nth is 2)
+        or 'h' (es. H, H/4, H(0-29)/10; start and end are the range, if any)
+    pos: position of the item inside the field, used in error messages
+    """
+    __slots__ = ()
+
+    @property
+    def is_any(self):
+        return self.start is None
+
+    @property
+    def is_range(self):
+        return self.end is not None
+
+
+def _error(s, pos, msg):
+    return ValueError("Wrong format '%s' at position %d - %s" % (s, pos, msg))
+
+
+def stable_hash(text):
+    """
+    :return: a hash of given string that does not change across runs, unlike hash()
+    """
+    return zlib.crc32(text.encode('utf-8')) & 0xffffffff
+
+
+# an H token, in a lowercase field; not the h inside 'thu'
+_HASH_TOKEN = re.compile(r'(^|,)h([^a-z]|$)')
+
+
+def uses_hash(pattern):
+    """
+    :return: ``True`` if some field of given normalized pattern contains an H token
+    """
+    return any(_HASH_TOKEN.search(field) for field in pattern)
+
+
 class Parser:
     """
     This class is just a library of "class" methods, used to parse crontab strings
     """
 
+    def __init__(self, seed=None):
+        """
+        :param seed:
+            a string identifying the job, used for choosing the value of H tokens
+            (es. H means some minute, always the same for a given seed)
+        """
+        self.seed = seed
+
     def decode_token(self, token, offsets):
         """
         return offsets[token], or token if not found
@@ -18,78 +72,163 @@ class Parser:
         except KeyError:
             return token
 
+    def tokenize(self, s, modifiers=''):
+        """
+        Parse a crontab field in a single pass.
+        given "1,2-5/3,jul,*/4" return the FieldItem's for '1', '2-5/3', 'jul' and '*/4'
+        :param modifiers:
+            the allowed modifiers among 'l', 'w', '#'. Modifiers are allowed only on singletons.
+        :return: a list of FieldItem
+        """
+        items = []
+        n = len(s)
+        i = 0
+        while True:
+            pos = i
+            hashed = False
+            if i < n and s[i] == '*':
+                start = None
+                i += 1
+            elif i < n and s[i] == 'h' and (i + 1 == n or not s[i + 1].isalnum()):
+                (start, end, hashed) = (None, None, True)
+                i += 1
+                if i < n and s[i] == '(':
+                    j = s.find(')', i)
+                    bounds = s[i + 1:j].split('-') if j > 0 else []
+                    if len(bounds) != 2 or not bounds[0].isalnum() or not bounds[1].isalnum():
+                        raise _error(s, i, "expecting H(x-y)")
+                    (start, end) = bounds
+                    i = j + 1
+            else:
+                j = i
+                while i < n and s[i].isalnum():
+                    i += 1
+                if i == j:
+                    raise _error(s, i, "expecting a value")
+                start = s[j:i]
+            if not hashed:
+                end = None
+            if i < n and s[i] == '-':
+                if start is None or hashed:
+                    raise _error(s, i, "a range cannot start with * or H")
+                i += 1
+                j = i
+                while i < n and s[i].isalnum():
+                    i += 1
+                if i == j:
+                    raise _error(s, i, "expecting a value after '-'")
+                end = s[j:i]
+            step = 1
+            if i < n and s[i] == '/':
+                if start is not None and end is None:
+                    raise _error(s, i, "a string y/z is meaningless, should be x-y/z")
+                i += 1
+                j = i
+                while i < n and s[i].isdigit():
+                    i += 1
+                if i == j:
+                    raise _error(s, i, "expecting an integer after '/'")
+                step = int(s[j:i])
+                if step == 0:
+                    raise _error(s, j, "step cannot be 0")
+            modifier = None
+            nth = None
+            if i < n and s[i] == '#':
+                if '#' not in modifiers or start is None or end is not None or hashed:
+                    raise _error(s, i, "unexpected '#'")
+                i += 1
+                j = i
+                while i < n and s[i].isdigit():
+                    i += 1
+                if i == j:
+                    raise _error(s, i, "expecting an integer after '#'")
+                (modifier, nth) = ('#', int(s[j:i]))
+                if not 1 <= nth <= 5:
+                    raise _error(s, j, "expecting an integer between 1 and 5 after '#'")
+            if i < n and s[i] != ',':
+                raise _error(s, i, "unexpected character '%s'" % s[i])
+            if hashed:
+                modifier = 'h'
+            elif start is not None:
+                for suffix in ('l', 'w'):
+                    if suffix not in modifiers:
+                        continue
+                    if end is not None and (start.endswith(suffix) or end.endswith(suffix)):
+                        raise _error(s, pos, "cannot use %s pattern inside ranges" % suffix.upper())
+                    if end is None and len(start) > 1 and start.endswith(suffix):
+                        (start, modifier) = (start[:-1], suffix)
+            items.append(FieldItem(start, end, step, modifier, nth, pos))
+            if i >= n:
+                return items
+            i += 1
+
     def split_tokens(self, s):
         """
         identify ranges in pattern
         given "1,2-5/3,jul,10-goofy/6" return two lists, the singletons ['1', 'jul']
-        and the ranges [['10', 'goofy', 1], ['2', '5', 3]]
+        and the ranges [['2', '5', 3], ['10', 'goofy', 6]]
         * and @ not supported
         :return: two lists, single items and ranges
         """
-        # here '1,2-5/3,jul,10-goofy'
-        ranges = s.split(",")
-        # here ranges == ['1', '2-5/3', 'jul', '10-goofy']
-        ranges = [x.split("/") for x in ranges]
-        # here ranges == [['1'], ['2-5', '3'], ['jul'], ['10-goofy']]
-        ranges = [[x[0].split("-")] + x[1:] for x in ranges]
-        # here ranges == [[['1']], [['2', '5'], '3'], [['jul']], [['10', 'goofy']]]
-        if max([len(x) for x in ranges]) > 2:
-            raise ValueError("Wrong format '%s' - a string x/y/z is meaningless" % s)
-        if max([len(x) for z in ranges for x in z]) > 2:
-            raise ValueError("Wrong format '%s' - a string x-y-z is meaningless" % s)
-        if [x for x in ranges if len(x) == 2 and len(x[0]) == 1]:
-            raise ValueError("Wrong format '%s' - a string y/z is meaningless, should be x-y/z" % s)
-        singletons = [w for x in ranges for z in x for w in z if len(z) == 1 and len(x) == 1]
-        # here singletons == ['1', 'jul']
-        ranges_no_step = [x[0] + [1] for x in ranges if len(x) == 1 and len(x[0]) == 2]
-        # here ranges_no_step == [['10', 'goofy', 1]]
+        items = self.tokenize(s)
+        if [item for item in items if item.is_any]:
+            raise ValueError("Wrong format '%s' - '*' not supported here" % s)
+        singletons = [item.start for item in items if not item.is_range]
+        ranges = [[item.start, item.end, item.step] for item in items if item.is_range]
+        return (singletons, ranges)
+
+    def _decode_int(self, s, item, token, offsets):
         try:
-            ranges_with_step = [x[0] + [int(x[1])] for x in ranges if len(x) == 2 and len(x[0]) == 2]
+            return int(self.decode_token(token, offsets))
         except ValueError:
-            raise ValueError("Wrong format '%s' - expecting an integer after '/'" % s)
-        # here ranges_with_step == [['2', '5', 3]]
-        return (singletons, ranges_no_step + ranges_with_step)
+            raise _error(s, item.pos, "'%s' is not a valid value" % token)
 
-    def _parse_common(self, s, minval, maxval, offsets={}, callback=None):
+    def _item_values(self, s, item, minval, maxval, offsets):
+        """
+        :return: the list of integers corresponding to given FieldItem
+        """
+        if item.modifier == 'h':
+            return self._hash_values(s, item, minval, maxval, offsets)
+        if item.is_any:
+            return range(minval, maxval + 1, item.step)
+        start = self._decode_int(s, item, item.start, offsets)
+        if not item.is_range:
+            return [start]
+        end = self._decode_int(s, item, item.end, offsets)
+        if start <= end:
+            return range(start, end + 1, item.step)
+        # reverse order, es. 23-4 for hours
+        return list(range(start, maxval + 1, item.step)) + list(range(minval, end + 1, item.step))
+
+    def _hash_values(self, s, item, minval, maxval, offsets):
+        """
+        :return: the list of integers corresponding to an H item, chosen according to self.seed
+        """
+        if item.is_range:
+            (minval, maxval) = (self._decode_int(s, item, item.start, offsets),
+                                self._decode_int(s, item, item.end, offsets))
+            if minval > maxval:
+                raise _error(s, item.pos, "H(x-y) requires x <= y")
+        # the field is identified by its max value, so that H gives different values in different fields
+        h = stable_hash("%s:%d" % (self.seed or '', maxval))
+        if item.step > 1:
+            return range(minval + h % min(item.step, maxval - minval + 1), maxval + 1, item.step)
+        return [minval + h % (maxval - minval + 1)]
+
+    def _parse_common(self, s, minval, maxval, offsets={}):
         """
         Generate a set of integers, corresponding to "allowed values".
         Work for minute, hours, weeks, month, ad days of week, because they
         are all "similar".
-        Does not work for '*'
         :param minval, maxval:
             es. 0-59 for minutes, 1-12 for month, ...
         :param offsets:
             a dict mapping names (es. "mar") to their offsets (es. 2).
-        :param minval:
-            es. 0 for hours and minutes, 1 for days and months
-        :param callback:
-            a 2-ary function that pre-elaborates singletons and ranges
-        """
-        if s.startswith("*/"):        # every tot minutes
-            try:
-                step = int(s[2:])
-            except ValueError:
-                raise ValueError("Wrong format '%s' - expecting an integer after '*/'" % s)
-            return set(range(minval, maxval + 1, step))
-        else:                           # at given minutes
-            # here s == '1,2-5/3,jul,10-nov'
-            (singletons, ranges) = self.split_tokens(s)
-            # here singletons == ['1', 'jul'], ranges == [['2', '5', 3], ['10', 'nov', 1]]
-            singletons = [self.decode_token(x, offsets) for x in singletons]
-            ranges = [[self.decode_token(rng[0], offsets), self.decode_token(rng[1], offsets), rng[2]]
-                      for rng in ranges]
-            if callback is not None:
-                (singletons, ranges) = callback(singletons, ranges)
-            singletons = list(map(int, singletons))           # may raise ValueError
-            ranges = [list(map(int, rng)) for rng in ranges]   # may raise ValueError
-            # here singletons == [1, 7], ranges == [[2, 5, 3], [10, 11, 1]]
-            ranges = [range(rng[0], rng[1] + 1, rng[2]) for rng in ranges if (rng[0] <= rng[1])] + \
-                     [range(rng[0], maxval + 1, rng[2]) for rng in ranges if rng[0] > rng[1]] + \
-                     [range(minval, rng[1] + 1, rng[2]) for rng in ranges if rng[0] > rng[1]]
-            # here ranges == [range(2, 5, 3), range(10, 11, 1]]
-            flatlist = singletons + [z for rng in ranges for z in rng]
-            # here flatlist == [1, 7, 2, 3, 4, 5, 10, 11]
-            return set(flatlist)
+        """
+        values = set()
+        for item in self.tokenize(s):
+            values.update(self._item_values(s, item, minval, maxval, offsets))
+        return values
 
     def parse_minute(self, s):
         """
@@ -100,6 +239,16 @@ class Parser:
             return [True, None]
         return [False, self._parse_common(s, 0, 59)]
 
+    def parse_second(self, s):
+        """
+        :return: [run_on_every_second: boolean,
+                  allowed_seconds: list or None]
+        """
+        if s == '*':
+            return [True, None]
+        # a different seed, so that H seconds differ from H minutes
+        return [False, Parser("%s second" % (self.seed or ''))._parse_common(s, 0, 59)]
+
     def parse_hour(self, s):
         """
         :return: [run_on_every_hour: boolean,
@@ -119,16 +268,14 @@ class Parser:
         if s == '*':
             return [True, None, False, None]
 
-        def ignore_w(singletons, ranges):
-            if [x for x in ranges for z in x if 'w' in x]:
-                raise ValueError("Cannot use W pattern inside ranges")
-            return ([x for x in singletons if x[-1] != 'w'], ranges)
-
-        def only_w(singletons, ranges):
-            return ([x[:-1] for x in singletons if x[-1] == 'w'], [])
-
-        dom = self._parse_common(s, 1, 31, {'l': '-1'}, ignore_w)
-        wdom = self._parse_common(s, 1, 31, {}, only_w)
+        dom = set()
+        wdom = set()
+        for item in self.tokenize(s, 'w'):
+            if item.modifier == 'w':
+                wdom.add(self._decode_int(s, item, item.start, {}))
+            else:
+                # like in Jenkins, H stays in days that exist in every month
+                dom.update(self._item_values(s, item, 1, 28 if item.modifier == 'h' else 31, {'l': '-1'}))
 
         return [False, dom, -1 in dom, wdom]
 
@@ -139,7 +286,7 @@ class Parser:
         """
         if s == '*':
             return [True, None]
-        return [False, self._parse_common(s, 1, 13, MONTH_OFFSET)]
+        return [False, self._parse_common(s, 1, 12, MONTH_OFFSET)]
 
     def parse_day_in_week(self, s):
         """
@@ -151,32 +298,22 @@ class Parser:
         if s == '*':
             return [True, None, None, None]
 
-        def only_plain(singletons, ranges):
-            if [x for x in ranges for z in x if ('l' in x or '#' in x)]:
-                raise ValueError("Cannot use L or # pattern inside ranges")
-            return ([x for x in singletons if not ('l' in x or '#' in x)], ranges)
-
-        def only_l(singletons, ranges):
-            return ([x[:-1] for x in singletons if x[-1] == 'l'], [])
-
-        def only_sharp(n):
-            suffix = '#' + str(n)
-            lens = len(suffix)
-            return lambda singletons, ranges: ([x[:-lens] for x in singletons if x.endswith(suffix)], [])
-
         # warning: in Python, Monday is 0 and Sunday is 6
         #          in cron, Sunday=0 and Saturday is 6
         def cron2py(x):
             return (x + 6) % 7
 
-        dow = self._parse_common(s, 0, 6, WEEK_OFFSET, only_plain)
-        dow = set(map(cron2py, dow))
-        dow_l = self._parse_common(s, 0, 6, WEEK_OFFSET, only_l)
-        dow_l = set(map(cron2py, dow_l))
-        dow_s = {}
-        for n in range(1, 6):
-            t = self._parse_common(s, 0, 6, WEEK_OFFSET, only_sharp(n))
-            dow_s[n] = set(map(cron2py, t))
+        dow = set()
+        dow_l = set()
+        dow_s = dict((n, set()) for n in range(1, 6))
+        for item in self.tokenize(s, 'l#'):
+            values = set(map(cron2py, self._item_values(s, item, 0, 6, WEEK_OFFSET)))
+            if item.modifier == 'l':
+                dow_l.update(values)
+            elif item.modifier == '#':
+                dow_s[item.nth].update(values)
+            else:
+                dow.update(values)
         return [False, dow, dow_l, dow_s]
 
     def parse_year(self, s):
@@ -186,4 +323,8 @@ class Parser:
         """
         if s == '*':
             return [True, None]
+        for item in self.tokenize(s):
+            if item.modifier == 'h':
+                # a hashed year could be already past
+                raise _error(s, item.pos, "H is not supported in the year field")
         return [False, self._parse_common(s, 1970, 2099)]
@@ -0,0 +1,279 @@
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+from .sched import CATCHUP_SKIP, Scheduler
+from .loader import iter_crontab_lines
+from .watch import _file_signature
+from . import launcher as _launcher
+
+logger = logging.getLogger('pcrond')
+
+# shards are rebalanced only when the heaviest one has more than this times the average number of jobs
+REBALANCE_RATIO = 1.25
+
+
+def list_crontabs(directory):
+    """
+    :return: the sorted absolute paths of the crontab files in given directory.
+        Hidden files and editor backups (ending with ~) are ignored, as cron does.
+    """
+    directory = os.path.abspath(directory)
+    paths = []
+    for name in os.listdir(directory):
+        if name.startswith('.') or name.endswith('~'):
+            continue
+        path = os.path.join(directory, name)
+        if os.path.isfile(path):
+            paths.append(path)
+    return sorted(paths)
+
+
+def count_jobs(path):
+    """
+    :return: the number of job lines in given crontab file, 0 if it cannot be read
+    """
+    try:
+        return sum(1 for _ in iter_crontab_lines(path))
+    except (IOError, OSError, UnicodeDecodeError):
+        return 0
+
+
+def plan_shards(weights, shards, current=None):
+    """
+    Assign crontab files to shards, balancing their number of jobs.
+    Files keep their current shard where possible, so that their jobs are not reloaded:
+    new files go to the lightest shard, and files are moved from the heaviest to the lightest shard
+    only while the heaviest one is above REBALANCE_RATIO times the average, and a move reduces the gap.
+    :param weights: dict {file: number of jobs}
+    :param shards: number of shards
+    :param current: a previous result of this function, or None
+    :return: dict {file: shard index}
+    """
+    plan = dict((f, s) for (f, s) in (current or {}).items() if f in weights and s < shards)
+    loads = [0] * shards
+    for f, s in plan.items():
+        loads[s] += weights[f]
+    for f in sorted(weights, key=lambda f: (-weights[f], f)):
+        if f not in plan:
+            s = loads.index(min(loads))
+            plan[f] = s
+            loads[s] += weights[f]
+    average = float(sum(loads)) / shards
+    while loads and max(loads) > REBALANCE_RATIO * average:
+        heavy = loads.index(max(loads))
+        light = loads.index(min(loads))
+        gap = loads[heavy] - loads[light]
+        candidates = [f for f, s in plan.items() if s == heavy and 0 < weights[f] < gap]
+        if not candidates:
+            break
+        # the move leaving the two shards closest
+        f = min(candidates, key=lambda f: (abs(gap - 2 * weights[f]), f))
+        plan[f] = light
+        loads[heavy] -= weights[f]
+        loads[light] += weights[f]
+    return plan
+
+
+def _worker(conn, cpu, capture, splay, catchup):
+    """
+    Body of a shard process: run a Scheduler, while another thread executes the commands
+    received from the Daemon.
+    """
+    # Ctrl-C reaches the whole process group, but only the Daemon should handle it
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if cpu is not None and hasattr(os, 'sched_setaffinity'):
+        try:
+            os.sched_setaffinity(0, [cpu])
+        except OSError as e:
+            logger.warning("Cannot pin shard to CPU %d: %s", cpu, e)
+    # the launcher of the parent process, if any, has no reaper thread here
+    _launcher.set_default(_launcher.Launcher(capture=capture))
+    scheduler = Scheduler()
+    scheduler.splay = splay
+    scheduler.catchup = catchup
+    thread = threading.Thread(target=_serve, args=(conn, scheduler), name="pcrond-shard")
+    thread.daemon = True
+    thread.start()
+    scheduler.main_loop()
+
+
+def _serve(conn, scheduler):
+    while True:
+        try:
+            (command, arg) = conn.recv()
+        except (EOFError, OSError):
+            # the Daemon is gone
+            command = 'stop'
+        if command == 'stop':
+            scheduler.stop()
+            return
+        try:
+            if command == 'load':
+                scheduler.load_crontab_file(arg, incremental=True)
+            elif command == 'unload':
+                scheduler.unload_crontab_file(arg)
+            elif command == 'count':
+                conn.send(len(scheduler.jobs))
+        except (IOError, OSError, UnicodeDecodeError) as e:
+            logger.error("Cannot %s %s: %s", command, arg, e)
+
+
+class _Shard(object):
+    """
+    A worker process, with its own Scheduler, and the crontab files loaded there.
+    """
+    def __init__(self, index, cpu):
+        self.index = index
+        self.cpu = cpu
+        self.files = set()
+        self.process = None
+        self.conn = None
+        self._lock = threading.Lock()
+
+    def start(self, capture, splay, catchup):
+        (self.conn, child_conn) = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_worker, args=(child_conn, self.cpu, capture, splay, catchup),
+                                               name="pcrond-shard-%d" % self.index)
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+
+    def send(self, command, arg=None):
+        with self._lock:
+            try:
+                self.conn.send((command, arg))
+            except (IOError, OSError) as e:
+                logger.error("Cannot reach shard %d: %s", self.index, e)
+
+    def count(self):
+        """
+        :return: number of jobs in the Scheduler of this shard, or None if it does not answer
+        """
+        with self._lock:
+            try:
+                self.conn.send(('count', None))
+                return self.conn.recv()
+            except (IOError, OSError, EOFError):
+                return None
+
+    def stop(self, timeout=None):
+        self.send('stop')
+        self.process.join(timeout)
+        self.conn.close()
+
+
+class Daemon(object):
+    """
+    Run all crontab files of a directory (one per user, or tenant, like /etc/cron.d),
+    in several Scheduler instances, each in its own process, pinned to a CPU where supported.
+
+    Each file is entirely loaded in one shard. The directory is checked every `interval` seconds:
+    changed files are reloaded incrementally, new and deleted files are loaded and unloaded,
+    and files are moved among shards if these become unbalanced (see plan_shards()).
+    Shard processes that die are restarted.
+    Commands run as the user running the Daemon.
+    """
+    def __init__(self, directory, shards=None, interval=5, capture=None, splay=0, catchup=CATCHUP_SKIP):
+        """
+        Constructor
+        :param directory: the crontab directory
+        :param shards: number of shard processes, None for one per usable CPU
+        :param interval: seconds between checks of the directory
+        :param capture: output capture of commands, see pcrond.launcher.Launcher
+        :param splay: see Scheduler.splay
+        :param catchup: see Scheduler.catchup
+        """
+        self.directory = os.path.abspath(directory)
+        self.interval = interval
+        self.capture = capture
+        self.splay = splay
+        self.catchup = catchup
+        if hasattr(os, 'sched_getaffinity'):
+            cpus = sorted(os.sched_getaffinity(0))
+        else:
+            cpus = [None] * (multiprocessing.cpu_count() or 1)
+        if shards is None:
+            shards = len(cpus)
+        if shards < 1:
+            raise ValueError("at least one shard is required")
+        self.shards = [_Shard(i, cpus[i % len(cpus)]) for i in range(shards)]
+        self.assignment = {}        # file: shard index
+        self._signatures = {}       # file: signature when last loaded
+        self._counts = {}           # file: number of jobs when last loaded
+        self._stop = threading.Event()
+
+    def start(self):
+        """
+        Start shard processes, and load the crontab files.
+        """
+        for shard in self.shards:
+            shard.start(self.capture, self.splay, self.catchup)
+        self.scan()
+
+    def scan(self):
+        """
+        Look for changes in the crontab directory, and in shard processes, and apply them.
+        """
+        for shard in self.shards:
+            if not shard.process.is_alive():
+                logger.error("Shard %d exited with code %s, restarting it", shard.index, shard.process.exitcode)
+                shard.conn.close()
+                shard.start(self.capture, self.splay, self.catchup)
+                for path in shard.files:
+                    shard.send('load', path)
+        try:
+            paths = list_crontabs(self.directory)
+        except OSError as e:
+            logger.error("Cannot read %s: %s", self.directory, e)
+            return
+        signatures = dict((path, _file_signature(path)) for path in paths)
+        # only changed files are read again
+        weights = dict((path, self._counts[path] if self._signatures.get(path) == signatures[path]
+                        else count_jobs(path)) for path in paths)
+        plan = plan_shards(weights, len(self.shards), self.assignment)
+        for path, index in self.assignment.items():
+            if plan.get(path) != index:
+                self.shards[index].send('unload', path)
+                self.shards[index].files.discard(path)
+        for path, index in plan.items():
+            shard = self.shards[index]
+            if self.assignment.get(path) != index or self._signatures.get(path) != signatures[path]:
+                shard.send('load', path)
+                shard.files.add(path)
+        self.assignment = plan
+        self._signatures = signatures
+        self._counts = weights
+
+    def job_counts(self):
+        """
+        :return: the list of the number of jobs in each shard
+        """
+        return [shard.count() for shard in self.shards]
+
+    def run(self):
+        """
+        Start, then check the directory until stop() is called, then shut down.
+        """
+        self.start()
+        logger.info("%d crontab files loaded in %d shards", len(self.assignment), len(self.shards))
+        try:
+            while not self._stop.wait(self.interval):
+                self.scan()
+        finally:
+            self.shutdown()
+
+    def stop(self):
+        """
+        Ask run() to terminate.
+        """
+        self._stop.set()
+
+    def shutdown(self, timeout=None):
+        """
+        Stop shard processes. Running commands are not stopped.
+        """
+        for shard in self.shards:
+            if shard.process is not None:
+                shard.stop(timeout)
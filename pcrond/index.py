@@ -0,0 +1,151 @@
+import itertools
+import time
+from .zones import ONE_MINUTE, is_hourly, wall_time
+
+# (name, number of buckets) of indexed fields, in the order used by TimeIndex
+FIELDS = (('minute', 60), ('hour', 24), ('month', 13), ('dom', 32), ('dow', 7))
+
+
+def _bits(mask, size):
+    return [i for i in range(size) if (mask >> i) & 1]
+
+
+def _field_values(compiled):
+    """
+    :return: a list of the allowed values of each indexed field of given CompiledSchedule;
+             None stands for "every value", i.e. the wildcard bucket
+    """
+    def values(mask, minval, maxval):
+        if mask >> minval == (1 << (maxval - minval + 1)) - 1:
+            return None
+        return _bits(mask, maxval + 1)
+
+    # jobs using L, W or # cannot be indexed by a fixed day, they go in the wildcard bucket
+    # and TimeIndex.jobs_at() will check them one by one
+    if compiled.dom is None or compiled.last_dom or compiled.wdom:
+        doms = None
+    else:
+        doms = [x for x in compiled.dom if 1 <= x <= 31]
+    if compiled.dow is None or compiled.dowl or compiled.dow_sharp:
+        dows = None
+    else:
+        dows = list(compiled.dow)
+    return [values(compiled.minute_mask, 0, 59),
+            values(compiled.hour_mask, 0, 23),
+            values(compiled.month_mask, 1, 12),
+            doms,
+            dows]
+
+
+class TimeIndex(object):
+    """
+    Inverted index from (minute, hour, month, day of month, day of week) values to jobs.
+    Jobs with '*' in a field are kept in the wildcard bucket of that field.
+    Used by :class:`Scheduler` to find the jobs due at a given minute without scanning all of them.
+    """
+    def __init__(self):
+        self._buckets = [[set() for _ in range(size)] for (_, size) in FIELDS]
+        self._wildcards = [set() for _ in FIELDS]
+        self._order = {}
+        self._counter = itertools.count()
+        self.evaluated = 0          # number of jobs checked by the last jobs_at()
+
+    def __len__(self):
+        return len(self._order)
+
+    def __contains__(self, job):
+        return job in self._order
+
+    def add(self, job):
+        """
+        Index given job, according to its compiled schedule.
+        """
+        if job in self._order:
+            return
+        self._order[job] = next(self._counter)
+        for (buckets, wildcard, values) in zip(self._buckets, self._wildcards, _field_values(job.compiled)):
+            if values is None:
+                wildcard.add(job)
+            else:
+                for v in values:
+                    buckets[v].add(job)
+
+    def remove(self, job):
+        """
+        Remove given job from the index, if present.
+        """
+        if self._order.pop(job, None) is None:
+            return
+        for (buckets, wildcard, values) in zip(self._buckets, self._wildcards, _field_values(job.compiled)):
+            if values is None:
+                wildcard.discard(job)
+            else:
+                for v in values:
+                    buckets[v].discard(job)
+
+    def clear(self):
+        for buckets in self._buckets:
+            for bucket in buckets:
+                bucket.clear()
+        for wildcard in self._wildcards:
+            wildcard.clear()
+        self._order.clear()
+
+    def jobs_at(self, now, profiler=None):
+        """
+        :param profiler: if given, the cost of checking each candidate job is recorded there
+        :return: the list of indexed jobs whose pattern matches given datetime,
+                 in the order they were added. The ``running`` flag is not taken into account.
+        """
+        # days of week are in Python convention, i.e. Monday is 0
+        keys = (now.minute, now.hour, now.month, now.day, now.weekday())
+        # the smallest candidate set is enough, since each job must match every field
+        (best, best_size) = (None, 0)
+        for (buckets, wildcard, key) in zip(self._buckets, self._wildcards, keys):
+            candidates = (buckets[key], wildcard)
+            size = len(candidates[0]) + len(candidates[1])
+            if best is None or size < best_size:
+                (best, best_size) = (candidates, size)
+        self.evaluated = best_size
+        if profiler is None:
+            jobs = [job for bucket in best for job in bucket if job.compiled.matches(now)]
+        else:
+            jobs = []
+            for bucket in best:
+                for job in bucket:
+                    start = time.time()
+                    if job.compiled.matches(now):
+                        jobs.append(job)
+                    profiler.record_check(job, time.time() - start)
+        jobs.sort(key=self._order.__getitem__)
+        return jobs
+
+    def due_at(self, ts, tz=None, wall=None, profiler=None):
+        """
+        Find the jobs due at the minute of given timestamp, in given zone, according to the DST rules
+        explained in pcrond.zones. The timestamp is converted to wall time only once for all jobs.
+        :param wall: the wall time at ts, if already known
+        :param profiler: see jobs_at()
+        :return: the list of jobs, in the order they were added
+        """
+        if wall is None:
+            wall = wall_time(ts, tz)
+        jobs = self.jobs_at(wall, profiler)
+        if getattr(wall, 'fold', 0):
+            # second pass through a repeated hour
+            return [job for job in jobs if is_hourly(job.compiled)]
+        minute = wall_time(ts - 60, tz).replace(second=0, microsecond=0) + ONE_MINUTE
+        if minute < wall:
+            # the clock jumped forward: jobs due in the skipped minutes run now, once
+            evaluated = self.evaluated
+            found = set(jobs)
+            while minute < wall:
+                for job in self.jobs_at(minute, profiler):
+                    if job not in found and not is_hourly(job.compiled):
+                        found.add(job)
+                        jobs.append(job)
+                evaluated += self.evaluated
+                minute += ONE_MINUTE
+            jobs.sort(key=self._order.__getitem__)
+            self.evaluated = evaluated
+        return jobs
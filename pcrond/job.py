@@ -1,8 +1,18 @@
 
+from collections import namedtuple
 from datetime import datetime
+from .compiled import compile_crontab, last_dom
+from .cronparser import stable_hash
+from .zones import get_zone, wall_time
+from . import metrics as _metrics
 import logging
+import threading
+import time
 logger = logging.getLogger('pcrond')
 
+# guards the running state of all jobs, which may be changed by worker threads
+_state_lock = threading.Lock()
+
 reboot_time = datetime.now()
 
 ALIASES = {'@yearly':    '0 0 1 1 *',
@@ -20,17 +30,144 @@ ALIASES = {'@yearly':    '0 0 1 1 *',
            }
 
 
+# overlap policies, for runs of a job due while the job is still running
+OVERLAP_SKIP = 'skip'                   # the new run is skipped
+OVERLAP_QUEUE = 'queue'                 # the new run starts when the running one terminates
+OVERLAP_CONCURRENT = 'concurrent'       # runs overlap, up to max_instances
+OVERLAP_KILL = 'kill'                   # the running instances are killed, if they can be
+OVERLAP_MODES = (OVERLAP_SKIP, OVERLAP_QUEUE, OVERLAP_CONCURRENT, OVERLAP_KILL)
+
+
+class OverlapPolicy(namedtuple('OverlapPolicy', ['mode', 'max_instances', 'max_queued', 'group', 'until_done'])):
+    """
+    How a job behaves when it should run while it is still running, see :meth:`Job.set_overlap`.
+    until_done is true if the job is running until the result of its job function is done, es. until
+    its command terminates; else only while the job function runs.
+    Policies are immutable, and shared among jobs.
+    """
+    __slots__ = ()
+
+
+# as in cron, commands are started even if their previous run did not terminate yet
+DEFAULT_OVERLAP = OverlapPolicy(OVERLAP_SKIP, 1, 0, None, False)
+_policies = {DEFAULT_OVERLAP: DEFAULT_OVERLAP}
+
+
+def when_done(result, fn):
+    """
+    Call fn(result) when given result of a job function is done: if it has add_done_callback(),
+    as futures and the ProcessRecord's of std_launch_func() have, then later, else now.
+    """
+    add_done_callback = getattr(result, 'add_done_callback', None)
+    if add_done_callback is None:
+        fn(result)
+    else:
+        add_done_callback(lambda _: fn(result))
+
+
+def _kill(handle):
+    """
+    Stop a running job instance, given the result of its job function or its task.
+    :return: False if it cannot be stopped
+    """
+    for method in ('kill', 'cancel'):
+        if hasattr(handle, method):
+            getattr(handle, method)()
+            return True
+    return False
+
+
+def _default_key(job_func, job_id=None):
+    """
+    :return: a key for a job without an explicit one, given its function and its id in the Scheduler, if any;
+             unique in the Scheduler, and stable across restarts as long as jobs are added in the same order
+    """
+    name = getattr(job_func, '__qualname__', None) or getattr(job_func, '__name__', None)
+    if name is None:
+        key = repr(job_func)
+    else:
+        key = "%s.%s" % (getattr(job_func, '__module__', None), name)
+    # lambdas, or methods of different instances, have the same name
+    return key if job_id is None else "%s#%d" % (key, job_id)
+
+
+def normalize_crontab(crontab):
+    """
+    :return: given crontab pattern as a list of 6 lowercase tokens, aliases expanded;
+             7 tokens for patterns with seconds, that come first as in Quartz, and where ? stands for *
+    :raise ValueError: if the number of tokens is wrong
+    """
+    if crontab is None:
+        raise ValueError("given None crontab")
+
+    crontab = crontab.lower().strip()
+
+    if crontab in ALIASES.keys():
+        crontab = ALIASES[crontab]
+
+    crontab_lst = crontab.split()
+
+    if len(crontab_lst) == 5:
+        crontab_lst.append("*")
+    elif len(crontab_lst) == 7:
+        crontab_lst = [token.replace('?', '*') for token in crontab_lst]
+    if len(crontab_lst) not in (6, 7):
+        raise ValueError(
+            "Each crontab pattern *must* contain either 1, 5, 6 or 7 items")
+    return crontab_lst
+
+
+def _field(index, item):
+    """
+    :return: a read-only property returning an item of the parsed fields of the job pattern
+    """
+    return property(lambda self: self.compiled.fields[index][item])
+
+
+# @reboot jobs run at the minute this module was imported
+REBOOT_PATTERN = tuple(normalize_crontab('@reboot'))
+
+
 class Job(object):
     """
     A periodic job as used by :class:`Scheduler`.
+    Parsed pattern data is shared among jobs with the same pattern, see compile_crontab();
+    jobs have no __dict__, in order to keep memory usage low.
     """
-    def __init__(self, crontab=None, job_func=None, scheduler=None):
+    __slots__ = ('job_func', 'scheduler', 'compiled', 'id', 'overlap', 'splay', 'tz', '_key', '_running',
+                 '_handles')
+
+    # Parser results, for backward compatibility; see CompiledSchedule.fields
+    allowed_every_min = _field(0, 0)
+    allowed_min = _field(0, 1)
+    allowed_every_hour = _field(1, 0)
+    allowed_hours = _field(1, 1)
+    # Day of month.
+    # L = last day
+    # 15W= nearest working day around the 15th, in the same month
+    allowed_every_dom = _field(2, 0)
+    allowed_dom = _field(2, 1)
+    allowed_last_dom = _field(2, 2)
+    allowed_wdom = _field(2, 3)
+    allowed_every_month = _field(3, 0)
+    allowed_months = _field(3, 1)
+    # Day of week.
+    # 5L = last friday of the month
+    # 5#2 = second friday of the month
+    allowed_every_dow = _field(4, 0)
+    allowed_dow = _field(4, 1)
+    allowed_dowl = _field(4, 2)
+    allowed_dow_sharp = _field(4, 3)
+    allowed_every_year = _field(5, 0)
+    allowed_years = _field(5, 1)
+
+    def __init__(self, crontab=None, job_func=None, scheduler=None, key=None, tz=None):
         """
         Constructor
         :param crontab:
             string containing crontab pattern
             Its tokens may be either: 1 (if alias), 5 (without year token),
-            6 (with year token)
+            6 (with year token), 7 (with seconds token first, and year token)
             if None, you should set it later
         :param job_func:
             the job 0-ary function to run
@@ -38,58 +175,160 @@ class Job(object):
         :param scheduler:
             scheduler to register with
             if None, you should set it later
+        :param key:
+            a string identifying the job, used for choosing the values of H tokens and the splay offset,
+            that stay the same as long as the key does, and by the journal and the leases of a cluster.
+            if None, it is derived from job_func and from the id the job gets in its Scheduler,
+            so it stays the same across restarts only as long as jobs are added in the same order
+        :param tz:
+            the time zone of the pattern, as a name such as 'Europe/Rome' or a tzinfo; None for local time.
+            See pcrond.zones for the behaviour around DST transitions.
         """
         self.job_func = job_func
         self.scheduler = scheduler
-        self.running = False
+        self.compiled = None
+        self.id = None              # set by the JobStore of the scheduler
+        self.overlap = DEFAULT_OVERLAP
+        self.splay = None           # in seconds, None for the default of the scheduler
+        self.tz = get_zone(tz)
+        self._key = key
+        self._running = 0           # number of running instances
+        self._handles = None        # results of running instances, that can be killed
         if crontab is not None:
             self.set_crontab(crontab)
 
     def set_crontab(self, crontab):
-        if crontab is None:
-            raise ValueError("given None crontab")
+        crontab_lst = normalize_crontab(crontab)
+        # the pattern is parsed only once, then cached
+        self._set_schedule(compile_crontab(crontab_lst, self.key))
+
+    def _set_schedule(self, schedule):
+        """
+        Set the pattern of this job from a CompiledSchedule, as returned by compile_crontab()
+        """
+        self.compiled = schedule
+        if schedule.pattern == REBOOT_PATTERN:
+            # the pattern of @reboot is the local boot time
+            self.tz = None
+
+    @property
+    def is_reboot(self):
+        """ true if the job was defined with @reboot """
+        return self.compiled is not None and self.compiled.pattern == REBOOT_PATTERN
+
+    @property
+    def key(self):
+        """ the string identifying this job, see the constructor """
+        return self._key if self._key is not None else _default_key(self.job_func, self.id)
+
+    def splay_offset(self, window):
+        """
+        :param window: the splay window in seconds, if the job has no own splay
+        :return: the number of seconds the job should wait after its scheduled minute, in [0, window);
+                 it stays the same as long as the key does
+        """
+        if self.splay is not None:
+            window = self.splay
+        if not window:
+            return 0
+        return window * (stable_hash(self.key + ':splay') / 4294967296.0)
 
-        crontab = crontab.lower().strip()
+    def set_overlap(self, mode=OVERLAP_SKIP, max_instances=1, max_queued=1, group=None):
+        """
+        Set what happens when the job should run while it is still running.
+        Once a policy is set, jobs returning an object with add_done_callback(), as std_launch_func()
+        commands do, are running until that object is done, i.e. until the command terminates.
+        By default, as in cron, they are running only while the job function runs.
+        :param mode:
+            OVERLAP_SKIP (default), OVERLAP_QUEUE, OVERLAP_CONCURRENT or OVERLAP_KILL.
+            Only instances returning an object with kill() or cancel() can be killed.
+        :param max_instances:
+            max number of instances running at once, for OVERLAP_CONCURRENT
+        :param max_queued:
+            max number of runs waiting, for OVERLAP_QUEUE; further runs are skipped
+        :param group:
+            name of a group of jobs sharing a concurrency limit, see Scheduler.group_limits
+        :return: this Job
+        """
+        if mode not in OVERLAP_MODES:
+            raise ValueError("Unknown overlap policy '%s', expected one of %s" % (mode, ", ".join(OVERLAP_MODES)))
+        if max_instances < 1 or max_queued < 0:
+            raise ValueError("max_instances must be positive, max_queued must not be negative")
+        policy = OverlapPolicy(mode, max_instances if mode == OVERLAP_CONCURRENT else 1,
+                               max_queued if mode == OVERLAP_QUEUE else 0, group, True)
+        self.overlap = _policies.setdefault(policy, policy)
+        return self
 
-        if crontab in ALIASES.keys():
-            crontab = ALIASES[crontab]
+    @property
+    def crontab_pattern(self):
+        """ the normalized pattern, as a list of 6 tokens """
+        return list(self.compiled.pattern)
 
-        crontab_lst = crontab.split()
+    @property
+    def running(self):
+        """ true if some instance of the job is running """
+        return self._running > 0
 
-        if len(crontab_lst) == 5:
-            crontab_lst.append("*")
-        if len(crontab_lst) != 6:
-            raise ValueError(
-                "Each crontab pattern *must* contain either 1, 5 or 6 items")
+    def _blocked(self):
+        """
+        :return: ``True`` if a new instance cannot start now, according to the overlap policy
+        """
+        mode = self.overlap.mode
+        if mode == OVERLAP_KILL:
+            return False
+        return self._running >= self.overlap.max_instances
+
+    def _acquire(self):
+        """
+        Mark the job as running, unless the overlap policy forbids a new instance now.
+        :return: ``True`` if the job can start
+        """
+        with _state_lock:
+            if self._blocked():
+                return False
+            self._running += 1
+            return True
 
-        from .cronparser import Parser
-        parser = Parser()
+    def _begin(self):
+        """ Mark the job as running, even if it is already running. """
+        with _state_lock:
+            self._running += 1
 
-        # Easy ones:
-        [self.allowed_every_min, self.allowed_min] = parser.parse_minute(crontab_lst[0])
-        [self.allowed_every_hour, self.allowed_hours] = parser.parse_hour(crontab_lst[1])
-        [self.allowed_every_month, self.allowed_months] = parser.parse_month(crontab_lst[3])
-        [self.allowed_every_year, self.allowed_years] = parser.parse_year(crontab_lst[5])
+    def _end(self):
+        """ Mark an instance of the job as terminated. """
+        with _state_lock:
+            self._running -= 1
 
-        # Day of month.
-        # L = last day
-        # 15W= nearest working day around the 15th, in the same month
-        [self.allowed_every_dom, self.allowed_dom, self.allowed_last_dom, self.allowed_wdom] = \
-            parser.parse_day_in_month(crontab_lst[2])
+    def _track(self, handle):
+        """ Remember a running instance, for OVERLAP_KILL """
+        with _state_lock:
+            if self._handles is None:
+                self._handles = []
+            self._handles.append(handle)
 
-        # Day of week.
-        # 5L = last friday of the month
-        # 5#2 = second friday of the month
-        [self.allowed_every_dow, self.allowed_dow, self.allowed_dowl, self.allowed_dow_sharp] = \
-            parser.parse_day_in_week(crontab_lst[4])
+    def _untrack(self, handle):
+        with _state_lock:
+            if self._handles is not None and handle in self._handles:
+                self._handles.remove(handle)
+                if not self._handles:
+                    self._handles = None
 
-        self.crontab_pattern = crontab_lst
+    def _kill_running(self):
+        """
+        Kill the running instances of this job, if possible.
+        """
+        with _state_lock:
+            handles = list(self._handles or ())
+        if len(handles) < self._running:
+            logger.warning("Cannot kill some running instances of job %s", self)
+        for handle in handles:
+            logger.info("Killing previous instance of job %s", self)
+            if not _kill(handle):
+                logger.warning("Cannot kill %r", handle)
 
     def get_last_dom(self, now):
         """ get last day in month determined by given datetime """
-        import calendar
-        last_day_of_month = calendar.monthrange(now.year, now.month)[1]
-        return last_day_of_month
+        return last_dom(now.year, now.month)
 
     def get_num_wom(self, now):
         """
@@ -102,72 +341,87 @@ class Job(object):
         """ true if given date is in the last week of the month """
         return now.day > self.get_last_dom(now) - 7
 
-    def _check_w(self, now):
-        """ used for checking 15w """
-        w = now.weekday()
-        if w >= 5:
-            return False
-        d = now.day
-        if d in self.allowed_wdom:
-            return True
-        if w == 0:
-            if (d - 1) in self.allowed_wdom:
-                return True
-            # 1w matches monday, 3rd
-            if d == 3 and 1 in self.allowed_wdom:
-                return True
-        elif w == 4:
-            if (d + 1) in self.allowed_wdom:
-                return True
-            # 31w matches friday, 29th
-            lday = self.get_last_dom(now)
-            if d == lday - 2 and lday in self.allowed_wdom:
-                return True
-        return False
-
     def should_run(self):
         """
         :return: ``True`` if the job should be run now.
         """
-        now = datetime.now()
-        return self._should_run_at(now)
+        return self._should_run_at(wall_time(time.time(), self.tz))
 
     def _should_run_at(self, now):
         """
-        :return: ``True`` if the job should be run at given datetime.
-        """
-        # warning: in Python, Monday is 0 and Sunday is 6
-        #          in cron, Sunday=0
-        w = now.weekday()
-        num_wom = self.get_num_wom(now)
-        return (not self.running
-                and (self.allowed_every_year or now.year in self.allowed_years)
-                and (self.allowed_every_month or now.month in self.allowed_months)
-                and (self.allowed_every_hour or now.hour in self.allowed_hours)
-                and (self.allowed_every_min or now.minute in self.allowed_min)
-                and (self.allowed_every_dow
-                     or (w in self.allowed_dow)
-                     or (self.allowed_dowl
-                         and w in self.allowed_dowl
-                         and self.is_last_wom(now))
-                     or (self.allowed_dow_sharp[num_wom]
-                         and w in self.allowed_dow_sharp[num_wom]))
-                and (self.allowed_every_dom
-                     or now.day in self.allowed_dom
-                     or (self.allowed_last_dom and now.day == self.get_last_dom(now))
-                     or (self.allowed_wdom and self._check_w(now)))
-                )
+        :return: ``True`` if the job should be run at given datetime,
+                 and its overlap policy allows a new instance.
+        """
+        return not self._blocked() and self.compiled.matches(now)
+
+    def next_run_at(self, start):
+        """
+        Compute the first minute, not before given datetime, when the job should run.
+        The ``running`` flag is not taken into account.
+        Both datetimes are wall times of the zone of the job; DST transitions are not taken into account,
+        see Scheduler for that.
+        :param start:
+            a datetime; seconds and microseconds are ignored, so that the current minute
+            is returned if it matches
+        :return: a datetime, or None if the pattern won't match anymore
+        """
+        return self.compiled.next_match(start)
 
     def run(self):
         """
         Run the job.
+        If the job function returns an object with add_done_callback(), and an overlap policy was set,
+        the job is running until it is done.
         :return: The return value returned by the `job_func`
         """
+        self._begin()
+        try:
+            result = self._call()
+        except BaseException:
+            self._end()
+            raise
+        self._finish_when_done(result, lambda result: self._end())
+        return result
+
+    def _call(self):
+        """
+        Call the job function, recording metrics and profiling data, without changing the running state.
+        The runtime of commands is recorded when they terminate.
+        """
         logger.info('Running job %s', self)
-        self.running = True
-        ret = self.job_func()
-        self.running = False
-        return ret
+        metrics = self.scheduler.metrics if self.scheduler is not None else _metrics.get_default()
+        profiler = getattr(self.scheduler, 'profiler', None)
+        start = time.time()
+        try:
+            if profiler is not None:
+                result = profiler.call(self, self.job_func)
+            else:
+                result = self.job_func()
+        except BaseException:
+            metrics.observe('pcrond_job_runtime_seconds', time.time() - start)
+            raise
+        when_done(result, lambda _: metrics.observe('pcrond_job_runtime_seconds', time.time() - start))
+        return result
+
+    def _finish_when_done(self, result, callback):
+        """
+        Call callback(result) when given result of the job function is done: if it has add_done_callback(),
+        as futures and the ProcessRecord's of std_launch_func() have, and an overlap policy was set,
+        then later, else now. Meanwhile, the result is tracked as a running instance.
+        """
+        if not self.overlap.until_done or getattr(result, 'add_done_callback', None) is None:
+            callback(result)
+            return
+        self._track(result)
+
+        def f(_):
+            self._untrack(result)
+            callback(result)
+        when_done(result, f)
+
+    def __repr__(self):
+        pattern = " ".join(self.compiled.pattern) if self.compiled is not None else None
+        return "Job(%r, %r)" % (pattern, self.job_func)
 
     def run_if_should(self):
         """
@@ -0,0 +1,138 @@
+import logging
+import mmap
+import os
+import threading
+import time
+
+logger = logging.getLogger('pcrond')
+
+# the journal is rewritten, with one record per job, when it has this many times more records than jobs
+COMPACT_RATIO = 4
+# ... and at least this many records
+COMPACT_MIN = 10000
+
+
+def boot_time():
+    """
+    :return: the timestamp of the last boot of the machine, or None if unknown
+    """
+    try:
+        with open('/proc/stat') as fp:
+            for line in fp:
+                if line.startswith('btime '):
+                    return int(line.split()[1])
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+class Journal(object):
+    """
+    Append-only journal of the last run of each job, so that a restarted scheduler knows what it missed,
+    and what it already did.
+
+    Each record is a line "R <timestamp> <key>". Records are buffered, and written and fsync'ed
+    at most once every sync_interval seconds, so that writing many of them is cheap.
+    On opening, the file is replayed through mmap; a truncated last line, as left by a crash, is ignored.
+    """
+    def __init__(self, path, sync_interval=1.0):
+        """
+        Constructor; the file is created if it does not exist
+        :param sync_interval: max seconds records may wait in memory, 0 to write each one at once
+        """
+        self.path = path
+        self.sync_interval = sync_interval
+        self.last_runs = {}         # key: timestamp
+        self._records = 0           # number of records in the file
+        self._buffer = []
+        self._last_sync = time.time()
+        self._lock = threading.Lock()
+        self._replay()
+        self._fp = open(path, 'ab')
+        if self._records > max(COMPACT_MIN, COMPACT_RATIO * len(self.last_runs)):
+            self.compact()
+
+    def _replay(self):
+        try:
+            fp = open(self.path, 'rb')
+        except (IOError, OSError):
+            return
+        with fp:
+            if os.fstat(fp.fileno()).st_size == 0:
+                return
+            data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for line in iter(data.readline, b''):
+                    if not line.endswith(b'\n'):
+                        break
+                    pieces = line[:-1].split(b' ', 2)
+                    if len(pieces) != 3 or pieces[0] != b'R':
+                        continue
+                    try:
+                        ts = int(pieces[1])
+                    except ValueError:
+                        continue
+                    self.last_runs[pieces[2].decode('utf-8')] = ts
+                    self._records += 1
+            finally:
+                data.close()
+        logger.info("%d jobs found in journal %s", len(self.last_runs), self.path)
+
+    def last_run(self, key):
+        """
+        :return: the timestamp of the last recorded run of given job key, or None
+        """
+        return self.last_runs.get(key)
+
+    def record(self, key, ts):
+        """
+        Record a run of given job key, at given timestamp.
+        """
+        ts = int(ts)
+        with self._lock:
+            self.last_runs[key] = ts
+            self._buffer.append(b'R %d %s\n' % (ts, key.replace('\n', ' ').encode('utf-8')))
+        self.maybe_flush()
+
+    def maybe_flush(self):
+        """
+        Write buffered records, if they have been waiting for more than sync_interval.
+        """
+        if self._buffer and time.time() - self._last_sync >= self.sync_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Write buffered records, and wait until they are on disk.
+        """
+        with self._lock:
+            if self._buffer:
+                self._fp.write(b''.join(self._buffer))
+                self._records += len(self._buffer)
+                del self._buffer[:]
+                self._fp.flush()
+                os.fsync(self._fp.fileno())
+            self._last_sync = time.time()
+            compact = self._records > max(COMPACT_MIN, COMPACT_RATIO * len(self.last_runs))
+        if compact:
+            self.compact()
+
+    def compact(self):
+        """
+        Rewrite the journal, with only the last run of each job.
+        """
+        with self._lock:
+            tmp = self.path + '.tmp'
+            with open(tmp, 'wb') as fp:
+                fp.write(b''.join(b'R %d %s\n' % (ts, key.encode('utf-8')) for (key, ts) in self.last_runs.items()))
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.rename(tmp, self.path)
+            self._fp.close()
+            self._fp = open(self.path, 'ab')
+            self._records = len(self.last_runs)
+            del self._buffer[:]
+
+    def close(self):
+        self.flush()
+        self._fp.close()
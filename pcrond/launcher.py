@@ -0,0 +1,537 @@
+import errno
+import logging
+import os
+import signal
+import threading
+import time
+from collections import deque, namedtuple
+
+logger = logging.getLogger('pcrond')
+
+# how often children are polled, when they cannot be waited for with pidfd
+POLL_INTERVAL = 0.5
+_READ_SIZE = 65536
+_callbacks_lock = threading.Lock()
+_SIGDEF = tuple(getattr(signal, name) for name in ('SIGPIPE', 'SIGXFSZ') if hasattr(signal, name))
+# same values as in the selectors module
+_EVENT_READ = 1
+_EVENT_WRITE = 2
+
+
+class RingBuffer(object):
+    """
+    Keep the last maxsize bytes written.
+    """
+    __slots__ = ('maxsize', 'truncated', '_data')
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.truncated = False      # true if some data was discarded
+        self._data = bytearray()
+
+    def write(self, data):
+        self._data.extend(data)
+        if len(self._data) > self.maxsize:
+            del self._data[:len(self._data) - self.maxsize]
+            self.truncated = True
+
+    def getvalue(self):
+        return bytes(self._data)
+
+
+class ProcessRecord(object):
+    """
+    A process started by :class:`Launcher`.
+    stdout and stderr are RingBuffer's, if output is captured in memory.
+    returncode is None while the process is running, negative if it was killed by a signal.
+    cpu_time (user + system seconds) and max_rss (as ru_maxrss, KiB on Linux) are those of the process,
+    read when it is reaped, or None where wait4() is not available.
+    """
+    __slots__ = ('args', 'pid', 'start_time', 'end_time', 'returncode', 'cpu_time', 'max_rss', 'stdout', 'stderr',
+                 '_poll', '_exited', '_streams', '_callbacks')
+
+    def __init__(self, args, pid, poll, stdout=None, stderr=None):
+        self.args = args
+        self.pid = pid
+        self.start_time = time.time()
+        self.end_time = None
+        self.returncode = None
+        self.cpu_time = None
+        self.max_rss = None
+        self.stdout = stdout
+        self.stderr = stderr
+        self._poll = poll           # 0-ary function returning (exit code, rusage or None), or None if still running
+        self._exited = threading.Event()
+        self._streams = (stdout is not None) + (stderr is not None)    # captured streams not closed yet
+        self._callbacks = []
+
+    @property
+    def running(self):
+        return self.returncode is None
+
+    @property
+    def wall_time(self):
+        """
+        Seconds the process ran, or None while it is running
+        """
+        return self.end_time - self.start_time if self.end_time is not None else None
+
+    def wait(self, timeout=None):
+        """
+        Wait until the process terminates, and its captured output has been read.
+        :return: the exit code, or None on timeout
+        """
+        self._exited.wait(timeout)
+        return self.returncode
+
+    def add_done_callback(self, fn):
+        """
+        Call fn(self) when wait() would return, or now if it already would.
+        """
+        with _callbacks_lock:
+            if not self._exited.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _set_done(self):
+        with _callbacks_lock:
+            self._exited.set()
+            (callbacks, self._callbacks) = (self._callbacks, [])
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception as e:
+                logger.error("Error in callback of %r: %s", self, e)
+
+    def kill(self, sig=signal.SIGTERM):
+        """
+        Send a signal to the process, if it is still running.
+        """
+        if self.returncode is None:
+            try:
+                os.kill(self.pid, sig)
+            except OSError:
+                pass
+
+    def __getstate__(self):
+        # records are returned by job functions run in process pools; there they cannot be waited for
+        return dict((name, getattr(self, name)) for name in ('args', 'pid', 'start_time', 'end_time', 'returncode',
+                                                             'cpu_time', 'max_rss', 'stdout', 'stderr'))
+
+    def __setstate__(self, state):
+        for (name, value) in state.items():
+            setattr(self, name, value)
+        self._poll = None
+        self._streams = 0
+        self._callbacks = []
+        self._exited = threading.Event()
+        self._exited.set()
+
+    def __repr__(self):
+        return "ProcessRecord(%r, pid=%r, returncode=%r)" % (self.args, self.pid, self.returncode)
+
+
+def _exit_code(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def _wait4_poll(pid):
+    """
+    :return: a poll function for ProcessRecord, reaping given child with wait4(), so that its rusage is kept
+    """
+    def poll():
+        try:
+            (reaped, status, usage) = os.wait4(pid, os.WNOHANG)
+        except OSError as e:
+            if e.errno != errno.ECHILD:
+                raise
+            return (0, None)        # already reaped by someone else
+        return (_exit_code(status), usage) if reaped else None
+    return poll
+
+
+def _popen_poll(p):
+    """
+    :return: a poll function for ProcessRecord, for given Popen; the child is reaped with wait4() where available,
+             so that its rusage is kept
+    """
+    if hasattr(os, 'wait4'):
+        wait4 = _wait4_poll(p.pid)
+
+        def poll():
+            status = wait4()
+            if status is not None:
+                # so that Popen does not wait for it again
+                p.returncode = status[0]
+            return status
+        return poll
+
+    def poll():
+        returncode = p.poll()
+        return (returncode, None) if returncode is not None else None
+    return poll
+
+
+_SelectorKey = namedtuple('_SelectorKey', ['fd', 'events', 'data'])
+
+
+class _SelectSelector(object):
+    """
+    The part of selectors.DefaultSelector used by Launcher, on top of select(); for Python 2
+    """
+    def __init__(self):
+        self._keys = {}
+
+    def register(self, fd, events, data=None):
+        self._keys[fd] = _SelectorKey(fd, events, data)
+
+    def unregister(self, fd):
+        del self._keys[fd]
+
+    def select(self, timeout=None):
+        import select
+        readers = [fd for (fd, key) in self._keys.items() if key.events & _EVENT_READ]
+        writers = [fd for (fd, key) in self._keys.items() if key.events & _EVENT_WRITE]
+        try:
+            (readable, writable, _) = select.select(readers, writers, [], timeout)
+        except (select.error, OSError) as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return []
+        ready = set(readable) | set(writable)
+        return [(self._keys[fd], self._keys[fd].events) for fd in ready if fd in self._keys]
+
+    def close(self):
+        self._keys.clear()
+
+
+def _new_selector():
+    """
+    :return: a selectors.DefaultSelector, or an equivalent based on select() where the selectors module is missing
+    """
+    try:
+        import selectors
+    except ImportError:
+        return _SelectSelector()
+    return selectors.DefaultSelector()
+
+
+def _set_nonblocking(fd):
+    import fcntl
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+
+class Launcher(object):
+    """
+    Start commands without blocking, and reap them in background.
+
+    On POSIX systems, children are started with os.posix_spawnp() where available (much cheaper than
+    fork() for a big parent process), and a single background thread feeds their stdin, reads their
+    output and waits for them, using pidfd where available or else polling.
+    As with posix_spawn, children inherit only the file descriptors that are inheritable,
+    which is not the default for files opened by Python.
+    Elsewhere, subprocess.Popen is used, with a helper thread per process.
+    """
+    def __init__(self, capture=None, buffer_size=65536, max_records=1000, use_posix_spawn=True):
+        """
+        Constructor
+        :param capture:
+            None to let children inherit stdout and stderr, 'buffer' to keep the last buffer_size bytes
+            of each stream in memory, or a file path where the output of all children is appended
+        :param max_records:
+            number of ProcessRecord of terminated processes kept in self.finished
+        :param use_posix_spawn:
+            set to False to use subprocess.Popen
+        """
+        self.capture = capture
+        self.buffer_size = buffer_size
+        self.finished = deque(maxlen=max_records)
+        self.running = {}           # pid: ProcessRecord
+        self._posix = os.name == 'posix'
+        self._use_posix_spawn = use_posix_spawn and hasattr(os, 'posix_spawnp')
+        self._use_pidfd = hasattr(os, 'pidfd_open')
+        self._lock = threading.Lock()
+        self._requests = []         # (fd, events, callback) to register in the selector
+        self._thread = None
+        self._selector = None
+        self._wakeup_fds = None
+        self._stop = False
+
+    def spawn(self, args, stdin=None):
+        """
+        Start given command.
+        :param args: the command, as a list of strings
+        :param stdin: None, or str or bytes to be sent to the standard input of the command
+        :return: a ProcessRecord
+        """
+        if stdin is not None and not isinstance(stdin, bytes):
+            stdin = stdin.encode()
+        if not self._posix:
+            return self._spawn_threaded(args, stdin)
+        self._ensure_thread()
+        if self._use_posix_spawn:
+            (record, fds) = self._posix_spawn(args, stdin)
+        else:
+            (record, fds) = self._popen(args, stdin)
+        with self._lock:
+            self.running[record.pid] = record
+            (stdin_w, stdout_r, stderr_r) = fds
+            if stdin_w is not None:
+                _set_nonblocking(stdin_w)
+                self._requests.append((stdin_w, 'w', self._writer(stdin_w, stdin)))
+            for (fd, buf) in ((stdout_r, record.stdout), (stderr_r, record.stderr)):
+                if fd is not None:
+                    self._requests.append((fd, 'r', self._reader(fd, record, buf)))
+            pidfd = None
+            if self._use_pidfd:
+                try:
+                    pidfd = os.pidfd_open(record.pid)
+                except OSError:
+                    # already reaped, or no kernel support
+                    pass
+            if pidfd is not None:
+                self._requests.append((pidfd, 'r', self._exit_watcher(pidfd, record)))
+            else:
+                self._requests.append((None, None, record))
+        os.write(self._wakeup_fds[1], b'x')
+        return record
+
+    def _pipes(self, stdin):
+        """
+        :return: pairs (read fd, write fd) or None, for stdin, stdout, stderr
+        """
+        capture = self.capture == 'buffer'
+        return (os.pipe() if stdin is not None else None,
+                os.pipe() if capture else None,
+                os.pipe() if capture else None)
+
+    def _buffers(self):
+        if self.capture == 'buffer':
+            return (RingBuffer(self.buffer_size), RingBuffer(self.buffer_size))
+        return (None, None)
+
+    def _posix_spawn(self, args, stdin):
+        pipes = self._pipes(stdin)
+        actions = []
+        logfd = None
+        if pipes[0] is not None:
+            actions.append((os.POSIX_SPAWN_DUP2, pipes[0][0], 0))
+        if self.capture == 'buffer':
+            actions.append((os.POSIX_SPAWN_DUP2, pipes[1][1], 1))
+            actions.append((os.POSIX_SPAWN_DUP2, pipes[2][1], 2))
+        elif self.capture is not None:
+            logfd = os.open(self.capture, os.O_WRONLY | os.O_APPEND | os.O_CREAT | getattr(os, 'O_CLOEXEC', 0),
+                            0o644)
+            actions.append((os.POSIX_SPAWN_DUP2, logfd, 1))
+            actions.append((os.POSIX_SPAWN_DUP2, logfd, 2))
+        try:
+            # like subprocess, restore the signals ignored by Python
+            pid = os.posix_spawnp(args[0], args, os.environ, file_actions=actions, setsigdef=_SIGDEF)
+        except Exception:
+            for pipe in pipes:
+                if pipe is not None:
+                    os.close(pipe[0])
+                    os.close(pipe[1])
+            raise
+        finally:
+            if logfd is not None:
+                os.close(logfd)
+        # close the ends used by the child
+        (stdin_p, stdout_p, stderr_p) = pipes
+        for (pipe, used) in ((stdin_p, 0), (stdout_p, 1), (stderr_p, 1)):
+            if pipe is not None:
+                os.close(pipe[used])
+        (stdout, stderr) = self._buffers()
+        record = ProcessRecord(args, pid, _wait4_poll(pid), stdout, stderr)
+        return (record, (stdin_p and stdin_p[1], stdout_p and stdout_p[0], stderr_p and stderr_p[0]))
+
+    def _start_popen(self, args, stdin):
+        """
+        :return: the Popen, and the RingBuffer's for stdout and stderr, if any
+        """
+        from subprocess import Popen, PIPE, STDOUT
+        logfile = None
+        if self.capture == 'buffer':
+            (stdout, stderr) = (PIPE, PIPE)
+        elif self.capture is not None:
+            logfile = open(self.capture, 'ab')
+            (stdout, stderr) = (logfile, STDOUT)
+        else:
+            (stdout, stderr) = (None, None)
+        try:
+            p = Popen(args, stdin=PIPE if stdin is not None else None, stdout=stdout, stderr=stderr)
+        finally:
+            if logfile is not None:
+                logfile.close()
+        return (p,) + self._buffers()
+
+    def _popen(self, args, stdin):
+        (p, out, err) = self._start_popen(args, stdin)
+        record = ProcessRecord(args, p.pid, _popen_poll(p), out, err)
+        # file objects are detached, the selector loop works on raw fds
+        fds = tuple(os.dup(f.fileno()) if f is not None else None for f in (p.stdin, p.stdout, p.stderr))
+        for f in (p.stdin, p.stdout, p.stderr):
+            if f is not None:
+                f.close()
+        return (record, fds)
+
+    def _spawn_threaded(self, args, stdin):
+        (p, out, err) = self._start_popen(args, stdin)
+        record = ProcessRecord(args, p.pid, _popen_poll(p), out, err)
+        with self._lock:
+            self.running[record.pid] = record
+
+        def run():
+            (outdata, errdata) = p.communicate(stdin)
+            for (buf, data) in ((out, outdata), (err, errdata)):
+                if buf is not None and data:
+                    buf.write(data)
+            record._streams = 0
+            self._exited(record, p.returncode)
+        thread = threading.Thread(target=run, name="pcrond-launch")
+        thread.daemon = True
+        thread.start()
+        return record
+
+    def _ensure_thread(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._selector = _new_selector()
+            self._wakeup_fds = os.pipe()
+            _set_nonblocking(self._wakeup_fds[0])
+            self._selector.register(self._wakeup_fds[0], _EVENT_READ, self._drain_wakeup)
+            self._thread = threading.Thread(target=self._run, name="pcrond-reaper")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        polled = []
+        while not self._stop:
+            with self._lock:
+                (requests, self._requests) = (self._requests, [])
+            for (fd, events, callback) in requests:
+                if fd is None:
+                    polled.append(callback)
+                else:
+                    event = _EVENT_READ if events == 'r' else _EVENT_WRITE
+                    self._selector.register(fd, event, callback)
+            for (key, _) in self._selector.select(POLL_INTERVAL if polled else None):
+                key.data(key.fd)
+            for record in list(polled):
+                status = record._poll()
+                if status is not None:
+                    polled.remove(record)
+                    self._exited(record, *status)
+        self._selector.close()
+        for fd in self._wakeup_fds:
+            os.close(fd)
+
+    def _drain_wakeup(self, fd):
+        try:
+            os.read(fd, _READ_SIZE)
+        except OSError:
+            pass
+
+    def _close(self, fd):
+        self._selector.unregister(fd)
+        os.close(fd)
+
+    def _reader(self, fd, record, buf):
+        def f(fd):
+            try:
+                data = os.read(fd, _READ_SIZE)
+            except OSError:
+                data = b''
+            if data:
+                buf.write(data)
+            else:
+                self._close(fd)
+                record._streams -= 1
+                self._finish(record)
+        return f
+
+    def _writer(self, fd, data):
+        view = memoryview(data)
+        pos = [0]
+
+        def f(fd):
+            try:
+                pos[0] += os.write(fd, view[pos[0]:pos[0] + _READ_SIZE])
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    return
+                pos[0] = len(view)      # the child does not read stdin anymore
+            if pos[0] >= len(view):
+                self._close(fd)
+        return f
+
+    def _exit_watcher(self, pidfd, record):
+        def f(fd):
+            self._close(fd)
+            status = record._poll()
+            if status is None:
+                # should not happen, wait anyway
+                status = (_exit_code(os.waitpid(record.pid, 0)[1]), None)
+            self._exited(record, *status)
+        return f
+
+    def _exited(self, record, returncode, usage=None):
+        record.end_time = time.time()
+        if usage is not None:
+            record.cpu_time = usage.ru_utime + usage.ru_stime
+            record.max_rss = usage.ru_maxrss
+        record.returncode = returncode
+        with self._lock:
+            self.running.pop(record.pid, None)
+            self.finished.append(record)
+        if returncode != 0:
+            logger.warning("Command %s terminated with exit code %d", record.args, returncode)
+        else:
+            logger.debug("Command %s terminated", record.args)
+        self._finish(record)
+
+    def _finish(self, record):
+        """
+        Wake up those waiting for given record, if the process terminated and its output was read.
+        """
+        if record.returncode is not None and record._streams <= 0:
+            record._set_done()
+
+    def shutdown(self):
+        """
+        Stop the background thread. Running children are neither killed nor reaped anymore.
+        """
+        with self._lock:
+            self._stop = True
+            if self._thread is None:
+                return
+        os.write(self._wakeup_fds[1], b'x')
+        self._thread.join()
+
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def get_default():
+    """
+    :return: the Launcher used by std_launch_func(); it is created on first use
+    """
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = Launcher()
+        return _default
+
+
+def set_default(launcher):
+    """
+    Set the Launcher used by std_launch_func().
+    """
+    global _default
+    with _default_lock:
+        _default = launcher
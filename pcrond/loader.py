@@ -0,0 +1,225 @@
+from collections import namedtuple
+import re
+from .compiled import compile_crontab, cache_schedule
+from .cronparser import uses_hash
+from .job import ALIASES, normalize_crontab
+from .zones import get_zone
+
+# an error found while loading a crontab; rownum counts from 0, like in Scheduler log messages
+LoadError = namedtuple('LoadError', ['rownum', 'line', 'message'])
+
+# a crontab line that can be turned into a job: pattern is the CompiledSchedule, key identifies the job,
+# tz is the time zone name set by the last CRON_TZ line before it, or None
+CrontabEntry = namedtuple('CrontabEntry', ['rownum', 'line', 'pattern', 'command', 'stdin', 'key', 'tz'])
+
+# a line setting the time zone of the following ones, as in cronie
+_CRON_TZ = re.compile(r'^CRON_TZ\s*=\s*(.*)$')
+
+# lines parsed at once by iter_crontab_entries(), so that memory does not grow with the file
+BLOCK_LINES = 50000
+
+# a year field contains no names, so a 6th token with other characters is the beginning of the command
+YEAR_CHARS = frozenset('0123456789*,-/')
+
+
+def iter_crontab_lines(source):
+    """
+    Read crontab lines lazily, skipping empty lines and comments.
+    :param source:
+        a file path, or a file-like object with readline() (also a mmap), or any iterable of lines.
+        bytes are decoded as UTF-8.
+    :return: a generator of (rownum, line)
+    """
+    if isinstance(source, str):
+        with open(source) as fp:
+            for x in iter_crontab_lines(fp):
+                yield x
+        return
+    if hasattr(source, 'readline'):
+        source = _readlines(source)
+    for rownum, line in enumerate(source):
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        line = line.strip()
+        if line != "" and line[0] != "#":
+            yield (rownum, line)
+
+
+def _readlines(fp):
+    while True:
+        line = fp.readline()
+        if not line:
+            return
+        yield line
+
+
+def cron_tz(line):
+    """
+    :return: the time zone name of a CRON_TZ=... line, '' for local time; None if the line is something else
+    """
+    match = _CRON_TZ.match(line)
+    if match is None:
+        return None
+    return match.group(1).strip().strip('"\'')
+
+
+def split_input_line(s):
+    """
+    Command is split in command and stdin using %, not %%
+    :return: two strings, command and stdin
+    """
+    # s == aaaa%%bbbbbb%cccc%dd%%ee
+    pieces = [x.split('%') for x in s.split('%%')]
+    # pieces == [[aaaa],[bbbbbb,cccc,dd],[ee]]
+    rejoin = "%".join(["\n".join(x) for x in pieces])
+    # rejoin == aaaa%bbbbbb\ncccc\ndd%ee
+    return rejoin.split('\n', 1)
+    # lines == [aaaa%bbbbbb,ccc\ndd%ee]
+
+
+def candidate_patterns(crontab_line):
+    """
+    :return: the list of (normalized pattern, command tokens) that given crontab line
+             (without stdin) may represent, in order of preference
+    :raise ValueError: if the line is too short
+    """
+    pieces = crontab_line.split()
+    if pieces[0] in ALIASES.keys():
+        # CASE 1 - pattern using alias
+        return [(tuple(normalize_crontab(pieces[0])), pieces[1:])]
+    if len(pieces) < 6:
+        raise ValueError("expected at least 6 tokens")
+    candidates = []
+    if len(pieces) >= 8 and set(pieces[6]) <= YEAR_CHARS:
+        # CASE 2 - pattern including seconds and year
+        candidates.append((tuple(normalize_crontab(" ".join(pieces[0:7]))), pieces[7:]))
+    if len(pieces) >= 7 and set(pieces[5]) <= YEAR_CHARS:
+        # CASE 3 - pattern including year
+        candidates.append((tuple(normalize_crontab(" ".join(pieces[0:6]))), pieces[6:]))
+    # CASE 4 - pattern not including year
+    candidates.append((tuple(normalize_crontab(" ".join(pieces[0:5]))), pieces[5:]))
+    return candidates
+
+
+def line_key(command):
+    """
+    :return: the key of the job of a crontab line, given its command tokens; it seeds H tokens
+    """
+    return " ".join(command)
+
+
+def _compile_chunk(patterns):
+    """
+    Compile given (pattern, seed) pairs; run by worker processes
+    :return: a list of CompiledSchedule or error messages
+    """
+    result = []
+    for (pattern, seed) in patterns:
+        try:
+            result.append(compile_crontab(pattern, seed))
+        except ValueError as e:
+            result.append(str(e))
+    return result
+
+
+def compile_patterns(patterns, processes=1, chunksize=1000):
+    """
+    Compile many distinct patterns, possibly in parallel. Compiled patterns are put in the cache.
+    :param patterns:
+        (pattern, seed) pairs, seed being None for patterns without H tokens; see compile_crontab()
+    :param processes:
+        number of worker processes, None for one per CPU, 1 for compiling in this process
+    :return: a dict {(pattern, seed): CompiledSchedule or error message}
+    """
+    patterns = list(patterns)
+    if processes != 1 and len(patterns) > chunksize:
+        from concurrent.futures import ProcessPoolExecutor
+        chunks = [patterns[i:i + chunksize] for i in range(0, len(patterns), chunksize)]
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            results = [x for chunk in executor.map(_compile_chunk, chunks) for x in chunk]
+        results = [x if isinstance(x, str) else cache_schedule(x) for x in results]
+    else:
+        results = _compile_chunk(patterns)
+    return dict(zip(patterns, results))
+
+
+def parse_crontab(source, processes=1, chunksize=1000):
+    """
+    Parse a whole crontab, see iter_crontab_entries().
+    :param source: see iter_crontab_lines()
+    :param processes: see compile_patterns()
+    :return: a list of CrontabEntry and a list of LoadError, both ordered by line number
+    """
+    return parse_crontab_lines(iter_crontab_lines(source), processes, chunksize)
+
+
+def parse_crontab_lines(numbered_lines, processes=1, chunksize=1000):
+    """
+    Same as parse_crontab(), for an iterable of (rownum, line) without empty lines and comments
+    """
+    entries = []
+    errors = []
+    for x in iter_crontab_entries(numbered_lines, processes, chunksize):
+        (errors if isinstance(x, LoadError) else entries).append(x)
+    return (entries, errors)
+
+
+def iter_crontab_entries(numbered_lines, processes=1, chunksize=1000, block_lines=BLOCK_LINES):
+    """
+    Parse crontab lines lazily, block_lines at a time; the distinct patterns of each block are parsed only once.
+    :param numbered_lines: an iterable of (rownum, line) without empty lines and comments
+    :param processes: see compile_patterns()
+    :return: a generator of CrontabEntry and LoadError, ordered by line number
+    """
+    block = []
+    tz = None
+    for rownum, line in numbered_lines:
+        zone = cron_tz(line)
+        if zone is not None:
+            try:
+                get_zone(zone or None)
+                tz = zone or None
+            except ValueError as e:
+                block.append(LoadError(rownum, line, str(e)))
+            continue
+        pieces = split_input_line(line)
+        stdin = pieces[1] if len(pieces) > 1 else None
+        try:
+            candidates = candidate_patterns(pieces[0])
+        except ValueError as e:
+            block.append(LoadError(rownum, line, str(e)))
+            continue
+        candidates = [(pattern, command, line_key(command) if uses_hash(pattern) else None)
+                      for (pattern, command) in candidates]
+        block.append((rownum, line, candidates, stdin, tz))
+        if len(block) >= block_lines:
+            for x in _block_entries(block, processes, chunksize):
+                yield x
+            block = []
+    for x in _block_entries(block, processes, chunksize):
+        yield x
+
+
+def _block_entries(block, processes, chunksize):
+    """
+    Compile the patterns of a block of lines, as collected by iter_crontab_entries().
+    :return: a generator of CrontabEntry and LoadError
+    """
+    patterns = {}
+    for item in block:
+        if not isinstance(item, LoadError):
+            for (pattern, _, seed) in item[2]:
+                patterns[(pattern, seed)] = None
+    compiled = compile_patterns(patterns, processes, chunksize)
+    for item in block:
+        if isinstance(item, LoadError):
+            yield item
+            continue
+        (rownum, line, candidates, stdin, tz) = item
+        for (pattern, command, seed) in candidates:
+            schedule = compiled[(pattern, seed)]
+            if not isinstance(schedule, str):
+                yield CrontabEntry(rownum, line, schedule, command, stdin, line_key(command), tz)
+                break
+        else:
+            yield LoadError(rownum, line, "cannot parse pattern: %s" % schedule)
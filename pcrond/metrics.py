@@ -0,0 +1,204 @@
+import bisect
+import logging
+import os
+import threading
+
+logger = logging.getLogger('pcrond')
+
+# upper bounds of histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+# metrics recorded by pcrond; all durations are in seconds
+DESCRIPTIONS = {
+    'pcrond_tick_seconds': 'Time spent by run_pending() finding the jobs to run',
+    'pcrond_jobs_evaluated_total': 'Jobs whose pattern was checked by run_pending()',
+    'pcrond_jobs_fired_total': 'Jobs started by run_pending()',
+    'pcrond_jobs_skipped_total': 'Runs skipped because of overlap policies or concurrency caps',
+    'pcrond_lateness_seconds': 'Delay between the scheduled minute and the start of a job',
+    'pcrond_job_runtime_seconds': 'Job duration, including the time waiting for a free worker',
+    'pcrond_spawn_seconds': 'Time spent starting a subprocess',
+}
+
+
+class NullMetrics(object):
+    """
+    A metrics hook doing nothing, used by default.
+    Custom hooks (es. forwarding to statsd) should define the same methods.
+    """
+    def observe(self, name, value):
+        """ record a value in the histogram with given name """
+        pass
+
+    def inc(self, name, value=1):
+        """ increment the counter with given name """
+        pass
+
+
+class Histogram(object):
+    """
+    Cumulative histogram, in Prometheus style.
+    """
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)   # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics(NullMetrics):
+    """
+    A metrics hook keeping histograms and counters in memory.
+    Values can be exported with render(), or with TextFileExporter and HTTPExporter.
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.histograms = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, value):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    def inc(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def render(self):
+        """
+        :return: all metrics, in Prometheus text exposition format
+        """
+        lines = []
+        with self._lock:
+            for name in sorted(self.counters):
+                lines.extend(_header(name, 'counter'))
+                lines.append('%s %s' % (name, self.counters[name]))
+            for name in sorted(self.histograms):
+                histogram = self.histograms[name]
+                lines.extend(_header(name, 'histogram'))
+                cumulative = 0
+                for (bound, count) in zip(self.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append('%s_bucket{le="%s"} %d' % (name, bound, cumulative))
+                lines.append('%s_bucket{le="+Inf"} %d' % (name, histogram.count))
+                lines.append('%s_sum %r' % (name, histogram.sum))
+                lines.append('%s_count %d' % (name, histogram.count))
+        return "\n".join(lines) + "\n"
+
+
+def _header(name, kind):
+    if name in DESCRIPTIONS:
+        yield '# HELP %s %s' % (name, DESCRIPTIONS[name])
+    yield '# TYPE %s %s' % (name, kind)
+
+
+_default = NullMetrics()
+
+
+def get_default():
+    """
+    :return: the metrics hook used by schedulers without their own one, and by std_launch_func()
+    """
+    return _default
+
+
+def set_default(metrics):
+    """
+    Set the metrics hook used by schedulers without their own one, and by std_launch_func().
+    :param metrics: a Metrics, or None to disable metrics
+    """
+    global _default
+    _default = metrics if metrics is not None else NullMetrics()
+
+
+class TextFileExporter(object):
+    """
+    Periodically write metrics to a file, es. for the textfile collector of Prometheus node exporter.
+    The file is replaced atomically.
+    """
+    def __init__(self, metrics, path, interval=15):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def write(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as fp:
+            fp.write(self.metrics.render())
+        os.rename(tmp, self.path)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="pcrond-metrics")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, wait=False):
+        self._stop.set()
+        if wait and self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.write()
+            except (IOError, OSError) as e:
+                logger.error("Cannot write metrics to %s: %s", self.path, e)
+        self.write()
+
+
+class HTTPExporter(object):
+    """
+    Serve metrics over HTTP from a background thread, at any path.
+    Listens on localhost only by default.
+    """
+    def __init__(self, metrics, port=9180, host='127.0.0.1'):
+        try:
+            from http.server import HTTPServer, BaseHTTPRequestHandler
+        except ImportError:     # Python 2
+            from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug("metrics: " + format, *args)
+
+        self.metrics = metrics
+        self.server = HTTPServer((host, port), Handler)
+        self._thread = None
+
+    @property
+    def port(self):
+        """ the actual port, useful if 0 was given """
+        return self.server.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name="pcrond-metrics-http")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, wait=False):
+        if self._thread is not None:
+            # would block forever if serve_forever() was not started
+            self.server.shutdown()
+            if wait:
+                self._thread.join()
+        self.server.server_close()
@@ -0,0 +1,186 @@
+"""
+Preview of the runs of many jobs over a time window, without running them.
+
+preview() streams the runs in time order, merging one lazy generator per distinct schedule.
+histogram() counts the runs in each minute; jobs are grouped by their day rules, so that the cost is
+proportional to the number of days in the window times the number of distinct day rules,
+rather than to the number of minutes times the number of jobs.
+
+Times are local wall times. Jobs with a time zone are evaluated in their zone, then converted;
+the DST rules of pcrond.zones are not simulated.
+"""
+import bisect
+import heapq
+import operator
+from datetime import timedelta
+from .batch import MINUTES_PER_DAY, _bit_indexes, _minute_range, day_row
+from .zones import timestamp, wall_time
+
+ONE_DAY = timedelta(days=1)
+# time zone offsets change at most every quarter of an hour
+CHUNK_MINUTES = 15
+
+
+def _day_minutes(compiled):
+    """
+    :return: the sorted list of the minutes of the day, as h*60+m, allowed by given CompiledSchedule
+    """
+    return _bit_indexes(day_row(compiled))
+
+
+def schedule_times(compiled, start, end):
+    """
+    Generate the run times of a CompiledSchedule in [start, end), seconds included, in order.
+    The next matching day is found by CompiledSchedule.next_match(), so rare patterns cost little.
+    """
+    minutes = _day_minutes(compiled)
+    seconds = compiled.seconds or (0,)
+    when = compiled.next_match(start)
+    while when is not None and when < end:
+        midnight = when.replace(hour=0, minute=0)
+        for i in range(bisect.bisect_left(minutes, when.hour * 60 + when.minute), len(minutes)):
+            minute = midnight + timedelta(minutes=minutes[i])
+            if minute >= end:
+                return
+            for second in seconds:
+                t = minute + timedelta(seconds=second)
+                if start <= t < end:
+                    yield t
+        when = compiled.next_match(midnight + ONE_DAY)
+
+
+def _group_by_schedule(jobs):
+    """
+    :return: a list of (compiled, tz, jobs), for each distinct schedule and zone, in order of first job
+    """
+    groups = {}
+    result = []
+    for job in jobs:
+        key = (id(job.compiled), job.tz)
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = (job.compiled, job.tz, [])
+            result.append(group)
+        group[2].append(job)
+    return result
+
+
+def _local_times(compiled, tz, start, end):
+    """
+    Same as schedule_times(), for a schedule in given zone, with start, end and results in local time.
+    """
+    if tz is None:
+        for t in schedule_times(compiled, start, end):
+            yield t
+        return
+    zstart = wall_time(timestamp(start), tz)
+    # an hour more, in case of a change of offset
+    zend = wall_time(timestamp(end), tz) + timedelta(hours=1)
+    for t in schedule_times(compiled, zstart, zend):
+        local = wall_time(timestamp(t, tz))
+        if local >= end:
+            return
+        if local >= start:
+            yield local
+
+
+def preview(jobs, start, end):
+    """
+    Generate the runs of given jobs in [start, end), as (datetime, job), in time order;
+    runs at the same time follow the order of the jobs.
+    Runs are produced lazily, so that a long window can be previewed without keeping it in memory.
+    """
+    def tagged(seq, compiled, tz, group):
+        for t in _local_times(compiled, tz, start, end):
+            yield (t, seq, group)
+
+    streams = [tagged(seq, compiled, tz, group)
+               for (seq, (compiled, tz, group)) in enumerate(_group_by_schedule(jobs))]
+    for (t, _, group) in heapq.merge(*streams):
+        for job in group:
+            yield (t, job)
+
+
+def _day_key(compiled):
+    """
+    :return: what identifies the days when given CompiledSchedule runs
+    """
+    return (compiled.month_mask, compiled.every_year, compiled.year_mask, compiled.dom, compiled.last_dom,
+            compiled.wdom, compiled.dow, compiled.dowl, tuple(sorted(compiled.dow_sharp.items())))
+
+
+def _day_counts(groups):
+    """
+    :param groups: (compiled, jobs) with the same day rules
+    :return: a list of 1440 run counts, one for each minute of a day when they run
+    """
+    rows = {}
+    for (compiled, jobs) in groups:
+        row = day_row(compiled)
+        rows[row] = rows.get(row, 0) + len(jobs) * len(compiled.seconds or (0,))
+    counts = [0] * MINUTES_PER_DAY
+    for (row, n) in rows.items():
+        for i in _bit_indexes(row):
+            counts[i] += n
+    return counts
+
+
+def _zone_histogram(groups, start, size):
+    """
+    :param groups: (compiled, jobs) of the same zone
+    :param start: a wall time of that zone, at the beginning of a minute
+    :return: the run counts of each minute of [start, start + size minutes)
+    """
+    classes = {}
+    for (compiled, jobs) in groups:
+        classes.setdefault(_day_key(compiled), []).append((compiled, jobs))
+    classes = [(same[0][0], _day_counts(same)) for same in classes.values()]
+    counts = [0] * size
+    midnight = start.replace(hour=0, minute=0)
+    offset = -(start.hour * 60 + start.minute)          # index of the current midnight in counts
+    while offset < size:
+        (year, month, day) = (midnight.year, midnight.month, midnight.day)
+        (lo, hi) = (max(offset, 0), min(offset + MINUTES_PER_DAY, size))
+        for (compiled, day_counts) in classes:
+            if (compiled.month_mask >> month) & 1 and compiled.year_matches(year) \
+                    and (compiled.day_mask(year, month) >> day) & 1:
+                counts[lo:hi] = map(operator.add, counts[lo:hi], day_counts[lo - offset:hi - offset])
+        midnight += ONE_DAY
+        offset += MINUTES_PER_DAY
+    return counts
+
+
+def histogram(jobs, start, end):
+    """
+    Count the runs of given jobs in each minute of [start, end), to spot load peaks.
+    Jobs with a seconds field count once per run.
+    :return: a list of counts, one for each minute of local wall time, the first one being the minute of start
+    """
+    (start, size) = _minute_range(start, end)
+    zones = {}
+    for (compiled, tz, group) in _group_by_schedule(jobs):
+        zones.setdefault(tz, []).append((compiled, group))
+    counts = [0] * size
+    for (tz, groups) in zones.items():
+        if tz is None:
+            counts = list(map(operator.add, counts, _zone_histogram(groups, start, size)))
+            continue
+        # counted in zone time, an hour more in case of a change of offset, then moved to local minutes
+        zstart = wall_time(timestamp(start), tz)
+        zone_counts = _zone_histogram(groups, zstart, size + 60)
+        for i in range(0, size + 60, CHUNK_MINUTES):
+            local = wall_time(timestamp(zstart + timedelta(minutes=i), tz))
+            j = int((local - start).total_seconds() // 60)
+            (lo, hi) = (max(j, 0), min(j + CHUNK_MINUTES, size))
+            if lo < hi:
+                counts[lo:hi] = map(operator.add, counts[lo:hi], zone_counts[i + lo - j:i + hi - j])
+    return counts
+
+
+def peaks(counts, start, n=10):
+    """
+    :param counts: as returned by histogram()
+    :return: the n busiest minutes, as (datetime, count), busiest first
+    """
+    best = heapq.nlargest(n, range(len(counts)), key=counts.__getitem__)
+    return [(start.replace(second=0, microsecond=0) + timedelta(minutes=i), counts[i]) for i in best]
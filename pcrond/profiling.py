@@ -0,0 +1,136 @@
+import json
+import logging
+import threading
+import time
+from .launcher import ProcessRecord
+
+logger = logging.getLogger('pcrond')
+
+# CPU time of the calling thread, where available
+thread_time = getattr(time, 'thread_time', None) or getattr(time, 'process_time', None) or time.clock
+
+
+class JobStats(object):
+    """
+    Cost accounting of a single job.
+    """
+    __slots__ = ('job_id', 'label', 'checks', 'check_time', 'calls', 'errors', 'wall_time', 'cpu_time',
+                 'children_cpu_time', 'children_max_rss')
+
+    def __init__(self, job_id, label):
+        self.job_id = job_id
+        self.label = label
+        self.checks = 0                 # times the pattern was matched against a minute
+        self.check_time = 0.0
+        self.calls = 0                  # runs
+        self.errors = 0
+        self.wall_time = 0.0
+        self.cpu_time = 0.0             # of the thread running the job function
+        self.children_cpu_time = 0.0
+        self.children_max_rss = 0       # in KiB on Linux, largest max RSS of a command of the job
+
+    def as_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+
+def _label(job):
+    try:
+        return "%s %r" % (" ".join(job.crontab_pattern), job.job_func)
+    except AttributeError:
+        return repr(job.job_func)
+
+
+class Profiler(object):
+    """
+    Collect per-job costs. Enable it by setting ``Scheduler.profiler``.
+
+    Commands started by std_launch_func() are accounted when they terminate, with the CPU time and
+    max RSS that wait4() reports for them; other children of job functions are not accounted.
+    Jobs run in a process pool are accounted only for calls and wall time.
+    Methods may be called from any thread, but not from signal handlers, since they take a lock.
+    """
+    def __init__(self):
+        self.stats = {}
+        self.loads = []
+        self._lock = threading.Lock()
+
+    def _stats(self, job):
+        stats = self.stats.get(job.id)
+        if stats is None:
+            stats = self.stats[job.id] = JobStats(job.id, _label(job))
+        return stats
+
+    def record_check(self, job, elapsed):
+        with self._lock:
+            stats = self._stats(job)
+            stats.checks += 1
+            stats.check_time += elapsed
+
+    def record_run(self, job, wall_time, cpu_time=0.0, children_cpu_time=0.0, children_max_rss=0, error=False):
+        with self._lock:
+            stats = self._stats(job)
+            stats.calls += 1
+            stats.errors += bool(error)
+            stats.wall_time += wall_time
+            stats.cpu_time += cpu_time
+            stats.children_cpu_time += children_cpu_time
+            stats.children_max_rss = max(stats.children_max_rss, children_max_rss)
+
+    def call(self, job, func):
+        """
+        Call given function on behalf of given job, accounting its costs.
+        If func returns a ProcessRecord, the run is accounted when the process terminates,
+        with its CPU time and max RSS; a non-zero exit code counts as an error.
+        :return: the value returned by func
+        """
+        cpu = thread_time()
+        start = time.time()
+        try:
+            result = func()
+        except BaseException:
+            self.record_run(job, time.time() - start, thread_time() - cpu, error=True)
+            raise
+        cpu_time = thread_time() - cpu
+        if not isinstance(result, ProcessRecord):
+            self.record_run(job, time.time() - start, cpu_time)
+            return result
+
+        def record(_):
+            self.record_run(job, time.time() - start, cpu_time, result.cpu_time or 0.0, result.max_rss or 0,
+                            result.returncode != 0)
+        result.add_done_callback(record)
+        return result
+
+    def record_load(self, source, jobs, wall_time, cpu_time):
+        with self._lock:
+            self.loads.append({'source': str(source), 'jobs': jobs, 'wall_time': wall_time, 'cpu_time': cpu_time})
+
+    def top(self, n=10, key='cpu_time'):
+        """
+        :return: the n JobStats with highest given attribute
+        """
+        with self._lock:
+            stats = list(self.stats.values())
+        stats.sort(key=lambda s: getattr(s, key), reverse=True)
+        return stats[:n]
+
+    def report(self):
+        """
+        :return: all collected data, as a JSON-serializable dict
+        """
+        with self._lock:
+            return {'jobs': [s.as_dict() for s in sorted(self.stats.values(), key=lambda s: s.job_id)],
+                    'loads': list(self.loads)}
+
+    def dump(self, path):
+        """
+        Write report() to given file, as JSON.
+        """
+        with open(path, "w") as fp:
+            json.dump(self.report(), fp, indent=2)
+        logger.info("Profiling data written to %s", path)
+
+    def reset(self):
+        with self._lock:
+            self.stats.clear()
+            del self.loads[:]
@@ -1,42 +1,288 @@
 # most of the code here comes from https://github.com/dbader/schedule
 
-from .job import Job, ALIASES
+from .compiled import compile_crontab
+from .job import Job, OVERLAP_QUEUE, OVERLAP_KILL, when_done
+from .index import TimeIndex
+from .store import JobStore
+from .loader import LoadError, cron_tz, iter_crontab_entries, iter_crontab_lines, split_input_line
+from .watch import FileWatcher
+from .journal import boot_time
+from . import launcher as _launcher
+from . import metrics as _metrics
+from . import profiling as _profiling
+from . import zones as _zones
+from collections import deque, namedtuple
+from datetime import datetime
+import heapq
+import itertools
 import logging
+import os
+import threading
 import time
 
 logger = logging.getLogger('pcrond')
 
+# not affected by adjustments of the wall clock; Python 2 has none
+_monotonic = getattr(time, 'monotonic', time.time)
+
+# result of Scheduler.bulk_load()
+LoadReport = namedtuple('LoadReport', ['jobs', 'errors'])
+
+# catch-up policies, for jobs whose run was missed because the scheduler was not running
+CATCHUP_SKIP = 'skip'       # ignore missed runs
+CATCHUP_ONCE = 'once'       # run once each job that missed at least one run
+CATCHUP_ALL = 'all'         # run each job once per missed run, up to Scheduler.max_catchup times
+
+
+class LaunchCommand(object):
+    """
+    A 0-ary function executing a command.
+    This is a class rather than a closure, so that it can be pickled and sent to a process pool.
+    """
+    def __init__(self, cmd_splitted, stdin=None):
+        self.cmd_splitted = cmd_splitted
+        self.stdin = stdin
+
+    def __call__(self):
+        """
+        Start the command, without waiting for it; it is reaped by the default Launcher.
+        :return: a ProcessRecord
+        """
+        logger.info("Now running: " + str(self.cmd_splitted))
+        start = time.time()
+        record = _launcher.get_default().spawn(self.cmd_splitted, self.stdin)
+        _metrics.get_default().observe('pcrond_spawn_seconds', time.time() - start)
+        return record
+
+    def __repr__(self):
+        return "LaunchCommand(%r)" % (self.cmd_splitted,)
+
 
 def std_launch_func(cmd_splitted, stdin=None):
     """
-    Default way of executing commands is to invoke subprocess.run()
+    Default way of executing commands is to start them with the default Launcher
+    """
+    return LaunchCommand(cmd_splitted, stdin)
+
+
+def _takes_stdin(job_func_func):
+    """
+    :return: ``True`` if given job_func_func accepts the text to send to stdin, as a second argument
+    """
+    try:
+        from inspect import signature
+    except ImportError:
+        # Python 2
+        from inspect import getcallargs
+        try:
+            getcallargs(job_func_func, None, None)
+        except TypeError:
+            return False
+        return True
+    try:
+        signature(job_func_func).bind(None, None)
+    except TypeError:
+        return False
+    except ValueError:
+        # no signature available, es. for some builtins
+        return True
+    return True
+
+
+def _log_job_result(job, metrics, release, profiler=None):
+    """
+    :return: a callback for the future of given job, run by the executor when the job function terminates
+    :param release: called with the result of the job function, or None if it raised
+    :param profiler: if given, the run is recorded there, with wall time only
     """
-    if stdin is None:
-        def f():
-            logger.info("Now running: " + str(cmd_splitted))
-            from subprocess import Popen
-            Popen(cmd_splitted, stdin=None, stdout=None, stderr=None)
-            # not returning anything here
-    else:
-        def f():
-            logger.info("Now running: " + str(cmd_splitted))
-            from subprocess import Popen, PIPE
-            p = Popen(cmd_splitted, stdin=PIPE, stdout=None, stderr=None)
-            p.communicate(input=stdin)
-            # not returning anything here
+    start = time.time()
+
+    def record(error):
+        metrics.observe('pcrond_job_runtime_seconds', time.time() - start)
+        if profiler is not None:
+            profiler.record_run(job, time.time() - start, error=error)
+
+    def f(future):
+        exc = future.exception()
+        if exc is not None:
+            record(True)
+            logger.error("Job %s raised an exception: %s", job, exc,
+                         exc_info=(type(exc), exc, getattr(exc, '__traceback__', None)))
+            release(None)
+            return
+        # commands started in this process are recorded when they terminate
+        when_done(future.result(), lambda _: record(False))
+        release(future.result())
     return f
 
 
+def _is_process_pool(executor):
+    from concurrent.futures import ProcessPoolExecutor
+    return isinstance(executor, ProcessPoolExecutor)
+
+
 class Scheduler(object):
     """
     Objects instantiated by the :class:`Scheduler <Scheduler>` are
     factories to create jobs, keep record of scheduled jobs and
     handle their execution.
     """
-    def __init__(self):
-        self.delay = 60         # in seconds
-        self.jobs = []
-        self.ask_for_stop = False
+    def __init__(self, executor=None, max_workers=None, metrics=None):
+        """
+        Constructor
+        :param executor:
+            how job functions are executed: None (default) to run them in the thread calling
+            run_pending(), 'thread' or 'process' to run them in a pool owned by this Scheduler,
+            or any ``concurrent.futures.Executor``.
+            Job functions sent to a process pool must be picklable.
+        :param max_workers:
+            max number of jobs running in parallel, for 'thread' and 'process' executors
+        :param metrics:
+            where scheduling metrics are recorded, see pcrond.metrics; None for the default hook
+        """
+        self.delay = 60         # in seconds, max time main_loop() sleeps
+        self.jobs = JobStore()
+        self._own_executor = executor in ('thread', 'process')
+        if executor == 'thread':
+            from concurrent.futures import ThreadPoolExecutor
+            executor = ThreadPoolExecutor(max_workers=max_workers)
+        elif executor == 'process':
+            from concurrent.futures import ProcessPoolExecutor
+            executor = ProcessPoolExecutor(max_workers=max_workers)
+        self.executor = executor
+        # guards jobs, index and queue, which may be changed by other threads;
+        # the condition is notified whenever main_loop() should wake up and plan again
+        self._lock = threading.RLock()
+        self._wakeup = threading.Condition(self._lock)
+        self._changed = False
+        self._ask_for_stop = False
+        self.catchup = CATCHUP_SKIP
+        self.max_catchup = 60
+        # timestamp of the last minute evaluated by run_pending(), and jobs added since then
+        self._last_tick = None
+        self._fresh_jobs = []
+        # jobs loaded from crontab files, as {file: {(time zone name, line): [jobs]}}
+        self._sources = {}
+        self._watchers = []
+        # inverted indexes, used for finding jobs due at a given minute; one for each time zone,
+        # None being local time
+        self._indexes = {None: TimeIndex()}
+        # priority queue of [timestamp, sequence, job], ordered by next run time
+        # cancelled entries are not removed, instead their job is set to None
+        self._queue = []
+        self._queue_entries = {}
+        self._counter = itertools.count()
+        self._metrics = metrics
+        # a pcrond.profiling.Profiler, for per-job cost accounting
+        self.profiler = None
+        # concurrency caps: max number of running jobs, overall and for each group (see Job.set_overlap)
+        self.max_running = None
+        self.group_limits = {}
+        self._running_total = 0
+        self._running_groups = {}
+        # a pcrond.journal.Journal, see set_journal()
+        self.journal = None
+        # a pcrond.cluster.Coordinator, when this scheduler shares its jobs with other nodes
+        self.coordinator = None
+        # jobs wait a stable offset in [0, splay) seconds after their scheduled minute, see Job.splay_offset()
+        self.splay = 0
+        # heap of (timestamp, sequence, job, scheduled timestamp) of jobs waiting for their splay offset,
+        # or for their takeover delay in a cluster
+        self._delayed = []
+        # jobs whose run was postponed, with overlap policy OVERLAP_QUEUE, and their number of runs there
+        self._waiting = deque()
+        self._queued = {}
+
+    @property
+    def metrics(self):
+        """ the metrics hook of this scheduler, see pcrond.metrics """
+        return self._metrics if self._metrics is not None else _metrics.get_default()
+
+    @metrics.setter
+    def metrics(self, value):
+        self._metrics = value
+
+    @property
+    def ask_for_stop(self):
+        """ when set, main_loop() terminates as soon as possible """
+        return self._ask_for_stop
+
+    @ask_for_stop.setter
+    def ask_for_stop(self, value):
+        self._ask_for_stop = value
+        self._notify()
+
+    def stop(self):
+        """
+        Ask main_loop() to terminate. Running jobs are not stopped.
+        """
+        self.ask_for_stop = True
+        for watcher in self._watchers:
+            watcher.stop()
+        del self._watchers[:]
+        if self.journal is not None:
+            self.journal.flush()
+
+    def _notify(self):
+        """
+        Wake up main_loop(), so that it checks again for jobs to run and plans the next wakeup.
+        """
+        with self._wakeup:
+            self._changed = True
+            self._wakeup.notify_all()
+
+    def _enqueue(self, job, start_ts):
+        """
+        Put given job in the priority queue, according to its first run not before given timestamp.
+        Any previous entry of the same job is invalidated.
+        """
+        self._dequeue(job)
+        ts = _zones.next_fire(job.compiled, start_ts, job.tz)
+        if ts is not None:
+            entry = [ts, next(self._counter), job]
+            self._queue_entries[job] = entry
+            heapq.heappush(self._queue, entry)
+
+    def _dequeue(self, job):
+        """
+        Invalidate the priority queue entry of given job, if any.
+        """
+        entry = self._queue_entries.pop(job, None)
+        if entry is not None:
+            entry[-1] = None
+
+    @property
+    def next_run(self):
+        """
+        :return: the datetime of the next scheduled run, or None if no job is scheduled
+        """
+        while self._queue and self._queue[0][-1] is None:
+            heapq.heappop(self._queue)
+        if not self._queue:
+            return None
+        return datetime.fromtimestamp(self._queue[0][0])
+
+    @property
+    def idle_seconds(self):
+        """
+        :return: the number of seconds until the next scheduled run (may be negative),
+                 or None if no job is scheduled
+        """
+        next_run = self.next_run
+        if next_run is None:
+            return None
+        return _zones.timestamp(next_run) - time.time()
+
+    def _sleep_time(self):
+        """
+        :return: the number of seconds main_loop() should sleep before next run_pending()
+        """
+        idle = self.idle_seconds
+        if idle is None or idle > self.delay:
+            idle = self.delay
+        if self._delayed:
+            idle = min(idle, self._delayed[0][0] - time.time())
+        return max(idle, 0)
 
     def run_pending(self):
         """
@@ -47,11 +293,368 @@ class Scheduler(object):
         in one hour increments then your job won't be run 60 times in
         between but only once.
         """
-        logger.debug("available jobs: " + str(self.jobs))
-        runnable_jobs = (job for job in self.jobs if job.should_run())
-        logger.debug("runnable jobs: " + str(self.jobs))
+        self._run_pending_at(datetime.now())
+
+    def _run_pending_at(self, now):
+        """
+        Run all jobs that are scheduled to run at given datetime.
+        Each minute is evaluated only once, even if this method is called many times in a minute,
+        or if the clock goes backwards; but jobs added in the meantime are still run.
+        Jobs that missed their run since the previous call are handled according to self.catchup.
+        """
+        start = time.time()
+        metrics = self.metrics
+        now = now.replace(second=0, microsecond=0)
+        now_ts = _zones.timestamp(now)
+        with self._lock:
+            if self._last_tick is not None and now_ts <= self._last_tick:
+                runnable_jobs = [job for job in self._fresh_jobs
+                                 if job in self.jobs and job.compiled.matches(self._wall_time(job, now, now_ts))]
+                evaluated = len(self._fresh_jobs)
+            else:
+                (runnable_jobs, evaluated) = self._due_at(now, now_ts)
+                self._last_tick = now_ts
+            self._fresh_jobs = []
+            missed = self._advance_queue(now_ts)
+        if self.journal is not None:
+            # runs of jobs with seconds are checked one by one, by _plan_seconds()
+            runnable_jobs = [job for job in runnable_jobs
+                             if job.compiled.seconds is not None or not self._already_run(job, now_ts)]
+        metrics.observe('pcrond_tick_seconds', time.time() - start)
+        metrics.inc('pcrond_jobs_evaluated_total', evaluated)
+        logger.debug("runnable jobs: " + str(runnable_jobs))
+        self._start_waiting()
+        if missed:
+            logger.warning("%d jobs missed their run, catch-up policy is '%s'", len(missed), self.catchup)
+            self._catch_up(missed, now_ts)
+        fired = 0
         for job in runnable_jobs:
-            job.run()
+            offset = job.splay_offset(self.splay)
+            if self.coordinator is not None:
+                offset += self.coordinator.delay(self._run_key(job))
+            if job.compiled.seconds is not None:
+                self._plan_seconds(job, now_ts, offset)
+            elif offset > 0:
+                with self._lock:
+                    heapq.heappush(self._delayed, (now_ts + offset, next(self._counter), job, now_ts))
+            elif self._claim(job, now_ts) and self._admit(job):
+                metrics.observe('pcrond_lateness_seconds', time.time() - now_ts)
+                self._record_run(job, now_ts)
+                self._start(job)
+                fired += 1
+        metrics.inc('pcrond_jobs_fired_total', fired)
+        self._start_delayed(time.time())
+        if self.journal is not None:
+            self.journal.maybe_flush()
+
+    def _due_at(self, now, now_ts):
+        """
+        :param now: the local wall time at now_ts
+        :return: (the jobs due at given minute, in the order they were added, number of jobs evaluated);
+                 the minute is converted only once for each time zone in use
+        """
+        jobs = []
+        evaluated = 0
+        for (tz, index) in self._indexes.items():
+            if len(index):
+                jobs.extend(index.due_at(now_ts, tz, now if tz is None else None, self.profiler))
+                evaluated += index.evaluated
+        if len(self._indexes) > 1:
+            jobs.sort(key=lambda job: job.id)
+        return (jobs, evaluated)
+
+    def _wall_time(self, job, now, now_ts):
+        return now if job.tz is None else _zones.wall_time(now_ts, job.tz)
+
+    def _index_of(self, job):
+        index = self._indexes.get(job.tz)
+        if index is None:
+            index = self._indexes[job.tz] = TimeIndex()
+        return index
+
+    def set_journal(self, journal):
+        """
+        Keep track of job runs in given journal, so that after a restart missed runs are handled
+        according to self.catchup, and runs already done, including @reboot ones, are not repeated.
+        Jobs are identified by their pattern and key, see :class:`Job`.
+        :param journal: a pcrond.journal.Journal, or None
+        """
+        now_ts = time.time()
+        with self._lock:
+            self.journal = journal
+            for job in self.jobs:
+                self._enqueue(job, self._resume_time(job, now_ts))
+
+    def _run_key(self, job):
+        """
+        :return: a string identifying given job across restarts and nodes, for journal and leases
+        """
+        if job.is_reboot:
+            # the pattern of @reboot jobs changes at each restart
+            return '@reboot ' + job.key
+        return ' '.join(job.compiled.pattern) + ' ' + job.key
+
+    def _resume_time(self, job, now_ts):
+        """
+        :return: the timestamp from which the runs of given job should be planned:
+                 the minute after its last run, if known from the journal, else given timestamp
+        """
+        if self.journal is None or job.is_reboot:
+            return now_ts
+        last_run = self.journal.last_run(self._run_key(job))
+        if last_run is None:
+            return now_ts
+        return last_run + 60
+
+    def _already_run(self, job, ts):
+        """
+        :return: ``True`` if the journal says that given job already ran for given timestamp,
+                 or since the last boot if it is a @reboot job
+        """
+        last_run = self.journal.last_run(self._run_key(job))
+        if last_run is None:
+            return False
+        if job.is_reboot:
+            booted = boot_time()
+            return booted is not None and last_run >= booted
+        return last_run >= ts
+
+    def _record_run(self, job, ts):
+        if self.journal is not None:
+            self.journal.record(self._run_key(job), ts)
+
+    def _plan_seconds(self, job, now_ts, offset):
+        """
+        Put the runs of given job, that has a seconds field, in the minute of given timestamp, among the
+        delayed ones; so main_loop() wakes up on each due second, while minute-only jobs need no more wakeups.
+        Seconds already past, es. because the minute was evaluated late, and runs already in the journal
+        are skipped.
+        """
+        late = time.time() - 1
+        last_run = self.journal.last_run(self._run_key(job)) if self.journal is not None else None
+        with self._lock:
+            for second in job.compiled.seconds:
+                fire_ts = now_ts + second
+                if fire_ts + offset < late or (last_run is not None and fire_ts <= last_run):
+                    continue
+                heapq.heappush(self._delayed, (fire_ts + offset, next(self._counter), job, fire_ts))
+
+    def _claim(self, job, fire_ts):
+        """
+        :return: ``True`` if this node should run given job, scheduled at given timestamp:
+                 always, unless there is a coordinator and another node took the run
+        """
+        if self.coordinator is None:
+            return True
+        if not self.coordinator.claim(self._run_key(job), fire_ts):
+            logger.debug("Job %s was run by another node", job)
+            return False
+        return True
+
+    def _start_delayed(self, now_ts):
+        """
+        Start the delayed jobs whose time has come: runs of jobs with seconds, and jobs delayed
+        by splay or by takeover delay.
+        :param now_ts: the current timestamp
+        """
+        due = []
+        with self._lock:
+            while self._delayed and self._delayed[0][0] <= now_ts:
+                (ts, _, job, fire_ts) = heapq.heappop(self._delayed)
+                if job in self.jobs:
+                    due.append((ts, job, fire_ts))
+        fired = 0
+        for (ts, job, fire_ts) in due:
+            if self._claim(job, fire_ts) and self._admit(job):
+                self.metrics.observe('pcrond_lateness_seconds', time.time() - ts)
+                self._record_run(job, fire_ts)
+                self._start(job)
+                fired += 1
+        if fired:
+            self.metrics.inc('pcrond_jobs_fired_total', fired)
+
+    def _catch_up(self, missed, now_ts):
+        """
+        Run jobs that missed their run, according to self.catchup
+        :param missed: list of (job, timestamp of first missed run)
+        """
+        if self.catchup == CATCHUP_SKIP:
+            return
+        for (job, when) in missed:
+            # in a cluster, the first missed run is claimed like a normal one
+            if not self._claim(job, when):
+                continue
+            count = 1
+            if self.catchup == CATCHUP_ALL:
+                when = _zones.next_fire(job.compiled, when + 60, job.tz)
+                while count < self.max_catchup and when is not None and when < now_ts:
+                    count += 1
+                    when = _zones.next_fire(job.compiled, when + 60, job.tz)
+            logger.info("Catching up job %s, %d times", job, count)
+            # all runs before now are done
+            self._record_run(job, now_ts - 1)
+            for _ in range(count):
+                self._dispatch(job)
+
+    def _dispatch(self, job):
+        """
+        Run given job, according to its overlap policy and the concurrency caps.
+        If this Scheduler has an executor, the job is only submitted to it.
+        :return: ``True`` if the job was started
+        """
+        if not self._admit(job):
+            return False
+        self._start(job)
+        return True
+
+    def _has_capacity(self, group):
+        """
+        :return: ``True`` if the concurrency caps allow one more job of given group to run
+        """
+        if self.max_running is not None and self._running_total >= self.max_running:
+            return False
+        limit = self.group_limits.get(group) if group is not None else None
+        return limit is None or self._running_groups.get(group, 0) < limit
+
+    def _admit(self, job):
+        """
+        Decide whether given job can start now. If so, mark it as running;
+        else, queue or skip the run, according to its overlap policy.
+        :return: ``True`` if the job can start
+        """
+        policy = job.overlap
+        with self._lock:
+            if policy.mode == OVERLAP_KILL and job.running:
+                job._kill_running()
+            if job._blocked() or not self._has_capacity(policy.group):
+                queued = self._queued.get(job, 0)
+                if policy.mode == OVERLAP_QUEUE and queued < policy.max_queued:
+                    logger.info("Job %s is queued", job)
+                    self._queued[job] = queued + 1
+                    self._waiting.append(job)
+                else:
+                    logger.info("Job %s is skipped, because %s", job,
+                                "it is still running" if job._blocked() else "too many jobs are running")
+                    self.metrics.inc('pcrond_jobs_skipped_total')
+                return False
+            self._take(job)
+            return True
+
+    def _take(self, job):
+        job._begin()
+        self._running_total += 1
+        group = job.overlap.group
+        if group is not None:
+            self._running_groups[group] = self._running_groups.get(group, 0) + 1
+
+    def _release(self, job):
+        """
+        Mark an instance of given job as terminated.
+        Queued runs are started by the next run_pending(), so that jobs always start in the same thread.
+        """
+        with self._lock:
+            job._end()
+            self._running_total -= 1
+            group = job.overlap.group
+            if group is not None:
+                self._running_groups[group] -= 1
+            waiting = bool(self._waiting)
+        if waiting:
+            self._notify()
+
+    def _start_waiting(self):
+        """
+        Start queued runs, as long as overlap policies and caps allow.
+        """
+        started = []
+        with self._lock:
+            still_waiting = deque()
+            while self._waiting:
+                job = self._waiting.popleft()
+                if job not in self.jobs:
+                    self._queued.pop(job, None)
+                elif job._blocked() or not self._has_capacity(job.overlap.group):
+                    still_waiting.append(job)
+                else:
+                    self._queued[job] -= 1
+                    if not self._queued[job]:
+                        del self._queued[job]
+                    self._take(job)
+                    started.append(job)
+            self._waiting = still_waiting
+        for job in started:
+            self._start(job)
+
+    def _start(self, job):
+        """
+        Run given job, already marked as running by _admit().
+        If this Scheduler has an executor, the job is only submitted to it.
+        Exceptions raised by the job function are logged, so that other jobs and main_loop() go on.
+        """
+        if self.executor is None:
+            try:
+                result = job._call()
+            except Exception as e:
+                self._release(job)
+                logger.exception("Job %s raised an exception: %s", job, e)
+                return
+            except BaseException:
+                self._release(job)
+                raise
+            job._finish_when_done(result, lambda result: self._release(job))
+            return
+        logger.info('Submitting job %s', job)
+        profiler = self.profiler
+        # a Profiler cannot be sent to other processes, there only wall time is measured
+        remote = profiler is not None and _is_process_pool(self.executor)
+        try:
+            if profiler is not None and not remote:
+                future = self.executor.submit(profiler.call, job, job.job_func)
+            else:
+                future = self.executor.submit(job.job_func)
+        except Exception:
+            self._release(job)
+            raise
+
+        def release(result):
+            job._finish_when_done(result, lambda result: self._release(job))
+        future.add_done_callback(_log_job_result(job, self.metrics, release, profiler if remote else None))
+
+    def shutdown(self, wait=True):
+        """
+        Release the executor, if it was created by this Scheduler.
+        :param wait: wait for running jobs to terminate
+        """
+        if self._own_executor:
+            self.executor.shutdown(wait=wait)
+
+    def get_job(self, job_id):
+        """
+        :return: the job with given id, or None
+        """
+        return self.jobs.get(job_id)
+
+    def jobs_at(self, when):
+        """
+        :return: the list of jobs due at given local datetime, in the order they were added;
+                 jobs with a time zone are matched at the same instant, in their zone
+        """
+        return self._due_at(when, _zones.timestamp(when.replace(second=0, microsecond=0)))[0]
+
+    def _advance_queue(self, now_ts):
+        """
+        Reschedule all jobs in the priority queue due not after the minute of given timestamp.
+        :return: the list of (job, timestamp) of jobs that were due before that minute, i.e. missed
+        """
+        missed = []
+        while self._queue and self._queue[0][0] <= now_ts:
+            (ts, _, job) = heapq.heappop(self._queue)
+            if job is not None:
+                del self._queue_entries[job]
+                if ts < now_ts:
+                    missed.append((job, ts))
+                self._enqueue(job, now_ts + 60)
+        return missed
 
     def run_all(self, delay_seconds=0):
         """
@@ -63,7 +666,7 @@ class Scheduler(object):
         """
         logger.info('Running *all* %i jobs with %is delay inbetween',
                     len(self.jobs), delay_seconds)
-        for job in self.jobs[:]:
+        for job in list(self.jobs):
             job.run()
             time.sleep(delay_seconds)
 
@@ -71,7 +674,17 @@ class Scheduler(object):
         """
         Deletes scheduled jobs
         """
-        del self.jobs[:]
+        with self._lock:
+            self.jobs.clear()
+            del self._fresh_jobs[:]
+            self._sources.clear()
+            self._indexes = {None: TimeIndex()}
+            del self._queue[:]
+            self._queue_entries.clear()
+            self._waiting.clear()
+            self._queued.clear()
+            del self._delayed[:]
+        self._notify()
         logger.info("jobs cleared")
 
     def cancel_job(self, job):
@@ -80,112 +693,234 @@ class Scheduler(object):
         If the job is running it won't be stopped.
         :param job: The job to be unscheduled
         """
-        try:
+        with self._lock:
             self.jobs.remove(job)
-        except ValueError:
-            pass
+            self._index_of(job).remove(job)
+            self._dequeue(job)
+        self._notify()
 
-    def cron(self, crontab, job_func):
+    def cron(self, crontab, job_func, key=None, tz=None):
         """
         Create a job and add it to this Scheduler
         :param crontab:
             string containing crontab pattern
             Its tokens may be either: 1 (if alias), 5 (without year token),
-            6 (with year token)
+            6 (with year token), 7 (with seconds token first, and year token)
         :param job_func:
             the job 0-ary function to run
+        :param key:
+            a string identifying the job, see :class:`Job`
+        :param tz:
+            the time zone of the pattern, see :class:`Job`
         :return: a Job
         """
-        job = Job(crontab, job_func, self)
-        self.jobs.append(job)
+        job = Job(crontab, job_func, self, key, tz)
+        self._add_jobs([job])
         return job
 
-    def _load_crontab_line(self, rownum, crontab_line, job_func_func=std_launch_func, stdin=None):
+    def _add_jobs(self, jobs):
         """
-        create a Job from a single crontab entry, and add it to this Scheduler
-        :param crontab_line:
-            a line from crontab
-            PRE: not empty and it not a comment
-        :param job_func_func:
-            function to be executed, @see load_crontab_file
-        :return: a Job
+        Add given jobs to this Scheduler
         """
-        pieces = crontab_line.split()
-
-        if pieces[0] in ALIASES.keys():
-            try:
-                # CASE 1 - pattern using alias
-                job = self.cron(pieces[0], job_func_func(pieces[1:]))
-                return job
-            except ValueError as e:
-                # shouldn't happen
-                logger.error(("Error at line %d, cannot parse pattern, the line will be ignored.\r\n" +
-                              "Inner Exception: %s") % (rownum, str(e)))
-                return None
-        if len(pieces) < 6:
-            logger.error("Error at line %d, expected at least 6 tokens" % rownum)
-            return None
-        if len(pieces) >= 7:
-            try:
-                # CASE 2 - pattern including year
-                job = self.cron(" ".join(pieces[0:6]), job_func_func(pieces[6:]))
-                return job
-            except ValueError:
-                pass
-        try:
-            # CASE 3 - pattern not including  year
-            job = self.cron(" ".join(pieces[0:5]), job_func_func(pieces[5:]))
-            return job
-        except ValueError as e:
-            logger.error(("Error at line %d, cannot parse pattern, the line will be ignored.\r\n" +
-                          "Inner Exception: %s") % (rownum, str(e)))
-            return None
+        now_ts = time.time()
+        with self._lock:
+            for job in jobs:
+                job.scheduler = self
+                self.jobs.add(job)
+                if job._key is None and job.compiled is not None and job.compiled.seed is not None:
+                    # the default key includes the id, so H tokens are chosen again
+                    job._set_schedule(compile_crontab(job.compiled.pattern, job.key))
+                self._index_of(job).add(job)
+                self._fresh_jobs.append(job)
+                self._enqueue(job, self._resume_time(job, now_ts))
+        self._notify()
 
     def _split_input_line(self, s):
         """
         Command is split in command and stdin using %, not %%
         :return: two strings, command and stdin
         """
-        # s == aaaa%%bbbbbb%cccc%dd%%ee
-        pieces = [x.split('%') for x in s.split('%%')]
-        # pieces == [[aaaa],[bbbbbb,cccc,dd],[ee]]
-        rejoin = "%".join(["\n".join(x) for x in pieces])
-        # rejoin == aaaa%bbbbbb\ncccc\ndd%ee
-        return rejoin.split('\n', 1)
-        # lines == [aaaa%bbbbbb,ccc\ndd%ee]
+        return split_input_line(s)
 
-    def load_crontab_file(self, crontab_file, clear=True, job_func_func=std_launch_func):
+    def load_crontab_file(self, crontab_file, clear=True, job_func_func=std_launch_func, incremental=False):
         """
         Read crontab file, create corresponding jobs in this scheduler
         :param crontab_file:
             crontab file path
         :param job_func_func:
-            a function that takes a list of tokens (from crontab file) and
-            returns a 0-args function
+            a function that takes a list of tokens (from crontab file), and returns a 0-args function.
+            If it accepts a second argument, it gets there the text to send to stdin, when the line has one.
+        :param clear:
+            should the new schedule override the previous ones?
+        :param incremental:
+            if True, compare the file with the jobs previously loaded from the same file:
+            only new lines are parsed, jobs of removed lines are cancelled, and jobs of unchanged lines
+            are kept as they are, including their running state. Jobs not coming from this file are kept too.
+            The clear parameter is ignored.
+        """
+        crontab_file = os.path.abspath(crontab_file)
+        (start, cpu) = (time.time(), _profiling.thread_time())
+        if incremental:
+            self._reload_crontab_file(crontab_file, job_func_func)
+        else:
+            report = self.bulk_load(crontab_file, job_func_func, clear, processes=1)
+            for error in report.errors:
+                logger.error("Error at line %d, the line will be ignored: %s", error.rownum, error.message)
+            logger.info(str(len(self.jobs)) + " jobs loaded from configuration file")
+        if self.profiler is not None:
+            self.profiler.record_load(crontab_file, len(self.jobs), time.time() - start,
+                                      _profiling.thread_time() - cpu)
+
+    def bulk_load(self, source, job_func_func=std_launch_func, clear=False, processes=None, chunksize=1000):
+        """
+        Load a whole crontab, create corresponding jobs in this scheduler.
+        Lines are read and parsed lazily, in blocks of loader.BLOCK_LINES; each distinct pattern
+        of a block is parsed only once, possibly in parallel worker processes.
+        :param source:
+            a crontab file path, a file-like object (also a mmap), or any iterable of lines
+        :param job_func_func:
+            a function that takes a list of tokens (from crontab file), and returns a 0-args function.
+            If it accepts a second argument, it gets there the text to send to stdin, when the line has one.
         :param clear:
             should the new schedule override the previous ones?
+        :param processes:
+            number of worker processes, None for one per CPU, 1 for parsing in this process
+        :param chunksize:
+            number of patterns sent to a worker at once; no workers are used for fewer patterns
+        :return: a LoadReport, with the list of jobs created and the list of LoadError
         """
+        crontab_file = None
+        if isinstance(source, str):
+            source = crontab_file = os.path.abspath(source)
+        return self._load_lines(crontab_file, iter_crontab_lines(source), job_func_func, clear, processes, chunksize)
+
+    def _load_lines(self, crontab_file, numbered_lines, job_func_func, clear=False, processes=1, chunksize=1000):
+        """
+        Create jobs from given (rownum, line), and keep track of the file they come from.
+        :return: a LoadReport
+        """
+        errors = []
+        loaded = []
+        takes_stdin = _takes_stdin(job_func_func)
+        for entry in iter_crontab_entries(numbered_lines, processes, chunksize):
+            if isinstance(entry, LoadError):
+                errors.append(entry)
+                continue
+            try:
+                if entry.stdin is None or not takes_stdin:
+                    job_func = job_func_func(entry.command)
+                else:
+                    job_func = job_func_func(entry.command, entry.stdin)
+                job = Job(None, job_func, self, entry.key, entry.tz)
+            except ValueError as e:
+                errors.append(LoadError(entry.rownum, entry.line, str(e)))
+                continue
+            job._set_schedule(entry.pattern)
+            loaded.append(((entry.tz, entry.line), job))
+        jobs = [job for (_, job) in loaded]
         if clear:
             self.clear()
-        with open(crontab_file) as fp:
-            for rownum, line in enumerate(fp):
-                if line is not None:                  # not sure if this can happen
-                    line = line.strip()
-                    if line != "" and line[0] != "#":
-                        # skip empty lines and comments
-                        pieces = self._split_input_line(line)
-                        stdin = pieces[1] if len(pieces) > 1 else None
-                        self._load_crontab_line(rownum, pieces[0], job_func_func, stdin)
-                        # TODO support % sign inside command, should consider pieces[1] if any
-        logger.info(str(len(self.jobs)) + " jobs loaded from configuration file")
+        self._add_jobs(jobs)
+        if crontab_file is not None:
+            with self._lock:
+                lines = self._sources.setdefault(crontab_file, {})
+                for (line, job) in loaded:
+                    lines.setdefault(line, []).append(job)
+        return LoadReport(jobs, errors)
+
+    def _reload_crontab_file(self, crontab_file, job_func_func):
+        """
+        Incremental version of load_crontab_file()
+        """
+        entries = list(iter_crontab_lines(crontab_file))
+        with self._lock:
+            old = self._sources.pop(crontab_file, {})
+            # jobs may have been cancelled in the meantime
+            old = dict((line, [job for job in jobs if job in self.jobs]) for (line, jobs) in old.items())
+            kept = {}
+            to_load = []
+            tz = None
+            for rownum, line in entries:
+                zone = cron_tz(line)
+                if zone is not None:
+                    # lines loaded again need their time zone
+                    to_load.append((rownum, line))
+                    try:
+                        _zones.get_zone(zone or None)
+                        tz = zone or None
+                    except ValueError:
+                        pass
+                    continue
+                jobs = old.get((tz, line))
+                if jobs:
+                    kept.setdefault((tz, line), []).append(jobs.pop(0))
+                else:
+                    to_load.append((rownum, line))
+            self._sources[crontab_file] = kept
+        removed = [job for jobs in old.values() for job in jobs]
+        for job in removed:
+            self.cancel_job(job)
+        report = self._load_lines(crontab_file, to_load, job_func_func)
+        for error in report.errors:
+            logger.error("Error at line %d, the line will be ignored: %s", error.rownum, error.message)
+        logger.info("%s reloaded: %d jobs added, %d removed, %d unchanged", crontab_file, len(report.jobs),
+                    len(removed), sum(len(jobs) for jobs in kept.values()))
+
+    def unload_crontab_file(self, crontab_file):
+        """
+        Cancel the jobs loaded from given crontab file. Jobs not coming from this file are kept.
+        :return: the number of jobs cancelled
+        """
+        crontab_file = os.path.abspath(crontab_file)
+        with self._lock:
+            lines = self._sources.pop(crontab_file, {})
+        removed = [job for jobs in lines.values() for job in jobs if job in self.jobs]
+        for job in removed:
+            self.cancel_job(job)
+        logger.info("%s unloaded: %d jobs removed", crontab_file, len(removed))
+        return len(removed)
+
+    def watch_crontab_file(self, crontab_file, job_func_func=std_launch_func, interval=5):
+        """
+        Reload given crontab file incrementally whenever it changes.
+        Changes are detected with inotify on Linux, or else by polling its mtime every `interval` seconds.
+        The file is not loaded now, see load_crontab_file().
+        Watchers are stopped by stop().
+        :return: the FileWatcher
+        """
+        def reload():
+            try:
+                self.load_crontab_file(crontab_file, job_func_func=job_func_func, incremental=True)
+            except (IOError, OSError) as e:
+                logger.error("Cannot reload %s: %s", crontab_file, e)
+
+        watcher = FileWatcher(crontab_file, reload, interval)
+        self._watchers.append(watcher)
+        watcher.start()
+        return watcher
 
     def main_loop(self):
         """
         Perform main run-and-wait loop.
+        Sleep until the next scheduled run, or until jobs are added or removed, or stop() is called.
+        Each wakeup is planned from the wall clock, and waited for on the monotonic clock.
         """
-        import time
         while not self.ask_for_stop:
             self.run_pending()
-            time.sleep(self.delay)
-            # FIXME this will look at self.ask_for_stop only every self.delay seconds
-            # see https://stackoverflow.com/questions/5114292/break-interrupt-a-time-sleep-in-python
+            self._wait(self._sleep_time())
+
+    def _wait(self, seconds):
+        """
+        Sleep for given seconds, measured on the monotonic clock, or until _notify() is called,
+        so that adjustments of the wall clock neither stretch nor shorten the wait.
+        Waits last at most self.delay seconds (see _sleep_time()), then the next one is planned
+        from the wall clock again: a jump of the wall clock is noticed within that time.
+        """
+        deadline = _monotonic() + seconds
+        with self._wakeup:
+            while not self._changed and not self.ask_for_stop:
+                remaining = deadline - _monotonic()
+                if remaining <= 0:
+                    break
+                self._wakeup.wait(remaining)
+            self._changed = False
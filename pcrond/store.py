@@ -0,0 +1,67 @@
+import itertools
+import sys
+
+
+class JobStore(object):
+    """
+    The jobs of a :class:`Scheduler`, indexed by a stable integer id.
+    Adding, removing and looking up a job take constant time.
+    Iteration follows the order jobs were added.
+    """
+    def __init__(self):
+        self._jobs = {}
+        self._ids = itertools.count(1)
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def __iter__(self):
+        return iter(list(self._jobs.values()))
+
+    def __contains__(self, job):
+        return self._jobs.get(job.id) is job
+
+    def __repr__(self):
+        return "JobStore(%r)" % list(self._jobs.values())
+
+    def add(self, job):
+        """
+        Store given job, assigning it a new id.
+        """
+        job.id = next(self._ids)
+        self._jobs[job.id] = job
+
+    def remove(self, job):
+        """
+        Remove given job, if present.
+        :return: ``True`` if the job was present
+        """
+        if job not in self:
+            return False
+        del self._jobs[job.id]
+        return True
+
+    def get(self, job_id):
+        """
+        :return: the job with given id, or None
+        """
+        return self._jobs.get(job_id)
+
+    def clear(self):
+        self._jobs.clear()
+
+    def memory_usage(self):
+        """
+        Estimate the memory used by stored jobs, in bytes.
+        CompiledSchedules shared by many jobs are counted once; job functions are not counted.
+        :return: a tuple (total bytes, bytes per job)
+        """
+        total = sys.getsizeof(self._jobs)
+        schedules = {}
+        for job in self._jobs.values():
+            total += sys.getsizeof(job)
+            if job.compiled is not None:
+                schedules[id(job.compiled)] = job.compiled
+        for schedule in schedules.values():
+            total += sys.getsizeof(schedule)
+        return (total, total // len(self._jobs) if self._jobs else 0)
@@ -0,0 +1,134 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import threading
+
+logger = logging.getLogger('pcrond')
+
+# from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+def _inotify_libc():
+    """
+    :return: the C library, if it supports inotify, else None
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+def _file_signature(path):
+    """
+    :return: something that changes whenever the file is modified or replaced, or None if it does not exist
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime)
+
+
+class FileWatcher(object):
+    """
+    Call a function whenever a file changes, from a background thread.
+    Uses inotify where available, i.e. on Linux, else polls the file mtime.
+    The containing directory is watched, so that files replaced by rename (as editors do) are detected.
+    """
+    def __init__(self, path, callback, interval=5, use_inotify=True):
+        """
+        Constructor
+        :param path: the file to watch
+        :param callback: 0-ary function called on changes
+        :param interval: polling interval in seconds, also max delay for noticing stop()
+        :param use_inotify: set to False to force polling
+        """
+        self.path = os.path.abspath(path)
+        self.callback = callback
+        self.interval = interval
+        self._libc = _inotify_libc() if use_inotify else None
+        self._stop = threading.Event()
+        self._thread = None
+        self._signature = _file_signature(self.path)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="pcrond-watch")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, wait=False):
+        self._stop.set()
+        if wait and self._thread is not None:
+            self._thread.join()
+
+    def _changed(self):
+        """
+        Call the callback, if the file really changed.
+        """
+        signature = _file_signature(self.path)
+        if signature is None or signature == self._signature:
+            return
+        self._signature = signature
+        logger.info("%s changed", self.path)
+        try:
+            self.callback()
+        except Exception as e:
+            logger.error("Error while handling change of %s: %s", self.path, e)
+
+    def _run(self):
+        fd = self._inotify_fd()
+        if fd is None:
+            self._poll()
+        else:
+            try:
+                self._watch(fd)
+            finally:
+                os.close(fd)
+
+    def _poll(self):
+        while not self._stop.wait(self.interval):
+            self._changed()
+
+    def _inotify_fd(self):
+        """
+        :return: an inotify file descriptor watching the directory of the file, or None
+        """
+        if self._libc is None:
+            return None
+        fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            return None
+        directory = os.path.dirname(self.path).encode()
+        if self._libc.inotify_add_watch(fd, directory, IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            logger.warning("Cannot watch %s with inotify, polling instead", directory)
+            os.close(fd)
+            return None
+        return fd
+
+    def _watch(self, fd):
+        name = os.path.basename(self.path).encode()
+        while not self._stop.is_set():
+            (readable, _, _) = select.select([fd], [], [], self.interval)
+            if not readable:
+                continue
+            data = os.read(fd, 65536)
+            pos = 0
+            found = False
+            while pos + _EVENT_HEADER.size <= len(data):
+                (_, _, _, length) = _EVENT_HEADER.unpack_from(data, pos)
+                pos += _EVENT_HEADER.size
+                found = found or data[pos:pos + length].rstrip(b'\0') == name
+                pos += length
+            if found:
+                self._changed()
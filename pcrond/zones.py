@@ -0,0 +1,133 @@
+"""
+Time zone support.
+
+Patterns are matched against the wall clock time of the zone of each job; None stands for local time.
+Around DST transitions:
+
+- when the clock jumps forward, jobs due in the skipped minutes run once, right after the jump,
+  unless they run at least hourly (i.e. their hour field is '*'): these just skip the missing minutes;
+- when the clock goes back, the repeated minutes run jobs the first time; the second time,
+  only jobs running at least hourly run again.
+"""
+
+import time
+from datetime import datetime, timedelta
+from .compiled import to_mask
+
+try:
+    from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+except ImportError:
+    try:
+        from backports.zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+    except ImportError:
+        ZoneInfo = None
+
+ONE_MINUTE = timedelta(minutes=1)
+ALL_HOURS = to_mask(None, 0, 23)
+
+_zones = {}
+
+# datetime.fold exists since Python 3.6
+_HAS_FOLD = hasattr(datetime.min, 'fold')
+
+
+def with_fold(wall, fold):
+    """
+    :return: given naive datetime, with given fold attribute where supported
+    """
+    return wall.replace(fold=fold) if _HAS_FOLD else wall
+
+
+def get_zone(zone):
+    """
+    :param zone: a time zone name, such as 'Europe/Rome', or a tzinfo, or None for local time
+    :return: a tzinfo, or None for local time
+    :raise ValueError: if the zone is unknown, or time zones are not supported
+    """
+    if zone is None or not isinstance(zone, str):
+        return zone
+    tz = _zones.get(zone)
+    if tz is None:
+        if ZoneInfo is None:
+            raise ValueError("time zones require the zoneinfo module (Python 3.9+, or backports.zoneinfo)")
+        try:
+            tz = _zones[zone] = ZoneInfo(zone)
+        except (ZoneInfoNotFoundError, ValueError):
+            raise ValueError("unknown time zone: %s" % zone)
+    return tz
+
+
+def wall_time(ts, tz=None):
+    """
+    :return: the naive datetime shown by the clocks of given zone at given timestamp;
+             its fold attribute is 1 the second time a wall time is shown, after the clock went back
+    """
+    if tz is None:
+        return datetime.fromtimestamp(ts)
+    return datetime.fromtimestamp(ts, tz).replace(tzinfo=None)
+
+
+def timestamp(wall, tz=None):
+    """
+    :return: the timestamp of a naive wall time of given zone, according to its fold attribute
+    """
+    if tz is not None:
+        return wall.replace(tzinfo=tz).timestamp()
+    try:
+        return wall.timestamp()
+    except AttributeError:
+        # Python 2, fold is not supported
+        return time.mktime(wall.timetuple())
+
+
+def is_hourly(compiled):
+    """
+    :return: ``True`` if given CompiledSchedule runs at least hourly, i.e. its hour field is '*'
+    """
+    return compiled.hour_mask == ALL_HOURS
+
+
+def _after_gap(ts_before, ts_after, wall, tz):
+    """
+    :return: the first minute after the jump of the clock that skipped given wall time,
+             which is shown neither at ts_before nor at ts_after
+    """
+    (lo, hi) = (int(ts_before), int(ts_after))
+    while hi - lo > 60:
+        mid = lo + (hi - lo) // 120 * 60
+        if wall_time(mid, tz) > wall:
+            hi = mid
+        else:
+            lo = mid
+    return hi
+
+
+def next_fire(compiled, start_ts, tz=None):
+    """
+    Compute the first run, not before the minute of given timestamp, of a CompiledSchedule in given zone.
+    The second pass of hourly jobs through a repeated hour may be predicted too late;
+    TimeIndex.due_at() finds those runs anyway.
+    :return: a timestamp, or None if the pattern won't match anymore
+    """
+    start_ts -= start_ts % 60
+    hourly = is_hourly(compiled)
+    wall = with_fold(wall_time(start_ts, tz), 0)
+    while True:
+        match = compiled.next_match(wall)
+        if match is None:
+            return None
+        ts = timestamp(match, tz)
+        if wall_time(ts, tz) != match:
+            # skipped by a jump forward
+            if not hourly:
+                ts = _after_gap(timestamp(with_fold(match, 1), tz), ts, match, tz)
+                if ts >= start_ts:
+                    return ts
+        elif ts >= start_ts:
+            return ts
+        elif hourly:
+            # maybe shown again, after the clock went back
+            ts = timestamp(with_fold(match, 1), tz)
+            if ts >= start_ts:
+                return ts
+        wall = match + ONE_MINUTE
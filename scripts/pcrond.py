@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 
 import logging
+import os
+import sys
 
 VERSION = "1.0"
 logger = logging.getLogger()
@@ -12,15 +14,93 @@ def parse_args():
     parser.add_argument('-r', '--crontabfile',
                         help='the crontab file (default ~/.local/crontab)',
                         default='~/.local/crontab')
+    parser.add_argument('-d', '--crontabdir',
+                        help='run all crontab files in this directory, one per user, instead of --crontabfile')
+    parser.add_argument('--shards', type=int,
+                        help='with --crontabdir, number of scheduler processes (default one per CPU)')
     parser.add_argument('-l', '--logfile',
                         help='the log file (default ~/.local/pcrond.log)',
                         default='~/.local/pcrond.log')
     parser.add_argument('-v', '--version', action='store_true', help='print version then exit')
     parser.add_argument('-x', '--debug', action='store_true', help='enable debug logging')
+    parser.add_argument('--metrics-port', type=int,
+                        help='serve Prometheus metrics on this port of localhost')
+    parser.add_argument('--metrics-file',
+                        help='periodically write Prometheus metrics to this file')
+    parser.add_argument('-o', '--output',
+                        help='append the output of commands to this file (default: inherit it)')
+    parser.add_argument('-j', '--journal',
+                        help='remember job runs in this file, so that restarts do not miss or repeat them')
+    parser.add_argument('-c', '--catchup', choices=['skip', 'once', 'all'], default='skip',
+                        help='what to do with runs missed while pcrond was not running (default skip)')
+    parser.add_argument('--node',
+                        help='name of this node, when the same crontab runs on several nodes (default hostname)')
+    parser.add_argument('--nodes',
+                        help='comma-separated names of all nodes sharing the crontab; each job runs on one of them')
+    parser.add_argument('--leases',
+                        help='with --nodes, where nodes record job runs: a directory, or else a SQLite database')
+    parser.add_argument('--splay', type=float, default=0,
+                        help='spread jobs over this many seconds after their scheduled minute (default 0)')
+    parser.add_argument('--profile',
+                        help='collect per-job costs, and write them to this JSON file on SIGUSR1')
     args = parser.parse_args()
+    if args.crontabdir is not None:
+        # shards are separate processes: they cannot share a journal, a profile or the metrics of this process
+        unsupported = [option for (option, value) in (('--metrics-port', args.metrics_port),
+                                                      ('--metrics-file', args.metrics_file),
+                                                      ('--journal', args.journal), ('--nodes', args.nodes),
+                                                      ('--profile', args.profile))
+                       if value is not None]
+        if unsupported:
+            parser.error("%s cannot be used with --crontabdir" % ", ".join(unsupported))
     return args
 
 
+def parse_time(text):
+    from datetime import datetime
+    for fmt in ("%Y-%m-%d %H:%M", "%Y-%m-%dT%H:%M", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(text, fmt)
+        except ValueError:
+            pass
+    raise ValueError("expected YYYY-MM-DD [HH:MM]: %s" % text)
+
+
+def preview_main(argv):
+    """
+    Print the runs of the jobs of a crontab file, or its busiest minutes, without running anything.
+    """
+    import argparse
+    from datetime import datetime, timedelta
+    from pcrond import Scheduler
+    from pcrond.preview import histogram, peaks, preview
+    parser = argparse.ArgumentParser(prog='pcrond.py preview',
+                                     description='Show when the jobs of a crontab file would run.')
+    parser.add_argument('-r', '--crontabfile',
+                        help='the crontab file (default ~/.local/crontab)',
+                        default='~/.local/crontab')
+    parser.add_argument('--start', type=parse_time,
+                        help='beginning of the window, as YYYY-MM-DD [HH:MM] (default now)')
+    parser.add_argument('--days', type=float, default=1,
+                        help='length of the window in days (default 1)')
+    parser.add_argument('--peaks', type=int, metavar='N',
+                        help='instead of the runs, print the N minutes with most runs')
+    args = parser.parse_args(argv)
+    start = args.start or datetime.now().replace(second=0, microsecond=0)
+    end = start + timedelta(days=args.days)
+    report = Scheduler().bulk_load(os.path.expanduser(args.crontabfile))
+    for error in report.errors:
+        sys.stderr.write("Error at line %d, the line will be ignored: %s\n" % (error.rownum, error.message))
+    if args.peaks is not None:
+        counts = histogram(report.jobs, start, end)
+        print("%d runs, %d minutes with runs" % (sum(counts), sum(1 for n in counts if n)))
+        for (when, n) in peaks(counts, start, args.peaks):
+            print("%s %6d" % (when.strftime("%Y-%m-%d %H:%M"), n))
+    else:
+        for (when, job) in preview(report.jobs, start, end):
+            print("%s %s" % (when.strftime("%Y-%m-%d %H:%M:%S"), " ".join(job.job_func.cmd_splitted)))
+
+
 def setup_logger(args):             # HOPE this affects modules too
     logginglevel = logging.DEBUG if args.debug else logging.INFO
     handler = logging.handlers.RotatingFileHandler(filename=args.logfile,
@@ -31,12 +111,60 @@ def setup_logger(args):             # HOPE this affects modules too
 
 
 if __name__ == "__main__":
+    if sys.argv[1:2] == ['preview']:
+        preview_main(sys.argv[2:])
+        exit(0)
     args = parse_args()
     if args.version:
         print(VERSION)
         exit(0)
     setup_logger(args)
 
+    if args.metrics_port is not None or args.metrics_file is not None:
+        from pcrond import metrics
+        metrics.set_default(metrics.Metrics())
+        if args.metrics_port is not None:
+            metrics.HTTPExporter(metrics.get_default(), args.metrics_port).start()
+        if args.metrics_file is not None:
+            metrics.TextFileExporter(metrics.get_default(), args.metrics_file).start()
+
+    if args.output is not None:
+        from pcrond import launcher
+        launcher.set_default(launcher.Launcher(capture=args.output))
+
+    if args.crontabdir is not None:
+        from pcrond.daemon import Daemon
+        daemon = Daemon(os.path.expanduser(args.crontabdir), args.shards, capture=args.output, splay=args.splay,
+                        catchup=args.catchup)
+        daemon.run()
+        exit(0)
+
     from pcrond import scheduler
+    scheduler.splay = args.splay
+    scheduler.catchup = args.catchup
+    if args.journal is not None:
+        from pcrond.journal import Journal
+        scheduler.set_journal(Journal(os.path.expanduser(args.journal)))
+    if args.nodes is not None:
+        import socket
+        from pcrond import cluster
+        if args.leases is None:
+            exit("--nodes requires --leases")
+        leases = os.path.expanduser(args.leases)
+        if os.path.isdir(leases):
+            backend = cluster.FileLeaseBackend(leases)
+        else:
+            backend = cluster.SQLiteLeaseBackend(leases)
+        scheduler.coordinator = cluster.Coordinator(args.node or socket.gethostname(), args.nodes.split(','), backend)
+    if args.profile is not None:
+        import signal
+        import threading
+        from pcrond.profiling import Profiler
+        scheduler.profiler = Profiler()
+
+        def dump_profile(signum, frame):
+            # the main thread may hold the lock of the profiler, so it is dumped by another thread
+            threading.Thread(target=scheduler.profiler.dump, args=(args.profile,), name="pcrond-profile").start()
+        signal.signal(signal.SIGUSR1, dump_profile)
     scheduler.load_crontab_file(args.crontabfile)
     scheduler.main_loop()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""Unit tests for pcrond.aiosched; async syntax requires Python 3.5+, see conftest.py"""
+import unittest
+import logging
+import sys
+
+logger = logging.getLogger()
+logger.addHandler(logging.NullHandler())  # do not show logs.
+
+
+def modify_obj(obj):
+    def f():
+        obj['modified'] = True
+    return f
+
+
+class AsyncSchedulerTests(unittest.TestCase):
+    @unittest.skipIf(sys.version_info < (3, 7), "requires asyncio.run")
+    def test_async_scheduler(self):
+        import asyncio
+        from pcrond import AsyncScheduler
+        from pcrond.aiosched import async_launch_func
+        test_obj = {'sync': False, 'async': False}
+
+        async def modify_async():
+            await asyncio.sleep(0)
+            test_obj['async'] = True
+
+        def modify_sync():
+            test_obj['sync'] = True
+
+        async def run():
+            sched = AsyncScheduler()
+            sched.cron("* * * * *", modify_async)
+            sched.cron("* * * * *", modify_sync)
+            command = sched.cron("* * * * *", async_launch_func([sys.executable, "-c", "import sys; sys.stdin.read()"],
+                                                                "some input"))
+            sched.run_pending()
+            assert command.running
+            await sched.join()
+            assert not command.running
+
+        asyncio.run(run())
+        assert test_obj['sync'] and test_obj['async']
+
+    @unittest.skipIf(sys.version_info < (3, 7), "requires asyncio.run")
+    def test_async_watch_crontab_file(self):
+        import asyncio
+        import os
+        import shutil
+        import tempfile
+        from pcrond import AsyncScheduler
+        from pcrond.aiosched import AsyncLaunchCommand
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "crontab")
+            with open(path, "w") as fp:
+                fp.write("30 4 * * mon echo goofy\n")
+
+            async def run():
+                sched = AsyncScheduler()
+                sched.load_crontab_file(path)
+                sched.watch_crontab_file(path, interval=0.05)
+                await asyncio.sleep(0.2)
+                with open(path, "a") as fp:
+                    fp.write("30 5 * * mon echo donald\n")
+                for _ in range(50):
+                    if len(sched.jobs) == 2:
+                        break
+                    await asyncio.sleep(0.05)
+                sched.stop()
+                return list(sched.jobs)
+
+            jobs = asyncio.run(run())
+            assert len(jobs) == 2
+            assert all(isinstance(job.job_func, AsyncLaunchCommand) for job in jobs)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @unittest.skipIf(sys.version_info < (3, 7), "requires asyncio.run")
+    def test_async_main_loop_wakes_up(self):
+        import asyncio
+        from pcrond import AsyncScheduler
+        test_obj = {'modified': False}
+
+        async def run():
+            sched = AsyncScheduler()
+            loop_task = asyncio.ensure_future(sched.main_loop())
+            await asyncio.sleep(0.1)
+            sched.cron("* * * * *", modify_obj(test_obj))
+            await asyncio.sleep(0.1)
+            sched.stop()
+            await asyncio.wait_for(loop_task, 1)
+            await sched.join()
+
+        asyncio.run(run())
+        assert test_obj['modified']
+
+    @unittest.skipIf(sys.version_info < (3, 7), "requires asyncio.run")
+    def test_async_command_overlap(self):
+        import asyncio
+        from pcrond import AsyncScheduler
+        from pcrond.aiosched import async_launch_func
+        command = [sys.executable, "-c", "import time; time.sleep(0.5)"]
+
+        async def run():
+            sched = AsyncScheduler()
+            # as in cron, commands are running only until they are started, unless an overlap policy is set
+            job = sched.cron("* * * * *", async_launch_func(command))
+            tracked = sched.cron("* * * * *", async_launch_func(command)).set_overlap()
+            sched.run_pending()
+            for _ in range(100):
+                if not job.running:
+                    break
+                await asyncio.sleep(0.01)
+            assert not job.running and tracked.running
+            await sched.join()
+            assert not tracked.running
+
+        asyncio.run(run())
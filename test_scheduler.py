@@ -4,7 +4,10 @@ import unittest
 import logging
 import sys
 from datetime import datetime as d, timedelta
-from pcrond import scheduler, Job, Parser
+from pcrond import scheduler, Job, Parser, Scheduler
+from pcrond.compiled import CompiledSchedule
+from pcrond.index import TimeIndex
+from pcrond import batch
 
 # when tests with a logger fail, you can set this to True
 SHOW_LOGGING = False
@@ -44,6 +47,22 @@ class SchedulerTests(unittest.TestCase):
         assert s == ['1', 'jul']
         assert r == [['2', '5', 3], ['10', 'goofy', 6]]
 
+    def test_tokenize(self):
+        items = self.parser.tokenize("1,2-5/3,*/4,5l,fri#2", 'l#')
+        assert [(x.start, x.end, x.step, x.modifier, x.nth, x.pos) for x in items] == \
+            [('1', None, 1, None, None, 0), ('2', '5', 3, None, None, 2), (None, None, 4, None, None, 8),
+             ('5', None, 1, 'l', None, 12), ('fri', None, 1, '#', 2, 15)]
+        assert items[2].is_any and items[1].is_range
+        with self.assertRaises(ValueError) as cm:
+            self.parser.tokenize("1,2,3x;4")
+        assert "position 6" in str(cm.exception)
+        with self.assertRaises(ValueError):
+            self.parser.tokenize("1-5w", 'w')
+        with self.assertRaises(ValueError):
+            self.parser.tokenize("5#6", '#')
+        with self.assertRaises(ValueError):
+            self.parser.tokenize("*/0")
+
     def test_decode_token(self):
         assert self.parser.decode_token("1234", {}) == "1234"
         assert self.parser.decode_token("goofy", {'goofy': "1234"}) == "1234"
@@ -186,6 +205,131 @@ class SchedulerTests(unittest.TestCase):
             Job("* * 1w2 * *")
         # currently, hour=25 does not raise errors.
 
+    def test_next_run_at(self):
+        job = Job("30 */3 * mar-jun,dec MON")
+        assert job.next_run_at(d(2019, 3, 4, 0, 30)) == d(2019, 3, 4, 0, 30)       # was mon
+        assert job.next_run_at(d(2019, 3, 4, 0, 31)) == d(2019, 3, 4, 3, 30)
+        assert job.next_run_at(d(2019, 3, 4, 21, 31)) == d(2019, 3, 11, 0, 30)
+        assert job.next_run_at(d(2019, 6, 25, 12, 0)) == d(2019, 12, 2, 0, 30)
+        job = Job("0 12 L * *")
+        assert job.next_run_at(d(2019, 2, 1)) == d(2019, 2, 28, 12, 0)
+        job = Job("0 0 * * 5#2")
+        assert job.next_run_at(d(2019, 3, 9)) == d(2019, 4, 12)
+        job = Job("0 0 1 1 * 2018")
+        assert job.next_run_at(d(2019, 1, 1)) is None
+        job = Job("0 0 30 2 *")
+        assert job.next_run_at(d(2019, 1, 1)) is None
+
+    def test_next_run_at_agrees_with_should_run_at(self):
+        start = d(2019, 2, 20)
+        for pattern in ["*/7 3-5 * * *", "0 0 15w * *", "0 0 * * 5l", "0 0 L * *", "13 13 1,20 * sun"]:
+            job = Job(pattern)
+            when = job.next_run_at(start)
+            minutes = int((when - start).total_seconds() // 60)
+            for i in range(minutes):
+                assert not job._should_run_at(start + timedelta(minutes=i))
+            assert job._should_run_at(when)
+
+    def test_scheduler_next_run(self):
+        assert scheduler.next_run is None
+        now = d.now().replace(second=0, microsecond=0)
+        job = scheduler.cron("%d %d * * *" % (now.minute, now.hour), do_nothing)
+        assert scheduler.next_run == now
+        scheduler.run_pending()
+        assert scheduler.next_run == now + timedelta(days=1)
+        scheduler.cancel_job(job)
+        assert scheduler.next_run is None
+
+    def test_compiled_schedule(self):
+        compiled = Job("30 */3 * mar-jun,dec MON").compiled
+        assert compiled.minute_mask == 1 << 30
+        assert compiled.hour_mask == sum(1 << h for h in range(0, 24, 3))
+        assert compiled.matches(d(2019, 3, 4, 3, 30))               # was mon
+        assert not compiled.matches(d(2019, 3, 5, 3, 30))           # was tue
+        assert not compiled.matches(d(2019, 7, 1, 3, 30))           # was mon, in july
+        compiled = CompiledSchedule(None, None, set(), True, set([15]), None, None, None, None, set([2019]))
+        assert compiled.day_mask(2019, 2) == (1 << 15) | (1 << 28)
+        assert compiled.day_mask(2019, 6) == (1 << 14) | (1 << 30)  # 15th was sat
+        assert not compiled.matches(d(2020, 2, 28))
+        # masks depend on the weekday of the 1st and the length of the month, and are shared by same day rules
+        other = CompiledSchedule(set([5]), None, set(), True, set([15]), None, None, None, None, None)
+        assert other.day_mask(2030, 2) == (1 << 15) | (1 << 28)    # feb 1st was fri, as in 2019
+        assert other._day_masks is compiled._day_masks
+        assert len(other._day_masks) == 2
+
+    def test_compile_cache(self):
+        from pcrond import compiled
+        assert Job("*/5 * * * *").compiled is Job(" */5  *  * * * ").compiled
+        assert Job("@hourly").compiled is Job("0 * * * * *").compiled
+        assert Job("*/5 * * * *").compiled is not Job("*/6 * * * *").compiled
+        old_size = compiled.CACHE_SIZE
+        compiled.CACHE_SIZE = 2
+        try:
+            compiled.clear_cache()
+            first = Job("1 * * * *").compiled
+            Job("2 * * * *")
+            Job("3 * * * *")
+            assert len(compiled._cache) == 2
+            assert Job("1 * * * *").compiled is not first
+        finally:
+            compiled.CACHE_SIZE = old_size
+
+    def test_time_index(self):
+        index = TimeIndex()
+        jobs = [Job(p) for p in ["*/7 3-5 * * *", "0 0 15w * *", "0 0 * * 5l", "* * * * *", "30 4 1,20 * sun",
+                                 "0 12 * jan mon-fri 2019", "* * L * *"]]
+        for job in jobs:
+            index.add(job)
+        index.remove(jobs[3])
+        assert len(index) == 6
+        when = d(2019, 1, 1)
+        for i in range(0, 60 * 24 * 62, 13):
+            now = when + timedelta(minutes=i)
+            assert index.jobs_at(now) == [job for job in jobs if job is not jobs[3] and job._should_run_at(now)]
+        index.clear()
+        assert index.jobs_at(d(2019, 1, 31, 12, 0)) == []
+
+    def test_batch(self):
+        jobs = [Job(p) for p in ["*/7 3-5 * * *", "0 0 15w * *", "0 0 * * 5l", "30 4 1,20 * sun", "* * L * *",
+                                 "0 0 1 1 * 2018"]]
+        start = d(2019, 2, 27, 3, 50)
+        end = d(2019, 3, 2, 0, 10)
+        minutes = [start + timedelta(minutes=i) for i in range(int((end - start).total_seconds() // 60))]
+        matrix = batch.match_matrix(jobs, start, end)
+        assert matrix == [[job._should_run_at(m) for m in minutes] for job in jobs]
+        times = batch.fire_times(jobs, start, end)
+        assert times == [[m for m in minutes if job._should_run_at(m)] for job in jobs]
+        counts = batch.fires_per_minute(jobs + jobs[:1], start, end)
+        assert counts == [sum(row[i] for row in matrix + matrix[:1]) for i in range(len(minutes))]
+
+    def test_job_store(self):
+        jobs = [scheduler.cron("* * * * *", do_nothing) for _ in range(3)]
+        assert [job.id for job in scheduler.jobs] == [job.id for job in jobs]
+        assert scheduler.get_job(jobs[1].id) is jobs[1]
+        scheduler.cancel_job(jobs[1])
+        assert scheduler.get_job(jobs[1].id) is None
+        assert jobs[1] not in scheduler.jobs
+        assert list(scheduler.jobs) == [jobs[0], jobs[2]]
+        job = scheduler.cron("* * * * *", do_nothing)
+        assert job.id > jobs[2].id
+
+    @unittest.skipIf(sys.version_info < (3, 4), "requires tracemalloc")
+    def test_memory_per_job(self):
+        import tracemalloc
+        job = Job("* * * * *")
+        assert not hasattr(job, '__dict__')
+        scheduler.cron("* * * * *", do_nothing)
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            for i in range(5000):
+                scheduler.cron("%d * * * *" % (i % 60), do_nothing)
+            per_job = (tracemalloc.get_traced_memory()[0] - before) / 5000
+        finally:
+            tracemalloc.stop()
+        assert per_job < 1500
+        assert scheduler.jobs.memory_usage()[1] < 200
+
     def test_misconfigured_job_wont_break_scheduler(self):
         """
         Ensure an interrupted job definition chain won't break
@@ -222,6 +366,683 @@ class SchedulerTests(unittest.TestCase):
         scheduler.run_pending()
         assert test_obj['modified'] is False
 
+    def test_run_pending_thread_pool(self):
+        import threading
+        sched = Scheduler(executor='thread', max_workers=2)
+        release = threading.Event()
+        started = []
+
+        def wait_release():
+            started.append(True)
+            release.wait(10)
+
+        def fail():
+            raise RuntimeError("expected")
+        jobs = [sched.cron("* * * * *", wait_release), sched.cron("* * * * *", wait_release),
+                sched.cron("* * * * *", fail)]
+        sched.run_pending()
+        assert jobs[0].running and jobs[1].running
+        release.set()
+        sched.shutdown()
+        assert len(started) == 2
+        assert not [job for job in jobs if job.running]
+
+    def test_failing_job_does_not_stop_loop(self):
+        import time
+        from threading import Thread
+        sched = Scheduler()
+        test_obj = {'modified': False}
+
+        def fail():
+            raise RuntimeError("expected")
+        job = sched.cron("* * * * *", fail)
+        sched.cron("* * * * *", modify_obj(test_obj))
+        thread = Thread(target=sched.main_loop)
+        thread.start()
+        time.sleep(0.2)
+        assert thread.is_alive()
+        sched.stop()
+        thread.join()
+        assert test_obj['modified'] and not job.running
+
+    @unittest.skipIf(sys.version_info < (3, 4), "requires assertLogs")
+    def test_job_exception_logged(self):
+        def fail():
+            raise RuntimeError("expected")
+        for executor in (None, 'thread'):
+            sched = Scheduler(executor=executor)
+            job = sched.cron("30 4 * * *", fail)
+            with self.assertLogs('pcrond', logging.ERROR) as cm:
+                sched._run_pending_at(d(2030, 5, 6, 4, 30))
+                sched.shutdown()
+            (record,) = [r for r in cm.records if "raised an exception" in r.getMessage()]
+            assert record.exc_info[0] is RuntimeError                  # with traceback
+            assert repr(job) in record.getMessage()
+            assert repr(job).startswith("Job('30 4 * * * *', <function ")
+
+    def test_job_running_reset_after_exception(self):
+        def fail():
+            raise RuntimeError("expected")
+        job = Job("* * * * *", fail)
+        with self.assertRaises(RuntimeError):
+            job.run()
+        assert not job.running
+
+    def test_hash_token(self):
+        for (pattern, count) in [("H * * * *", 1), ("H/15 * * * *", 4), ("H(0-29)/10 H(9-17) * * *", 3)]:
+            job = Job(pattern, do_nothing, key="job1")
+            assert job.compiled is Job(pattern, key="job1").compiled
+            assert len(job.allowed_min) == count
+        assert max(Job("H/15 * * * *", key="job1").allowed_min) - min(Job("H/15 * * * *", key="job1").allowed_min) == 45
+        job = Job("H(0-29)/10 H(9-17) H * *", key="job1")
+        assert min(job.allowed_min) < 10 and max(job.allowed_min) < 30
+        assert list(job.allowed_hours)[0] in range(9, 18)
+        assert list(job.allowed_dom)[0] in range(1, 29)
+        minutes = set(list(Job("H * * * *", key="job%d" % i).allowed_min)[0] for i in range(50))
+        assert len(minutes) > 20
+        # lines with H are seeded by their command
+        scheduler.bulk_load(["H * * * * echo a", "H * * * * echo b", "H * * * * echo a"], processes=1)
+        (a, b, a2) = list(scheduler.jobs)
+        assert a.compiled is a2.compiled
+        assert a.compiled is not b.compiled
+        assert a.compiled is Job("H * * * *", key="echo a").compiled
+        for bad in ["H-5 * * * *", "H(5) * * * *", "H(30-1) * * * *", "* * * * H#2", "0 0 1 1 * H"]:
+            with self.assertRaises(ValueError):
+                Job(bad)
+
+    def test_hash_token_bounds(self):
+        bounds = [('parse_second', 0, 59), ('parse_minute', 0, 59), ('parse_hour', 0, 23),
+                  ('parse_month', 1, 12), ('parse_day_in_week', 0, 6)]
+        for i in range(200):
+            parser = Parser("job%d" % i)
+            for (method, minval, maxval) in bounds:
+                for field in ("h", "h/5"):
+                    values = getattr(parser, method)(field)[1]
+                    assert values and all(minval <= x <= maxval for x in values), (method, field, i)
+            assert all(1 <= x <= 28 for x in parser.parse_day_in_month("h")[1])
+        job = Job("0 0 1 H *", key="job0")
+        assert job.next_run_at(d(2030, 1, 1)) is not None
+
+    def test_splay(self):
+        import time
+        counter = []
+        sched = Scheduler()
+        sched.splay = 30
+        job = sched.cron("* * * * *", lambda: counter.append(1), key="some job")
+        offset = job.splay_offset(sched.splay)
+        assert 0 < offset < 30
+        assert offset == Job("* * * * *", key="some job").splay_offset(30)
+        sched._run_pending_at(d(2030, 5, 6, 7, 8))
+        assert not counter
+        ts = time.mktime(d(2030, 5, 6, 7, 8).timetuple())
+        assert sched._delayed[0][0] == ts + offset
+        sched._start_delayed(ts + offset - 1)
+        assert not counter
+        sched._start_delayed(ts + offset)
+        assert counter == [1]
+        job.splay = 0                       # no splay for this job
+        sched._run_pending_at(d(2030, 5, 6, 7, 9))
+        assert counter == [1, 1]
+
+    def test_overlap_policies(self):
+        import threading
+        import time
+        from pcrond.job import OVERLAP_QUEUE, OVERLAP_CONCURRENT
+        minute = d(2030, 5, 6, 7, 8)
+        for (mode, expected_running, expected_runs) in [('skip', 1, 1), (OVERLAP_QUEUE, 1, 3),
+                                                        (OVERLAP_CONCURRENT, 2, 2)]:
+            release = threading.Event()
+            runs = []
+
+            def blocking():
+                runs.append(1)
+                release.wait(5)
+            sched = Scheduler(executor='thread', max_workers=4)
+            job = sched.cron("* * * * *", blocking).set_overlap(mode, max_instances=2, max_queued=2)
+            for i in range(4):
+                sched._run_pending_at(minute + timedelta(minutes=i))
+            assert job._running == expected_running
+            release.set()
+            for _ in range(100):
+                while job.running:
+                    time.sleep(0.01)
+                if not sched._waiting:
+                    break
+                sched._run_pending_at(minute)     # already evaluated, only queued runs start
+            sched.shutdown()
+            assert len(runs) == expected_runs, mode
+            assert not job.running
+        with self.assertRaises(ValueError):
+            Job("* * * * *").set_overlap('sometimes')
+
+    def test_concurrency_caps(self):
+        import threading
+        release = threading.Event()
+        runs = []
+
+        def blocking():
+            runs.append(1)
+            release.wait(5)
+        sched = Scheduler(executor='thread', max_workers=8)
+        sched.max_running = 3
+        sched.group_limits = {'backup': 1}
+        for i in range(2):
+            sched.cron("* * * * *", blocking).set_overlap(group='backup')
+        for i in range(4):
+            sched.cron("* * * * *", blocking)
+        sched._run_pending_at(d(2030, 5, 6, 7, 8))
+        assert len(runs) == 3
+        assert sched._running_groups['backup'] == 1
+        release.set()
+        sched.shutdown()
+        assert sched._running_total == 0
+
+    @unittest.skipIf(sys.platform.startswith("win"), "requires a POSIX shell")
+    def test_overlap_kill(self):
+        from pcrond.sched import std_launch_func
+        sched = Scheduler()
+        job = sched.cron("* * * * *", std_launch_func(["sleep", "10"])).set_overlap('kill')
+        sched._run_pending_at(d(2030, 5, 6, 7, 8))
+        assert job.running                                      # until the command terminates
+        (first,) = job._handles
+        sched._run_pending_at(d(2030, 5, 6, 7, 9))
+        assert first.wait(5) < 0
+        (second,) = job._handles
+        second.kill()
+        assert second.wait(5) < 0
+        assert not job.running
+
+    @unittest.skipIf(sys.platform.startswith("win"), "requires a POSIX shell")
+    def test_long_command_runs_every_minute(self):
+        from pcrond import launcher
+        from pcrond.sched import std_launch_func
+        sched = Scheduler()
+        # as in cron, a command still running from the previous minute does not stop the next run
+        job = sched.cron("* * * * *", std_launch_func(["sleep", "90"]))
+        tracked = sched.cron("* * * * *", std_launch_func(["sleep", "91"])).set_overlap('skip')
+        sched._run_pending_at(d(2030, 5, 6, 7, 8))
+        sched._run_pending_at(d(2030, 5, 6, 7, 9))
+        records = [r for r in launcher.get_default().running.values() if r.args[0] == "sleep"]
+        try:
+            assert sorted(r.args[1] for r in records) == ["90", "90", "91"]
+            assert not job.running and tracked.running
+        finally:
+            for record in records:
+                record.kill()
+                record.wait(5)
+
+    def test_std_launch_func_picklable(self):
+        import pickle
+        from pcrond.sched import std_launch_func
+        f = pickle.loads(pickle.dumps(std_launch_func(["echo", "goofy"], "some input")))
+        assert f.cmd_splitted == ["echo", "goofy"]
+        assert f.stdin == "some input"
+
+    @unittest.skipIf(sys.platform.startswith("win"), "requires a POSIX shell")
+    def test_launcher(self):
+        from pcrond.launcher import Launcher
+        for use_posix_spawn in (True, False):
+            launcher = Launcher(capture='buffer', buffer_size=8, use_posix_spawn=use_posix_spawn)
+            try:
+                record = launcher.spawn(["sh", "-c", "cat; echo oops >&2; exit 3"], "some input")
+                assert record.wait(5) == 3
+                assert record.stdout.getvalue() == b"me input"
+                assert record.stdout.truncated
+                assert record.stderr.getvalue() == b"oops\n"
+                assert not launcher.running
+                assert list(launcher.finished) == [record]
+            finally:
+                launcher.shutdown()
+
+    @unittest.skipIf(sys.platform.startswith("win"), "requires a POSIX shell")
+    def test_launcher_without_selectors(self):
+        from pcrond import launcher
+        old = sys.modules.get('selectors')
+        sys.modules['selectors'] = None         # import fails, as on Python 2
+        try:
+            assert isinstance(launcher._new_selector(), launcher._SelectSelector)
+            self.test_launcher()
+        finally:
+            if old is None:
+                del sys.modules['selectors']
+            else:
+                sys.modules['selectors'] = old
+
+    @unittest.skipIf(sys.platform.startswith("win"), "requires a POSIX shell")
+    def test_command_usage(self):
+        # with posix_spawn where available, and with the Popen fallback
+        for use_posix_spawn in (True, False):
+            self._check_command_usage(use_posix_spawn)
+
+    def _check_command_usage(self, use_posix_spawn):
+        from pcrond import launcher
+        from pcrond.metrics import Metrics
+        from pcrond.profiling import Profiler
+        from pcrond.sched import std_launch_func
+        metrics = Metrics()
+        sched = Scheduler(metrics=metrics)
+        sched.profiler = Profiler()
+        old = launcher.get_default()
+        launcher.set_default(launcher.Launcher(use_posix_spawn=use_posix_spawn))
+        try:
+            loop = "i=0; while [ $i -lt 100000 ]; do i=$((i+1)); done"
+            job = sched.cron("* * * * *", std_launch_func(["sh", "-c", loop])).set_overlap()
+            sched._run_pending_at(d(2030, 5, 6, 7, 8))
+            record = job._handles[0]
+            assert 'pcrond_job_runtime_seconds' not in metrics.histograms      # not terminated yet
+            assert record.wait(30) == 0
+            assert record.cpu_time > 0 and record.max_rss > 0
+            stats = sched.profiler.stats[job.id]
+            assert stats.calls == 1 and stats.children_cpu_time == record.cpu_time
+            assert stats.children_max_rss == record.max_rss
+            assert stats.wall_time >= record.wall_time
+            assert metrics.histograms['pcrond_job_runtime_seconds'].sum >= record.wall_time
+        finally:
+            launcher.get_default().shutdown()
+            launcher.set_default(old)
+
+    @unittest.skipIf(sys.platform.startswith("win"), "requires a POSIX shell")
+    def test_std_launch_func_reaps(self):
+        from pcrond import launcher
+        from pcrond.sched import std_launch_func
+        launcher.set_default(launcher.Launcher(capture='buffer'))
+        try:
+            sched = Scheduler()
+            sched.bulk_load(["* * * * * cat%some%input"], std_launch_func)
+            record = sched.jobs.get(1).run()
+            assert record.wait(5) == 0
+            assert record.stdout.getvalue() == b"some\ninput"
+        finally:
+            launcher.get_default().shutdown()
+            launcher.set_default(None)
+
+    def test_run_pending_once_per_minute(self):
+        counter = []
+        sched = Scheduler()
+        sched.cron("* * * * *", lambda: counter.append(1))
+        now = d.now() + timedelta(minutes=1)
+        sched._run_pending_at(now)
+        sched._run_pending_at(now)
+        assert len(counter) == 1
+        sched.cron("* * * * *", lambda: counter.append(2))      # added later in the same minute
+        sched._run_pending_at(now)
+        sched._run_pending_at(now)
+        assert counter == [1, 2]
+
+    def test_catchup(self):
+        tomorrow = d.now().replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+        for (policy, expected) in [('skip', 0), ('once', 1), ('all', 5)]:
+            counter = []
+            sched = Scheduler()
+            sched.catchup = policy
+            sched.cron("*/10 0 * * *", lambda: counter.append(1))
+            sched._run_pending_at(tomorrow)
+            assert len(counter) == 1
+            sched._run_pending_at(tomorrow + timedelta(minutes=55))       # 10, 20, 30, 40, 50 were missed
+            assert len(counter) == 1 + expected
+
+    def test_metrics(self):
+        from pcrond.metrics import Metrics
+        metrics = Metrics()
+        sched = Scheduler(metrics=metrics)
+        sched.cron("* * * * *", do_nothing)
+        sched.cron("0 0 1 1 *", do_nothing)
+        sched._run_pending_at(d(2030, 5, 6, 7, 8))
+        assert metrics.counters['pcrond_jobs_fired_total'] == 1
+        assert metrics.counters['pcrond_jobs_evaluated_total'] >= 1
+        assert metrics.histograms['pcrond_tick_seconds'].count == 1
+        assert metrics.histograms['pcrond_job_runtime_seconds'].count == 1
+        assert metrics.histograms['pcrond_lateness_seconds'].count == 1
+        text = metrics.render()
+        assert '# TYPE pcrond_tick_seconds histogram' in text
+        assert 'pcrond_job_runtime_seconds_bucket{le="+Inf"} 1' in text
+        assert 'pcrond_jobs_fired_total 1' in text
+
+    def test_metrics_exporters(self):
+        import os
+        import tempfile
+        from pcrond.metrics import Metrics, TextFileExporter, HTTPExporter
+        try:
+            from urllib.request import urlopen
+        except ImportError:
+            from urllib2 import urlopen
+        metrics = Metrics()
+        metrics.inc('pcrond_jobs_fired_total', 3)
+        path = os.path.join(tempfile.mkdtemp(), "pcrond.prom")
+        exporter = TextFileExporter(metrics, path, interval=60)
+        exporter.start()
+        exporter.stop(wait=True)
+        with open(path) as fp:
+            assert 'pcrond_jobs_fired_total 3' in fp.read()
+        exporter = HTTPExporter(metrics, port=0)
+        exporter.start()
+        try:
+            body = urlopen("http://127.0.0.1:%d/metrics" % exporter.port).read().decode()
+        finally:
+            exporter.stop(wait=True)
+        assert 'pcrond_jobs_fired_total 3' in body
+
+    def test_profiler(self):
+        import os
+        import json
+        import tempfile
+        from pcrond.profiling import Profiler
+        sched = Scheduler()
+        sched.profiler = Profiler()
+        sched.load_crontab_file(os.path.join("tests", "crontab.txt"))
+        job = sched.cron("* * * * *", lambda: sum(range(10000)))
+        sched._run_pending_at(d(2030, 5, 6, 7, 8))
+        stats = sched.profiler.stats[job.id]
+        assert stats.checks == 1
+        assert stats.calls == 1
+        assert stats.cpu_time > 0
+        assert stats.wall_time > 0
+        assert sched.profiler.top(1, 'calls')[0] is stats
+        assert sched.profiler.loads[0]['jobs'] == 4
+        path = os.path.join(tempfile.mkdtemp(), "profile.json")
+        sched.profiler.dump(path)
+        with open(path) as fp:
+            assert json.load(fp)['jobs'][0]['job_id'] == job.id
+
+    def test_journal(self):
+        import os
+        import tempfile
+        from pcrond.journal import Journal
+        path = os.path.join(tempfile.mkdtemp(), "journal")
+        journal = Journal(path, sync_interval=60)
+        journal.record("some job", 1000)
+        journal.record("other job", 2000)
+        journal.record("some job", 3000)
+        assert Journal(path).last_runs == {}            # still buffered
+        journal.flush()
+        with open(path, "ab") as fp:
+            fp.write(b"R 4000 some")                    # truncated by a crash
+        assert Journal(path).last_runs == {"some job": 3000, "other job": 2000}
+        journal.compact()
+        with open(path, "rb") as fp:
+            assert len(fp.readlines()) == 2
+        journal.close()
+
+    def test_journal_recovery(self):
+        import os
+        import time
+        import tempfile
+        from pcrond.journal import Journal, boot_time
+        path = os.path.join(tempfile.mkdtemp(), "journal")
+        tomorrow = d.now().replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+        counter = []
+
+        def new_scheduler():
+            sched = Scheduler()
+            sched.catchup = 'once'
+            sched.set_journal(Journal(path, sync_interval=0))
+            sched.cron("*/10 0 * * *", lambda: counter.append(1), key="job")
+            return sched
+        new_scheduler()._run_pending_at(tomorrow)
+        assert len(counter) == 1
+        # restart in the same minute: no double run
+        new_scheduler()._run_pending_at(tomorrow)
+        assert len(counter) == 1
+        # restart later: runs at 0:10 ... 0:50 were missed
+        new_scheduler()._run_pending_at(tomorrow + timedelta(minutes=55))
+        assert len(counter) == 2
+        if boot_time() is not None:
+            sched = new_scheduler()
+            job = sched.cron("@reboot", do_nothing, key="reboot job")
+            assert job.is_reboot
+            assert not sched._already_run(job, 0)
+            sched._record_run(job, time.time())
+            assert sched._already_run(job, 0)
+
+    def test_plan_shards(self):
+        from pcrond.daemon import plan_shards
+        plan = plan_shards({"a": 10, "b": 5, "c": 5, "d": 1}, 2)
+        assert plan["a"] != plan["b"] == plan["c"] != plan["d"]
+        # files stay in their shard...
+        plan2 = plan_shards({"a": 10, "b": 5, "c": 5, "d": 1, "e": 2}, 2, plan)
+        assert all(plan2[f] == plan[f] for f in plan)
+        # ...unless shards become unbalanced
+        plan3 = plan_shards({"a": 10, "b": 5, "c": 5, "f": 12}, 2, {"a": 0, "b": 1, "c": 1, "f": 0})
+        loads = [sum(w for (f, w) in [("a", 10), ("b", 5), ("c", 5), ("f", 12)] if plan3[f] == s) for s in (0, 1)]
+        assert max(loads) < 22 and max(loads) <= 1.25 * 16
+
+    def test_daemon(self):
+        import os
+        import tempfile
+        from pcrond.daemon import Daemon
+        directory = tempfile.mkdtemp()
+        for (name, lines) in (("alice", 3), ("bob", 2), (".hidden", 1), ("carol~", 1)):
+            with open(os.path.join(directory, name), "w") as fp:
+                fp.write("0 0 1 1 * true\n" * lines)
+        daemon = Daemon(directory, shards=2)
+        try:
+            daemon.start()
+            assert sorted(daemon.assignment) == [os.path.join(directory, "alice"), os.path.join(directory, "bob")]
+            assert sorted(daemon.job_counts()) == [2, 3]
+            with open(os.path.join(directory, "dave"), "w") as fp:
+                fp.write("0 0 1 1 * true\n")
+            os.remove(os.path.join(directory, "alice"))
+            daemon.scan()
+            assert sum(daemon.job_counts()) == 3
+            # unchanged files are not read again
+            from pcrond import daemon as daemon_module
+            (counted, count_jobs) = ([], daemon_module.count_jobs)
+            daemon_module.count_jobs = lambda path: counted.append(path) or count_jobs(path)
+            try:
+                daemon.scan()
+            finally:
+                daemon_module.count_jobs = count_jobs
+            assert counted == []
+        finally:
+            daemon.shutdown()
+
+    def test_hash_ring(self):
+        from pcrond.cluster import HashRing
+        ring = HashRing(["a", "b", "c"])
+        keys = ["job %d" % i for i in range(300)]
+        owners = dict((key, ring.owner(key)) for key in keys)
+        assert all(50 < list(owners.values()).count(node) < 150 for node in "abc")
+        assert all(ring.preference(key)[0] == owners[key] for key in keys)
+        # only the jobs of the removed node move
+        ring2 = HashRing(["a", "b"])
+        assert all(ring2.owner(key) == owners[key] for key in keys if owners[key] != "c")
+
+    def test_lease_backends(self):
+        import os
+        import tempfile
+        from pcrond.cluster import SQLiteLeaseBackend, FileLeaseBackend
+        directory = tempfile.mkdtemp()
+        for backend in (SQLiteLeaseBackend(os.path.join(directory, "leases.db")),
+                        FileLeaseBackend(os.path.join(directory, "leases"))):
+            assert backend.acquire("some job", 1000, "a")
+            assert not backend.acquire("some job", 1000, "b")
+            assert backend.acquire("some job", 1060, "b")
+            assert backend.holder("some job", 1000) == "a"
+            backend.purge(1060)
+            assert backend.holder("some job", 1000) is None
+            assert backend.holder("some job", 1060) == "b"
+            backend.close()
+
+    def test_cluster(self):
+        import os
+        import time
+        import tempfile
+        from pcrond.cluster import Coordinator, SQLiteLeaseBackend
+        path = os.path.join(tempfile.mkdtemp(), "leases.db")
+        runs = []
+        nodes = {}
+        for node in ("a", "b"):
+            nodes[node] = Scheduler()
+            nodes[node].coordinator = Coordinator(node, ["a", "b"], SQLiteLeaseBackend(path), takeover_delay=30)
+            for i in range(20):
+                nodes[node].cron("* * * * *", (lambda node, i: lambda: runs.append((node, i)))(node, i), key=str(i))
+        now = d(2030, 5, 6, 7, 8)
+        ts = time.mktime(now.timetuple())
+        for sched in nodes.values():
+            sched._run_pending_at(now)
+        # each job ran once, on its owner
+        assert sorted(i for (_, i) in runs) == list(range(20))
+        assert len(set(node for (node, _) in runs)) == 2
+        for sched in nodes.values():
+            sched._start_delayed(ts + 30)
+        assert len(runs) == 20
+        # node b is down: node a takes its jobs over, after the delay
+        del runs[:]
+        nodes["a"]._run_pending_at(now + timedelta(minutes=1))
+        owned = len(runs)
+        assert 0 < owned < 20
+        nodes["a"]._start_delayed(ts + 60 + 30)
+        assert sorted(i for (_, i) in runs) == list(range(20))
+
+    def test_default_keys_are_unique(self):
+        import os
+        import tempfile
+        from pcrond.cluster import Coordinator, SQLiteLeaseBackend
+        path = os.path.join(tempfile.mkdtemp(), "leases.db")
+        runs = []
+        sched = Scheduler()
+        sched.coordinator = Coordinator("a", ["a"], SQLiteLeaseBackend(path))
+        first = sched.cron("* * * * *", lambda: runs.append("backup db"))
+        second = sched.cron("* * * * *", lambda: runs.append("rotate logs"))
+        assert first.key != second.key
+        sched._run_pending_at(d(2030, 5, 6, 7, 8))
+        assert sorted(runs) == ["backup db", "rotate logs"]
+        # H tokens follow the key, id included
+        jobs = [sched.cron("H H * * *", do_nothing) for _ in range(10)]
+        assert all(job.compiled.seed == job.key for job in jobs)
+        assert len(set((tuple(job.allowed_min), tuple(job.allowed_hours)) for job in jobs)) > 1
+
+    def test_time_zones(self):
+        import calendar
+        from pcrond import zones
+        if zones.ZoneInfo is None:
+            self.skipTest("zoneinfo is not available")
+        with self.assertRaises(ValueError):
+            Job("* * * * *", do_nothing, tz="Goofy/Nowhere")
+        sched = Scheduler()
+        runs = []
+        sched.cron("0 9 * * *", lambda: runs.append("rome"), tz="Europe/Rome")
+        sched.cron("0 9 * * *", lambda: runs.append("tokyo"), tz="Asia/Tokyo")
+        ts = calendar.timegm((2030, 6, 3, 0, 0, 0))      # 9:00 in Tokyo
+        sched._run_pending_at(d.fromtimestamp(ts))
+        ts = calendar.timegm((2030, 6, 3, 7, 0, 0))      # 9:00 in Rome, summer time
+        sched._run_pending_at(d.fromtimestamp(ts))
+        assert runs == ["tokyo", "rome"]
+        report = sched.bulk_load(["CRON_TZ=Asia/Tokyo", "0 9 * * * true", "CRON_TZ=Mars/Olympus", "CRON_TZ=",
+                                  "0 9 * * * false"])
+        assert [str(job.tz) for job in report.jobs] == ["Asia/Tokyo", "None"]
+        assert len(report.errors) == 1
+
+    def test_dst(self):
+        import calendar
+        from pcrond import zones
+        if zones.ZoneInfo is None:
+            self.skipTest("zoneinfo is not available")
+        sched = Scheduler()
+        runs = []
+        now = []
+        sched.cron("30 2 * * *", lambda: runs.append(("daily", now[0])), tz="Europe/Rome")
+        sched.cron("30 * * * *", lambda: runs.append(("hourly", now[0])), tz="Europe/Rome")
+
+        def tick(*utc):
+            start = calendar.timegm(utc)
+            for ts in range(start, start + 4 * 3600, 60):
+                now[:] = [ts]
+                sched._run_pending_at(d.fromtimestamp(ts))
+            return [(name, ts - start) for (name, ts) in runs]
+        # clocks go from 2:00 to 3:00 at 1:00 UTC: the daily job runs right after the jump
+        assert tick(2030, 3, 30, 23, 0, 0) == [("hourly", 1800), ("hourly", 3600 + 1800), ("daily", 7200),
+                                               ("hourly", 7200 + 1800), ("hourly", 3 * 3600 + 1800)]
+        rome = zones.get_zone("Europe/Rome")
+        job = list(sched.jobs)[0]
+        assert zones.next_fire(job.compiled, calendar.timegm((2030, 3, 31, 0, 0, 0)), rome) == \
+            calendar.timegm((2030, 3, 31, 1, 0, 0))
+        # clocks go from 3:00 back to 2:00 at 1:00 UTC: the daily job runs only the first time
+        del runs[:]
+        assert tick(2030, 10, 26, 23, 0, 0) == [("hourly", 1800), ("daily", 3600 + 1800), ("hourly", 3600 + 1800),
+                                                ("hourly", 7200 + 1800), ("hourly", 3 * 3600 + 1800)]
+
+    def test_seconds(self):
+        import time
+        job = Job("*/15 30 12 * * ? *")
+        assert job.compiled.seconds == (0, 15, 30, 45)
+        assert job.crontab_pattern == ['*/15', '30', '12', '*', '*', '*', '*']
+        assert Job("30 12 * * *").compiled.seconds is None
+        job = Job("H H * * * * *", key="a")
+        assert job.compiled.seconds == (8,) and job.allowed_min == set([26])     # not the same value
+        report = scheduler.bulk_load(["*/10 * * * * * * true", "0 0 * * * 2030 true"])
+        assert [job.compiled.seconds for job in report.jobs] == [(0, 10, 20, 30, 40, 50), None]
+        counter = []
+        sched = Scheduler()
+        sched.cron("* * * * *", do_nothing)
+        sched._run_pending_at(d(2030, 5, 6, 7, 8))
+        assert not sched._delayed                   # minute-only jobs need no more wakeups
+        sched.cron("*/20 * * * * * *", lambda: counter.append(1))
+        sched._run_pending_at(d(2030, 5, 6, 7, 9))
+        ts = time.mktime(d(2030, 5, 6, 7, 9).timetuple())
+        assert [entry[0] - ts for entry in sorted(sched._delayed)] == [0, 20, 40]
+        sched._start_delayed(ts + 20)
+        assert len(counter) == 2
+        sched._start_delayed(ts + 40)
+        assert len(counter) == 3
+
+    def test_preview(self):
+        from pcrond import preview
+        report = Scheduler().bulk_load(["0 */6 * * 1-5 a", "30 12 * * 1-5 b", "0 12 * * 1-5 c",
+                                        "*/20 0 0 * * ? * d", "0 0 29 2 * e"])
+        start = d(2030, 5, 3, 11, 0)                # a Friday
+        runs = preview.preview(report.jobs, start, start + timedelta(days=3))
+        assert [(t.strftime("%a %H:%M:%S"), job.job_func.cmd_splitted[0]) for (t, job) in runs] == [
+            ("Fri 12:00:00", "a"), ("Fri 12:00:00", "c"), ("Fri 12:30:00", "b"), ("Fri 18:00:00", "a"),
+            ("Sat 00:00:00", "d"), ("Sat 00:00:20", "d"), ("Sat 00:00:40", "d"),
+            ("Sun 00:00:00", "d"), ("Sun 00:00:20", "d"), ("Sun 00:00:40", "d"),
+            ("Mon 00:00:00", "a"), ("Mon 00:00:00", "d"), ("Mon 00:00:20", "d"), ("Mon 00:00:40", "d"),
+            ("Mon 06:00:00", "a")]
+        runs = preview.preview(report.jobs, start, start + timedelta(days=36500))
+        assert next(runs)[0] == d(2030, 5, 3, 12, 0)    # runs are not computed in advance
+
+    def test_histogram(self):
+        from pcrond import preview
+        report = Scheduler().bulk_load(["H H * * * job%d" % i for i in range(200)] +
+                                       ["*/15 * * * 1 a", "0 0 L * * b", "*/30 * * * * * * c"])
+        (start, end) = (d(2030, 1, 30, 22, 30), d(2030, 3, 2, 1, 0))
+        minute_jobs = report.jobs[:-1]
+        assert preview.histogram(minute_jobs, start, end) == batch.fires_per_minute(minute_jobs, start, end)
+        counts = preview.histogram(report.jobs, start, end)
+        expected = [0] * len(counts)
+        for (t, _) in preview.preview(report.jobs, start, end):
+            expected[int((t - start).total_seconds() // 60)] += 1
+        assert counts == expected
+        ((when, n),) = preview.peaks(counts, start, 1)
+        assert n == max(counts) and counts[int((when - start).total_seconds() // 60)] == n
+
+    def test_main_loop_wakes_up(self):
+        import time
+        from threading import Thread
+        sched = Scheduler()
+        test_obj = {'modified': False}
+        thread = Thread(target=sched.main_loop)
+        thread.start()
+        time.sleep(0.2)
+        sched.cron("* * * * *", modify_obj(test_obj))
+        time.sleep(0.2)
+        start = time.time()
+        sched.stop()
+        thread.join()
+        assert time.time() - start < 1
+        assert test_obj['modified']
+
+    @unittest.skipIf(sys.version_info < (3, 3), "requires time.monotonic")
+    def test_wait_ignores_wall_clock(self):
+        import time
+        from unittest import mock
+        sched = Scheduler()
+        start = time.monotonic()
+        # the wall clock goes back an hour at each reading
+        with mock.patch('time.time', side_effect=(time.time() - 3600 * i for i in range(1000))):
+            sched._wait(0.2)
+        assert 0.15 < time.monotonic() - start < 1
+
     def test_split_input_line(self):
         assert scheduler._split_input_line('aaaa%%bbbbbb%cccc%dd%%ee') == ['aaaa%bbbbbb', 'cccc\ndd%ee']
         assert scheduler._split_input_line('aaaa%%bbbbbb') == ['aaaa%bbbbbb']
@@ -232,9 +1053,94 @@ class SchedulerTests(unittest.TestCase):
         scheduler.load_crontab_file(os.path.join("tests", "crontab.txt"))
         assert len(scheduler.jobs) == 4
 
+    def test_bulk_load(self):
+        lines = ["# comment", "30 4 * * mon echo goofy", "0 0 * * * 2020 echo year", "too short line",
+                 "0 0 * * * 20x0 echo not a year", "61 * * * * echo wrong minute", "@daily echo midnight",
+                 "a b c d e f"] + ["%d * * * * echo %d" % (i % 60, i) for i in range(3000)]
+        report = scheduler.bulk_load(lines, processes=2, chunksize=10)
+        assert [(e.rownum, e.line) for e in report.errors] == [(3, "too short line"), (7, "a b c d e f")]
+        assert len(report.jobs) == len(lines) - 3 == len(scheduler.jobs)
+        assert report.jobs[1].crontab_pattern == ['0', '0', '*', '*', '*', '2020']
+        assert report.jobs[2].crontab_pattern == ['0', '0', '*', '*', '*', '*']
+        assert report.jobs[-1].crontab_pattern == ['59', '*', '*', '*', '*', '*']
+        assert report.jobs[-1].compiled is report.jobs[-61].compiled
+
+    def test_load_crontab_one_arg_factory(self):
+        commands = []
+
+        def job_func_func(tokens):
+            commands.append(tokens)
+            return do_nothing
+
+        report = Scheduler().bulk_load(["* * * * * cat%some input", "* * * * * echo 100%%"], job_func_func)
+        assert not report.errors and len(report.jobs) == 2
+        assert commands == [["cat"], ["echo", "100%"]]
+
+    def test_iter_crontab_entries(self):
+        from pcrond.loader import LoadError, iter_crontab_entries
+        read = []
+
+        def lines():
+            for i in range(1000):
+                read.append(i)
+                yield (i, "%d * * * * echo %d" % (i % 60, i) if i != 3 else "bad line")
+        entries = iter_crontab_entries(lines(), block_lines=10)
+        first = [next(entries) for _ in range(5)]
+        assert len(read) == 10          # only the first block was read
+        assert isinstance(first[3], LoadError) and first[3].rownum == 3
+        assert [x.rownum for x in entries] == list(range(5, 1000))
+
+    def test_load_crontab_incremental(self):
+        import os
+        import shutil
+        import tempfile
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "crontab")
+            with open(path, "w") as fp:
+                fp.write("30 4 * * mon echo goofy\n30 5 * * mon echo donald\n30 5 * * mon echo donald\n")
+            scheduler.load_crontab_file(path)
+            jobs = list(scheduler.jobs)
+            assert len(jobs) == 3
+            with open(path, "w") as fp:
+                fp.write("# a comment\n30 5 * * mon echo donald\n30 6 * * mon echo mickey\n")
+            scheduler.load_crontab_file(path, incremental=True)
+            assert len(scheduler.jobs) == 2
+            assert jobs[1] in scheduler.jobs or jobs[2] in scheduler.jobs
+            assert jobs[0] not in scheduler.jobs
+            assert [job.crontab_pattern[1] for job in scheduler.jobs] == ['5', '6']
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_watch_crontab_file(self):
+        import os
+        import shutil
+        import tempfile
+        import time
+        from pcrond.watch import FileWatcher
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "crontab")
+            with open(path, "w") as fp:
+                fp.write("30 4 * * mon echo goofy\n")
+            for use_inotify in (True, False):
+                changes = []
+                watcher = FileWatcher(path, lambda: changes.append(True), 0.05, use_inotify)
+                watcher.start()
+                time.sleep(0.2)
+                with open(path, "a") as fp:
+                    fp.write("30 5 * * mon echo donald\n")
+                for _ in range(50):
+                    if changes:
+                        break
+                    time.sleep(0.05)
+                watcher.stop(wait=True)
+                assert changes
+        finally:
+            shutil.rmtree(tmpdir)
+
     @unittest.skipIf(sys.platform.startswith("win"), "requires *NIX")
     def test_load_crontab_and_main_loop(self):
-        # FIXME this is a slow test, currently 1 minute
         import os
         import time
         from threading import Thread